@@ -10,7 +10,12 @@ from pathlib import Path
 # Добавить src в path
 sys.path.insert(0, str(Path(__file__).parent / "src"))
 
-from bot import run_bot
+from config import BOT_RUNTIME
 
 if __name__ == "__main__":
-    run_bot()
+    if BOT_RUNTIME == "async":
+        from async_bot import run_async_bot
+        run_async_bot()
+    else:
+        from bot import run_bot
+        run_bot()
@@ -0,0 +1,485 @@
+"""
+Асинхронный режим бота (BOT_RUNTIME = "async")
+AsyncTeleBot обрабатывает тяжелые сценарии - ссылки, выбор качества и отправку
+файлов - без отдельного потока на каждую операцию. Остальные обновления
+(команды, админка, платежи) передаются обработчикам синхронного бота из bot.py.
+Требует aiohttp.
+"""
+
+import asyncio
+import logging
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from telebot import types, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from config import (
+    TELEGRAM_TOKEN, MAX_FILE_SIZE_MB, MESSAGES, TELEGRAM_API_URL, BOT_UPDATE_MODE, WEBHOOK_PUBLIC_URL,
+    WEBHOOK_PATH, WEBHOOK_LISTEN_HOST, WEBHOOK_LISTEN_PORT, WEBHOOK_MAX_CONNECTIONS, HANDLER_QUEUE_SIZE,
+    HANDLER_PER_USER_CONCURRENCY, HANDLER_PER_USER_QUEUE,
+)
+from http_server import WebhookServer
+from progress_notifier import progress_markup
+from update_dispatcher import update_user_id
+from db import db
+from storage import storage_manager
+from utils import is_youtube_url, canonical_video_key, canonical_video_url, get_video_info
+from bot import (
+    bot as sync_bot,
+    busy_notice_due,
+    url_cache,
+    url_cache_lock,
+    video_info_messages,
+    video_info_lock,
+    progress_messages,
+    progress_lock,
+    progress_notifier,
+    update_pool,
+    FORMAT_EMOJI,
+    video_info_error,
+    build_video_menu,
+    start_services,
+    stop_services,
+    webhook_secret_token,
+    _media_type_for,
+    _media_caption,
+    _remember_file_id,
+    _too_large_text,
+)
+
+logger = logging.getLogger(__name__)
+
+# Callback-кнопки, которые обрабатываются асинхронно
+ASYNC_CALLBACK_PREFIXES = ("download_", "confirm_download_")
+
+
+def is_async_update(update: types.Update) -> bool:
+    """Обновление обрабатывается асинхронными обработчиками этого модуля."""
+    message = update.message
+    if message and message.text and (is_youtube_url(message.text) or message.text.startswith("http")):
+        return True
+    call = update.callback_query
+    return bool(call and call.data and call.data.startswith(ASYNC_CALLBACK_PREFIXES))
+
+
+class HybridAsyncTeleBot(AsyncTeleBot):
+    """AsyncTeleBot, который отдает остальные обновления синхронному боту.
+    Синхронный бот выполняет их в своем пуле потоков, event loop не блокируется.
+    Свои обновления ограничены на пользователя так же, как в update_pool.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user_in_flight: Dict[int, int] = {}  # user_id -> обновлений в обработке
+
+    async def process_new_updates(self, updates: List[types.Update]):
+        delegated = [update for update in updates if not is_async_update(update)]
+        if delegated:
+            sync_bot.process_new_updates(delegated)
+        own = [update for update in updates if is_async_update(update)]
+        if own:
+            await asyncio.gather(*(self._process_limited(update) for update in own))
+
+    async def _process_limited(self, update: types.Update):
+        user_id = update_user_id(update)
+        limit = HANDLER_PER_USER_CONCURRENCY + HANDLER_PER_USER_QUEUE
+        if user_id is not None and self.user_in_flight.get(user_id, 0) >= limit:
+            logger.warning(f"Too many updates in flight for user {user_id}, rejecting update {update.update_id}")
+            await _reject_update(update)
+            return
+
+        self.user_in_flight[user_id] = self.user_in_flight.get(user_id, 0) + 1
+        try:
+            await super().process_new_updates([update])
+        finally:
+            self.user_in_flight[user_id] -= 1
+            if not self.user_in_flight[user_id]:
+                del self.user_in_flight[user_id]
+
+
+if TELEGRAM_API_URL:
+    asyncio_helper.API_URL = TELEGRAM_API_URL
+async_bot = HybridAsyncTeleBot(TELEGRAM_TOKEN)
+
+
+async def _reject_update(update: types.Update):
+    """Ответить на отброшенное обновление, что бот занят."""
+    try:
+        if update.callback_query is not None:
+            await async_bot.answer_callback_query(update.callback_query.id, MESSAGES["busy"], show_alert=False)
+        elif update.message is not None and busy_notice_due(update_user_id(update)):
+            await async_bot.send_message(update.message.chat.id, MESSAGES["busy"])
+    except Exception as e:
+        logger.debug(f"Reject handler error: {e}")
+
+
+class AsyncKeyedLock:
+    """asyncio-аналог utils.KeyedLock: сериализует корутины с одним ключом."""
+
+    def __init__(self):
+        self.locks: Dict[object, list] = {}  # key -> [asyncio.Lock, число пользователей]
+
+    async def run(self, key, coro_func, *args):
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await coro_func(*args)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+
+# Отправки одного видео в одном формате идут по очереди (см. bot.send_locks)
+send_locks = AsyncKeyedLock()
+
+
+# ==================== Ссылки ====================
+
+@async_bot.message_handler(func=lambda m: m.text and (is_youtube_url(m.text) or m.text.startswith("http")))
+async def handle_video_link(message: types.Message):
+    """Обработка ссылки на видео: метаданные извлекаются вне event loop."""
+    user_id = message.from_user.id
+    url = message.text.strip()
+
+    if not url.startswith("http"):
+        return
+
+    youtube = is_youtube_url(url)
+    url, video_key = canonical_video_url(url), canonical_video_key(url)
+    with url_cache_lock:
+        url_cache[user_id] = {'url': url, 'key': video_key, 'timestamp': time.time()}
+
+    await asyncio.to_thread(db.add_or_update_user, user_id, message.from_user.username, message.from_user.first_name)
+
+    wait_msg = await async_bot.send_message(message.chat.id, "⏳ Получаю информацию о видео...")
+
+    try:
+        video_info = await asyncio.to_thread(get_video_info, url)
+
+        error_text = video_info_error(video_info)
+        if error_text:
+            await async_bot.edit_message_text(error_text, message.chat.id, wait_msg.message_id)
+            return
+
+        text, markup = build_video_menu(video_info, user_id, youtube)
+
+        menu_message_id = wait_msg.message_id
+        if video_info.get("thumbnail"):
+            try:
+                await async_bot.delete_message(message.chat.id, wait_msg.message_id)
+                sent_msg = await async_bot.send_photo(
+                    message.chat.id,
+                    video_info["thumbnail"],
+                    caption=text,
+                    reply_markup=markup
+                )
+                menu_message_id = sent_msg.message_id
+            except Exception:
+                await async_bot.edit_message_text(text, message.chat.id, wait_msg.message_id, reply_markup=markup)
+        else:
+            await async_bot.edit_message_text(text, message.chat.id, wait_msg.message_id, reply_markup=markup)
+
+        # Сохранить message_id для удаления позже
+        with video_info_lock:
+            video_info_messages[user_id] = menu_message_id
+
+        logger.info(f"User {user_id} sent {'YouTube' if youtube else 'non-YouTube'} link: {url}")
+
+    except Exception as e:
+        logger.error(f"Error handling video link: {e}")
+        await async_bot.edit_message_text(
+            MESSAGES["error"].format(error=str(e)[:100]), message.chat.id, wait_msg.message_id
+        )
+
+
+# ==================== Выбор качества ====================
+
+@async_bot.callback_query_handler(func=lambda c: c.data.startswith("download_"))
+async def handle_download_callback(call: types.CallbackQuery):
+    """Обработка выбора качества."""
+    parts = call.data.split("_")
+    await _start_download(call, parts[1], int(parts[2]), youtube=True)
+
+
+@async_bot.callback_query_handler(func=lambda c: c.data.startswith("confirm_download_"))
+async def handle_confirm_download_callback(call: types.CallbackQuery):
+    """Обработка подтверждения скачивания не-YouTube видео."""
+    parts = call.data.split("_")
+    await _start_download(call, parts[2], int(parts[3]), youtube=False)
+
+
+async def _start_download(call: types.CallbackQuery, format_type: str, user_id: int, youtube: bool):
+    """Отправить файл из кеша или поставить загрузку в очередь."""
+    if call.from_user.id != user_id:
+        await async_bot.answer_callback_query(call.id, "❌ Это не твоя ссылка", show_alert=True)
+        return
+
+    chat_id = call.message.chat.id
+    emoji = FORMAT_EMOJI.get(format_type, "📥")
+    warning = "" if youtube else "⚠️ ВНИМАНИЕ: Скачивание не-YouTube видео!\n\n"
+    try:
+        await async_bot.edit_message_text(
+            f"{warning}⏳ Подготавливаю загрузку в качестве {emoji} {format_type}...", chat_id, call.message.message_id
+        )
+    except Exception:
+        pass
+
+    # Получить URL из кеша
+    with url_cache_lock:
+        cache_entry = url_cache.get(user_id)
+        url = cache_entry['url'] if cache_entry else None
+        video_key = cache_entry['key'] if cache_entry else None
+
+    if not url:
+        await async_bot.answer_callback_query(call.id, "❌ Ошибка: ссылка потеряна", show_alert=True)
+        return
+
+    logger.info(f"User {user_id} selected format: {format_type}")
+
+    # Файл уже загружался в Telegram - отправить по file_id
+    if await _send_cached_telegram_file(user_id, video_key, format_type, chat_id):
+        await async_bot.answer_callback_query(call.id, "✅ Файл из кеша отправлен", show_alert=False)
+        return
+
+    # Проверить кеш готовых файлов
+    cached_download = await asyncio.to_thread(db.get_completed_download_by_key_format, video_key, format_type)
+    if cached_download and cached_download["file_path"] and Path(cached_download["file_path"]).exists():
+        logger.info(f"Using cached file for {video_key} {format_type}: {cached_download['file_path']}")
+        await _send_file(user_id, cached_download, chat_id, from_cache=True)
+        await async_bot.answer_callback_query(call.id, "✅ Файл из кеша отправлен", show_alert=False)
+        return
+
+    # Добавить в БД
+    download_id = await asyncio.to_thread(
+        db.add_download, user_id, url, format_type=format_type, video_key=video_key
+    )
+
+    header = "" if youtube else "⚠️ НЕ-YOUTUBE ВИДЕО\n"
+    progress_msg = await async_bot.send_message(
+        chat_id,
+        f"{header}📥 Стартую загрузку в качестве {emoji} {format_type}...\n0%",
+        reply_markup=progress_markup(download_id)
+    )
+
+    with progress_lock:
+        progress_messages[download_id] = (chat_id, progress_msg.message_id)
+
+    await asyncio.to_thread(progress_notifier.track, download_id, user_id, chat_id, progress_msg.message_id)
+
+    await async_bot.answer_callback_query(call.id, "✅ Загрузка запущена", show_alert=False)
+
+
+# ==================== Отправка файлов ====================
+
+async def _send_media(chat_id: int, media, media_type: str, caption: str) -> types.Message:
+    """Отправить файл (открытый файл или file_id) нужным методом API."""
+    if media_type == "audio":
+        return await async_bot.send_audio(chat_id, media, caption=caption)
+    if media_type == "video":
+        return await async_bot.send_video(
+            chat_id,
+            media,
+            caption=caption,
+            supports_streaming=True,
+            width=1280,
+            height=720
+        )
+    return await async_bot.send_document(chat_id, media, caption=caption)
+
+
+async def _delete_video_info_message(user_id: int, chat_id: int):
+    """Удалить сообщение с информацией о видео и кнопками."""
+    with video_info_lock:
+        message_id = video_info_messages.pop(user_id, None)
+    if message_id is None:
+        return
+    try:
+        await async_bot.delete_message(chat_id, message_id)
+    except Exception as e:
+        logger.debug(f"Could not delete video info message: {e}")
+
+
+async def _send_cached_telegram_file(user_id: int, video_key: str, format_type: str, chat_id: int) -> bool:
+    """Отправить ранее загруженный в Telegram файл по file_id (см. bot._send_cached_telegram_file)."""
+    cached = await asyncio.to_thread(db.get_telegram_file, video_key, format_type)
+    if not cached:
+        return False
+
+    try:
+        await _send_media(chat_id, cached["file_id"], cached["media_type"], _media_caption(cached["media_type"], from_cache=True))
+    except Exception as e:
+        logger.warning(f"Cached file_id for {video_key} {format_type} is not valid: {e}")
+        await asyncio.to_thread(db.delete_telegram_file, video_key, format_type)
+        return False
+
+    await _delete_video_info_message(user_id, chat_id)
+    logger.info(f"Sent cached file_id for {video_key} {format_type}")
+    return True
+
+
+async def _send_file(user_id: int, download: dict, chat_id: int, from_cache: bool = False):
+    """Отправить файл загрузки новым сообщением (или ссылку, если он больше лимита)."""
+    file_path = download.get("file_path")
+    file_size = download.get("file_size_bytes", 0)
+
+    if not file_path or not Path(file_path).exists() or not file_size:
+        logger.error(f"File not found or empty: {file_path}")
+        return None
+
+    await _delete_video_info_message(user_id, chat_id)
+
+    if file_size > MAX_FILE_SIZE_MB * 1024 * 1024:
+        await async_bot.send_message(chat_id, _too_large_text(download["download_id"], file_path, file_size))
+        return None
+
+    media_type = _media_type_for(file_path)
+    with storage_manager.in_use(file_path), open(file_path, "rb") as f:
+        sent_msg = await _send_media(chat_id, f, media_type, _media_caption(media_type, from_cache=from_cache))
+    await asyncio.to_thread(_remember_file_id, download["video_key"], download["format"], sent_msg, file_size)
+    return sent_msg
+
+
+async def send_completed_download(user_id: int, download: dict):
+    """Отправить завершенную загрузку (вызывается из ProgressNotifier через event loop)."""
+    try:
+        await send_locks.run((download["video_key"], download["format"]), _deliver_download, user_id, download)
+    except Exception as e:
+        logger.error(f"Error sending download {download['download_id']}: {e}")
+
+
+async def _deliver_download(user_id: int, download: dict):
+    """Статус 'sending' стоит только на время загрузки файла (см. bot._upload_completed_download)."""
+    download_id = download["download_id"]
+    file_path = download.get("file_path")
+    file_size = download.get("file_size_bytes", 0)
+
+    with progress_lock:
+        progress_entry = progress_messages.get(download_id)
+    if not progress_entry:
+        return
+    chat_id, message_id = progress_entry
+
+    # Файл уже отправлен другому подписчику - переслать по file_id
+    if not await _send_cached_telegram_file(user_id, download["video_key"], download["format"], chat_id):
+        if not file_path or not Path(file_path).exists() or not file_size:
+            logger.error(f"File not found or empty: {file_path}")
+            try:
+                await async_bot.edit_message_text("❌ Ошибка: файл пустой", chat_id, message_id)
+            except Exception:
+                pass
+            await asyncio.to_thread(db.update_download_status, download_id, "failed",
+                                    error_message="File not found or empty")
+            return
+
+        if file_size > MAX_FILE_SIZE_MB * 1024 * 1024:
+            await _delete_video_info_message(user_id, chat_id)
+            try:
+                await async_bot.edit_message_text(_too_large_text(download_id, file_path, file_size), chat_id, message_id)
+            except Exception:
+                pass
+            await asyncio.to_thread(db.update_download_status, download_id, "completed")
+            logger.info(f"Sent download link for {file_path}")
+            return
+
+        try:
+            await async_bot.edit_message_text("📤 Отправляю файл...", chat_id, message_id)
+            await asyncio.to_thread(db.update_download_status, download_id, "sending")
+            await _send_file(user_id, download, chat_id)
+        except Exception as e:
+            logger.error(f"Error sending file: {e}")
+            await asyncio.to_thread(db.update_download_status, download_id, "failed", error_message=str(e))
+            try:
+                await async_bot.edit_message_text(f"❌ Ошибка при отправке файла\n\n⚠️ {str(e)[:100]}", chat_id, message_id)
+            except Exception:
+                pass
+            return
+
+        # Удалить файл после отправки (дальше отправляется по file_id)
+        if await asyncio.to_thread(storage_manager.delete, file_path):
+            logger.info(f"Deleted file after sending: {file_path}")
+
+    # Удалить сообщение о прогрессе
+    try:
+        await async_bot.delete_message(chat_id, message_id)
+    except Exception:
+        pass
+
+    await asyncio.to_thread(db.update_download_status, download_id, "completed", file_size_bytes=file_size)
+
+
+# ==================== Точка входа ====================
+
+async def _main():
+    loop = asyncio.get_running_loop()
+
+    # Готовые загрузки отправляются корутинами в этом event loop
+    def on_completed(user_id: int, download: dict):
+        asyncio.run_coroutine_threadsafe(send_completed_download(user_id, download), loop)
+
+    progress_notifier.on_completed = on_completed
+
+    # Отказы update_pool (обновления, переданные синхронному боту) отвечаются
+    # асинхронным клиентом: синхронный вызов API из event loop остановил бы
+    # все корутины как раз при перегрузке
+    def on_reject(update: types.Update):
+        asyncio.run_coroutine_threadsafe(_reject_update(update), loop)
+
+    update_pool.on_reject = on_reject
+    start_services()
+
+    try:
+        if BOT_UPDATE_MODE == "webhook":
+            await _run_webhook(loop)
+        else:
+            logger.info("Bot polling started (asyncio)")
+            await async_bot.remove_webhook()
+            await async_bot.infinity_polling(timeout=30)
+    finally:
+        stop_services()
+        await async_bot.close_session()
+
+
+async def _run_webhook(loop: asyncio.AbstractEventLoop):
+    """Принимать обновления через webhook и обрабатывать их в event loop."""
+    in_flight = set()
+
+    def dispatch(update: types.Update) -> bool:
+        # Не больше HANDLER_QUEUE_SIZE необработанных обновлений, лишние отбрасываются
+        # с ответом "бот занят", как в update_pool синхронного бота
+        if len(in_flight) >= HANDLER_QUEUE_SIZE:
+            logger.warning(f"Too many updates in flight, rejecting update {update.update_id}")
+            asyncio.run_coroutine_threadsafe(_reject_update(update), loop)
+            return True
+        future = asyncio.run_coroutine_threadsafe(async_bot.process_new_updates([update]), loop)
+        in_flight.add(future)
+        future.add_done_callback(in_flight.discard)
+        return True
+
+    secret_token = webhook_secret_token()
+    server = WebhookServer(WEBHOOK_LISTEN_HOST, WEBHOOK_LISTEN_PORT, WEBHOOK_PATH, secret_token, dispatch)
+    server.start()
+    try:
+        await async_bot.set_webhook(
+            url=WEBHOOK_PUBLIC_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret_token,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=["message", "callback_query"],
+        )
+        logger.info(f"Webhook set to {WEBHOOK_PUBLIC_URL.rstrip('/')}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
+
+
+def run_async_bot():
+    """Запустить бота в асинхронном режиме."""
+    logger.info("Starting KusokMedi bot (asyncio runtime)...")
+    try:
+        asyncio.run(_main())
+    except KeyboardInterrupt:
+        logger.info("Bot interrupted")
+    logger.info("Bot stopped")
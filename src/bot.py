@@ -4,12 +4,13 @@
 """
 
 import logging
+import secrets
 import time
 from pathlib import Path
 from datetime import datetime, timedelta
-from threading import Thread, Lock
+from threading import Lock
 import telebot
-from telebot import types
+from telebot import types, apihelper
 
 from config import (
     TELEGRAM_TOKEN,
@@ -18,22 +19,43 @@ from config import (
     OWNER_USERNAME,
     STORAGE_DIR,
     MAX_FILE_SIZE_MB,
+    MAX_STORAGE_MB,
+    HTTP_SERVER_TIMEOUT,
     PRIORITY_DAYS,
     MESSAGES,
-    PROGRESS_UPDATE_INTERVAL,
+    VIDEO_INFO_CACHE_PERSIST,
+    BOT_UPDATE_MODE,
+    WEBHOOK_PUBLIC_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_LISTEN_HOST,
+    WEBHOOK_LISTEN_PORT,
+    WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_MAX_CONNECTIONS,
+    HANDLER_WORKERS,
+    HANDLER_QUEUE_SIZE,
+    HANDLER_PER_USER_CONCURRENCY,
+    HANDLER_PER_USER_QUEUE,
+    BUSY_NOTICE_INTERVAL,
+    TELEGRAM_API_URL,
 )
 from db import db
 from utils import (
     is_youtube_url,
+    ytdl_info_pool,
+    video_info_cache,
+    KeyedLock,
+    canonical_video_key,
+    canonical_video_url,
     get_video_info,
     format_duration,
     format_file_size,
     format_speed,
-    format_eta,
-    get_storage_size_mb,
 )
-from queue_worker import start_queue_worker, stop_queue_worker
-from http_server import init_http_server, get_download_url
+from queue_worker import queue_worker, start_queue_worker, stop_queue_worker
+from storage import storage_manager, start_storage_manager, stop_storage_manager
+from progress_notifier import ProgressNotifier, progress_markup, CANCEL_DOWNLOAD_PREFIX
+from http_server import init_http_server, get_download_url, WebhookServer
+from update_dispatcher import UpdateWorkerPool, update_user_id
 
 # Настройка логирования
 logging.basicConfig(
@@ -47,9 +69,63 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Инициализация бота
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL
 
-# Кеш для ссылок (user_id -> {'url': url, 'timestamp': time.time()})
+
+class PooledTeleBot(telebot.TeleBot):
+    """TeleBot, который передает обновления в update_pool вместо своего пула потоков.
+    Обработчики выполняются синхронно в потоках пула (threaded=False).
+    """
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            # Смещение getUpdates двигается сразу, а не в потоке пула: иначе при
+            # polling те же обновления (и отклоненные пулом) приходят снова
+            self.last_update_id = max(self.last_update_id, update.update_id)
+            update_pool.submit(update)
+
+    def process_updates_inline(self, updates):
+        """Обработать обновления в текущем потоке."""
+        super().process_new_updates(updates)
+
+
+bot = PooledTeleBot(TELEGRAM_TOKEN, threaded=False)
+
+# Когда пользователю последний раз отвечали "бот занят" (user_id -> time.time())
+busy_notices = {}
+busy_notices_lock = Lock()
+
+
+def busy_notice_due(user_id: int) -> bool:
+    """Можно ли снова ответить пользователю "бот занят" (не чаще BUSY_NOTICE_INTERVAL)."""
+    now = time.time()
+    with busy_notices_lock:
+        if now - busy_notices.get(user_id, 0) < BUSY_NOTICE_INTERVAL:
+            return False
+        busy_notices[user_id] = now
+        return True
+
+
+def reject_update(update: types.Update):
+    """Ответить на отброшенное обновление, что бот занят."""
+    if update.callback_query is not None:
+        # На callback нужно ответить всегда, иначе у кнопки крутятся часы
+        bot.answer_callback_query(update.callback_query.id, MESSAGES["busy"], show_alert=False)
+    elif update.message is not None and busy_notice_due(update_user_id(update)):
+        bot.send_message(update.message.chat.id, MESSAGES["busy"])
+
+
+update_pool = UpdateWorkerPool(
+    bot.process_updates_inline,
+    HANDLER_WORKERS,
+    HANDLER_QUEUE_SIZE,
+    per_user_limit=HANDLER_PER_USER_CONCURRENCY,
+    per_user_queue=HANDLER_PER_USER_QUEUE,
+    on_reject=reject_update,
+)
+
+# Кеш для ссылок (user_id -> {'url': url, 'key': canonical_video_key, 'timestamp': time.time()})
 url_cache = {}
 url_cache_lock = Lock()
 
@@ -61,9 +137,16 @@ video_info_lock = Lock()
 progress_messages = {}  # download_id -> (chat_id, message_id)
 progress_lock = Lock()
 
+FORMAT_EMOJI = {
+    "4K": "📺", "2K": "🖥️", "1080p": "🎬", "720p": "🎥",
+    "480p": "📹", "360p": "🎞️", "240p": "📱", "144p": "📟", "mp3": "🎵"
+}
+
 def cleanup_caches():
     """Очистить старые записи из кешей."""
     current_time = time.time()
+    video_info_cache.purge_expired()
+
     # Очистить url_cache старше 1 часа
     with url_cache_lock:
         to_remove = []
@@ -74,6 +157,11 @@ def cleanup_caches():
         for user_id in to_remove:
             del url_cache[user_id]
 
+    # Очистить отметки "бот занят"
+    with busy_notices_lock:
+        for user_id in [uid for uid, ts in busy_notices.items() if current_time - ts > BUSY_NOTICE_INTERVAL]:
+            del busy_notices[user_id]
+
     # Очистить video_info_messages старше 30 минут
     with video_info_lock:
         to_remove = []
@@ -135,7 +223,7 @@ def handle_status(message: types.Message):
     user_id = message.from_user.id
     
     active = db.get_user_active_downloads(user_id)
-    pending = db.get_all_pending_downloads()
+    pending_count = db.count_pending_downloads()
     active_count = db.count_active_downloads()
     
     user = db.get_user(user_id)
@@ -144,11 +232,11 @@ def handle_status(message: types.Message):
     status_text = f"""
 📊 Статус очереди:
 - Активных загрузок: {active_count}
-- В очереди: {len(pending)}
+- В очереди: {pending_count}
 - Твои загрузки: {len(active)}
 - Твой приоритет: {'✅ Активен' if has_priority else '❌ Нет'}
 
-💾 Хранилище: {get_storage_size_mb(STORAGE_DIR):.1f} MB
+💾 Хранилище: {storage_manager.size_mb():.1f} MB
 """
     
     bot.send_message(message.chat.id, status_text)
@@ -162,14 +250,18 @@ def handle_admin(message: types.Message):
         return
     
     pending = db.get_pending_priority_purchases()
+    cache_stats = video_info_cache.stats()
+    pool_stats = update_pool.stats()
     
     admin_panel = f"""
 👑 АДМИН ПАНЕЛЬ
     
 📊 СТАТИСТИКА:
 - Активных загрузок: {db.count_active_downloads()}
-- В очереди: {len(db.get_all_pending_downloads())}
-- Хранилище: {get_storage_size_mb(STORAGE_DIR):.1f} MB
+- В очереди: {db.count_pending_downloads()}
+- Хранилище: {storage_manager.size_mb():.1f} / {MAX_STORAGE_MB} MB, вытеснено файлов: {storage_manager.evicted_files}
+- Кеш метаданных: {cache_stats['entries']} записей, попаданий {cache_stats['hit_rate']:.0%}
+- Обработчики: в очереди {pool_stats['queued']}, выполняется {pool_stats['running']}, отклонено {pool_stats['rejected']}
     
 💳 ПЛАТЕЖИ:
 - Ожидают подтверждения: {len(pending)}
@@ -244,8 +336,7 @@ def handle_admin_cleanup(call: types.CallbackQuery):
         bot.answer_callback_query(call.id, "❌ Нет доступа", show_alert=True)
         return
     
-    from utils import cleanup_old_files
-    cleanup_old_files(STORAGE_DIR, max_age_hours=72)
+    storage_manager.remove_older_than(72 * 3600)
     
     bot.answer_callback_query(call.id, "✅ Файлы очищены", show_alert=True)
     logger.info("Admin performed cleanup")
@@ -455,9 +546,13 @@ def handle_video_link(message: types.Message):
     if not url.startswith("http"):
         return
 
-    # Сохранить URL
+    # Сохранить URL вместе с каноническим ключом видео (youtu.be/X и watch?v=X - одно видео)
     with url_cache_lock:
-        url_cache[user_id] = {'url': url, 'timestamp': time.time()}
+        url_cache[user_id] = {
+            'url': canonical_video_url(url),
+            'key': canonical_video_key(url),
+            'timestamp': time.time(),
+        }
 
     db.add_or_update_user(user_id, message.from_user.username, message.from_user.first_name)
 
@@ -469,13 +564,112 @@ def handle_video_link(message: types.Message):
         handle_non_youtube_link(message)
 
 
+YOUTUBE_MENU_TEXT = """
+🎬 ВИДЕО
+
+📝 Название: {title}
+⏱️ Длительность: {duration}
+📦 Примерный размер: ~{size}
+
+👇 Выбери качество:
+"""
+
+NON_YOUTUBE_MENU_TEXT = """
+    ⚠️ ВНИМАНИЕ: Это видео НЕ из YouTube!
+    
+    🎬 ВИДЕО
+    📝 Название: {title}
+    ⏱️ Длительность: {duration}
+    📦 Примерный размер: ~{size}
+    
+    🚨 ВОЗМОЖНЫЕ ПРОБЛЕМЫ:
+    • Скачивание может не работать
+    • Качество может быть хуже
+    • Файл может быть поврежден
+    • Сервис может блокировать загрузку
+    
+    ❓ Продолжить скачивание?
+    """
+
+
+def video_info_error(video_info: dict) -> str:
+    """Текст ошибки, если по video_info нельзя показать меню, иначе пустая строка."""
+    if not video_info:
+        return MESSAGES["video_not_found"]
+    if video_info.get("duration", 0) > 120 * 60:
+        return MESSAGES["video_too_long"]
+    return ""
+
+
+def build_video_menu(video_info: dict, user_id: int, youtube: bool = True):
+    """Текст и кнопки выбора качества. Возвращает (text, markup).
+    Для не-YouTube ссылок - с предупреждением и кнопками confirm_download_.
+    """
+    title = video_info['title']
+    if len(title) > 100:
+        title = title[:97] + "..."
+
+    # Получить доступные форматы
+    available_formats = video_info.get('available_formats', [])
+
+    # Сформировать текст с размером лучшего качества
+    template = YOUTUBE_MENU_TEXT if youtube else NON_YOUTUBE_MENU_TEXT
+    text = template.format(
+        title=title,
+        duration=format_duration(video_info.get("duration", 0)),
+        size=format_file_size(video_info.get('filesize', 0)),
+    )
+
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    prefix = "download" if youtube else "confirm_download"
+    max_formats = 6 if youtube else 4  # Для не-YouTube меньше форматов
+
+    # Динамически создать кнопки для доступных форматов
+    quality_buttons = []
+    for fmt in available_formats[:max_formats]:
+        label = fmt["label"]
+        emoji = FORMAT_EMOJI.get(label, "📹")
+        size_text = format_file_size(fmt["filesize"]) if fmt["filesize"] > 0 else ""
+        button_text = f"{emoji} {label}"
+        if size_text:
+            button_text += f" (~{size_text})"
+        quality_buttons.append(
+            types.InlineKeyboardButton(button_text, callback_data=f"{prefix}_{label}_{user_id}")
+        )
+
+    # Добавить кнопки парами
+    for i in range(0, len(quality_buttons), 2):
+        if i + 1 < len(quality_buttons):
+            markup.add(quality_buttons[i], quality_buttons[i + 1])
+        else:
+            markup.add(quality_buttons[i])
+
+    # Добавить аудио и кнопки управления
+    markup.add(types.InlineKeyboardButton("🎵 Аудио MP3", callback_data=f"{prefix}_mp3_{user_id}"))
+    if not youtube:
+        markup.add(types.InlineKeyboardButton("✅ Продолжить", callback_data=f"proceed_anyway_{user_id}"))
+    markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data=f"cancel_{user_id}"))
+    return text, markup
+
+
 def handle_youtube_link(message: types.Message):
     """Обработка ссылки на YouTube."""
+    _handle_link(message, youtube=True)
+
+
+def handle_non_youtube_link(message: types.Message):
+    """Обработка ссылки не из YouTube с предупреждением."""
+    _handle_link(message, youtube=False)
+
+
+def _handle_link(message: types.Message, youtube: bool):
+    """Получить информацию о видео и показать меню выбора качества."""
     user_id = message.from_user.id
 
     # Получить URL из кеша
     with url_cache_lock:
-        url = url_cache.get(user_id)
+        cache_entry = url_cache.get(user_id)
+        url = cache_entry['url'] if cache_entry else None
 
     if not url:
         bot.send_message(message.chat.id, MESSAGES["invalid_link"])
@@ -486,73 +680,12 @@ def handle_youtube_link(message: types.Message):
     try:
         video_info = get_video_info(url)
 
-        if not video_info:
-            bot.edit_message_text(
-                MESSAGES["video_not_found"],
-                message.chat.id,
-                wait_msg.message_id
-            )
-            return
-
-        duration = video_info.get("duration", 0)
-        if duration > 120 * 60:
-            bot.edit_message_text(
-                MESSAGES["video_too_long"],
-                message.chat.id,
-                wait_msg.message_id
-            )
+        error_text = video_info_error(video_info)
+        if error_text:
+            bot.edit_message_text(error_text, message.chat.id, wait_msg.message_id)
             return
 
-        title = video_info['title']
-        if len(title) > 100:
-            title = title[:97] + "..."
-
-        # Получить доступные форматы
-        available_formats = video_info.get('available_formats', [])
-
-        # Сформировать текст с размером лучшего качества
-        best_size = video_info.get('filesize', 0)
-
-        text = f"""
-🎬 ВИДЕО
-
-📝 Название: {title}
-⏱️ Длительность: {format_duration(duration)}
-📦 Примерный размер: ~{format_file_size(best_size)}
-
-👇 Выбери качество:
-"""
-
-        markup = types.InlineKeyboardMarkup(row_width=2)
-
-        # Динамически создать кнопки для доступных форматов
-        quality_buttons = []
-        emoji_map = {
-            "4K": "📺", "2K": "🖥️", "1080p": "🎬", "720p": "🎥",
-            "480p": "📹", "360p": "🎞️", "240p": "📱", "144p": "📟"
-        }
-
-        for fmt in available_formats[:6]:  # Максимум 6 форматов видео
-            label = fmt["label"]
-            emoji = emoji_map.get(label, "📹")
-            size_text = format_file_size(fmt["filesize"]) if fmt["filesize"] > 0 else ""
-            button_text = f"{emoji} {label}"
-            if size_text:
-                button_text += f" (~{size_text})"
-            quality_buttons.append(
-                types.InlineKeyboardButton(button_text, callback_data=f"download_{label}_{user_id}")
-            )
-
-        # Добавить кнопки парами
-        for i in range(0, len(quality_buttons), 2):
-            if i + 1 < len(quality_buttons):
-                markup.add(quality_buttons[i], quality_buttons[i + 1])
-            else:
-                markup.add(quality_buttons[i])
-
-        # Добавить аудио и отмену
-        markup.add(types.InlineKeyboardButton("🎵 Аудио MP3", callback_data=f"download_mp3_{user_id}"))
-        markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data=f"cancel_{user_id}"))
+        text, markup = build_video_menu(video_info, user_id, youtube)
 
         if video_info.get("thumbnail"):
             try:
@@ -575,133 +708,13 @@ def handle_youtube_link(message: types.Message):
             with video_info_lock:
                 video_info_messages[user_id] = wait_msg.message_id
 
-        logger.info(f"User {user_id} sent YouTube link: {url}")
+        logger.info(f"User {user_id} sent {'YouTube' if youtube else 'non-YouTube'} link: {url}")
 
     except Exception as e:
-        logger.error(f"Error handling YouTube link: {e}")
+        logger.error(f"Error handling video link: {e}")
         bot.edit_message_text(MESSAGES["error"].format(error=str(e)[:100]), message.chat.id, wait_msg.message_id)
 
 
-def handle_non_youtube_link(message: types.Message):
-        """Обработка ссылки не из YouTube с предупреждением."""
-        user_id = message.from_user.id
-        url = message.text.strip()
-    
-        # Получить URL из кеша
-        with url_cache_lock:
-            cache_entry = url_cache.get(user_id)
-            url = cache_entry['url'] if cache_entry else url
-    
-        wait_msg = bot.send_message(message.chat.id, "⏳ Получаю информацию о видео...")
-    
-        try:
-            video_info = get_video_info(url)
-    
-            if not video_info:
-                bot.edit_message_text(
-                    MESSAGES["video_not_found"],
-                    message.chat.id,
-                    wait_msg.message_id
-                )
-                return
-    
-            duration = video_info.get("duration", 0)
-            if duration > 120 * 60:
-                bot.edit_message_text(
-                    MESSAGES["video_too_long"],
-                    message.chat.id,
-                    wait_msg.message_id
-                )
-                return
-    
-            title = video_info['title']
-            if len(title) > 100:
-                title = title[:97] + "..."
-    
-            # Получить доступные форматы
-            available_formats = video_info.get('available_formats', [])
-    
-            # Сформировать текст с размером лучшего качества
-            best_size = video_info.get('filesize', 0)
-    
-            text = f"""
-    ⚠️ ВНИМАНИЕ: Это видео НЕ из YouTube!
-    
-    🎬 ВИДЕО
-    📝 Название: {title}
-    ⏱️ Длительность: {format_duration(duration)}
-    📦 Примерный размер: ~{format_file_size(best_size)}
-    
-    🚨 ВОЗМОЖНЫЕ ПРОБЛЕМЫ:
-    • Скачивание может не работать
-    • Качество может быть хуже
-    • Файл может быть поврежден
-    • Сервис может блокировать загрузку
-    
-    ❓ Продолжить скачивание?
-    """
-    
-            markup = types.InlineKeyboardMarkup(row_width=2)
-    
-            # Добавить кнопки для форматов (только если есть информация)
-            if available_formats:
-                quality_buttons = []
-                emoji_map = {
-                    "4K": "📺", "2K": "🖥️", "1080p": "🎬", "720p": "🎥",
-                    "480p": "📹", "360p": "🎞️", "240p": "📱", "144p": "📟"
-                }
-    
-                for fmt in available_formats[:4]:  # Максимум 4 формата для не-YouTube
-                    label = fmt["label"]
-                    emoji = emoji_map.get(label, "📹")
-                    size_text = format_file_size(fmt["filesize"]) if fmt["filesize"] > 0 else ""
-                    button_text = f"{emoji} {label}"
-                    if size_text:
-                        button_text += f" (~{size_text})"
-                    quality_buttons.append(
-                        types.InlineKeyboardButton(button_text, callback_data=f"confirm_download_{label}_{user_id}")
-                    )
-    
-                # Добавить кнопки парами
-                for i in range(0, len(quality_buttons), 2):
-                    if i + 1 < len(quality_buttons):
-                        markup.add(quality_buttons[i], quality_buttons[i + 1])
-                    else:
-                        markup.add(quality_buttons[i])
-    
-            # Добавить аудио и кнопки управления
-            markup.add(types.InlineKeyboardButton("🎵 Аудио MP3", callback_data=f"confirm_download_mp3_{user_id}"))
-            markup.add(types.InlineKeyboardButton("✅ Продолжить", callback_data=f"proceed_anyway_{user_id}"))
-            markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data=f"cancel_{user_id}"))
-    
-            if video_info.get("thumbnail"):
-                try:
-                    bot.delete_message(message.chat.id, wait_msg.message_id)
-                    sent_msg = bot.send_photo(
-                        message.chat.id,
-                        video_info["thumbnail"],
-                        caption=text,
-                        reply_markup=markup
-                    )
-                    # Сохранить message_id для удаления позже
-                    with video_info_lock:
-                        video_info_messages[user_id] = sent_msg.message_id
-                except:
-                    bot.edit_message_text(text, message.chat.id, wait_msg.message_id, reply_markup=markup)
-                    with video_info_lock:
-                        video_info_messages[user_id] = wait_msg.message_id
-            else:
-                bot.edit_message_text(text, message.chat.id, wait_msg.message_id, reply_markup=markup)
-                with video_info_lock:
-                    video_info_messages[user_id] = wait_msg.message_id
-    
-            logger.info(f"User {user_id} sent non-YouTube link: {url}")
-    
-        except Exception as e:
-            logger.error(f"Error handling non-YouTube link: {e}")
-            bot.edit_message_text(MESSAGES["error"].format(error=str(e)[:100]), message.chat.id, wait_msg.message_id)
-
-
 @bot.message_handler(func=lambda m: True, content_types=["text"])
 def handle_any_message(message: types.Message):
     """Обработка любых текстовых сообщений."""
@@ -766,11 +779,7 @@ def handle_download_callback(call: types.CallbackQuery):
         return
     
     try:
-        emoji_map = {
-            "4K": "📺", "2K": "🖥️", "1080p": "🎬", "720p": "🎥",
-            "480p": "📹", "360p": "🎞️", "240p": "📱", "144p": "📟", "mp3": "🎵"
-        }
-        emoji = emoji_map.get(format_type, "📥")
+        emoji = FORMAT_EMOJI.get(format_type, "📥")
         bot.edit_message_text(f"⏳ Подготавливаю загрузку в качестве {emoji} {format_type}...", call.message.chat.id, call.message.message_id)
     except:
         pass
@@ -779,6 +788,7 @@ def handle_download_callback(call: types.CallbackQuery):
     with url_cache_lock:
         cache_entry = url_cache.get(user_id)
         url = cache_entry['url'] if cache_entry else None
+        video_key = cache_entry['key'] if cache_entry else None
     
     if not url:
         bot.answer_callback_query(call.id, "❌ Ошибка: ссылка потеряна", show_alert=True)
@@ -786,131 +796,172 @@ def handle_download_callback(call: types.CallbackQuery):
     
     logger.info(f"User {user_id} selected format: {format_type}")
 
+    # Файл уже загружался в Telegram - отправить по file_id
+    if _send_cached_telegram_file(user_id, video_key, format_type, call.message.chat.id):
+        bot.answer_callback_query(call.id, "✅ Файл из кеша отправлен", show_alert=False)
+        return
+
     # Проверить кеш готовых файлов
-    cached_download = db.get_completed_download_by_url_format(url, format_type)
+    cached_download = db.get_completed_download_by_key_format(video_key, format_type)
     if cached_download and cached_download["file_path"] and Path(cached_download["file_path"]).exists():
         # Файл уже есть, отправить из кеша
-        logger.info(f"Using cached file for {url} {format_type}: {cached_download['file_path']}")
+        logger.info(f"Using cached file for {video_key} {format_type}: {cached_download['file_path']}")
         _send_cached_file(user_id, cached_download, call.message.chat.id)
         bot.answer_callback_query(call.id, "✅ Файл из кеша отправлен", show_alert=False)
         return
 
     # Добавить в БД
-    download_id = db.add_download(user_id, url, format_type=format_type)
+    download_id = db.add_download(user_id, url, format_type=format_type, video_key=video_key)
 
-    emoji_map = {
-        "4K": "📺", "2K": "🖥️", "1080p": "🎬", "720p": "🎥",
-        "480p": "📹", "360p": "🎞️", "240p": "📱", "144p": "📟", "mp3": "🎵"
-    }
-    emoji = emoji_map.get(format_type, "📥")
+    emoji = FORMAT_EMOJI.get(format_type, "📥")
     progress_msg = bot.send_message(
         call.message.chat.id,
-        f"📥 Стартую загрузку в качестве {emoji} {format_type}...\n0%"
+        f"📥 Стартую загрузку в качестве {emoji} {format_type}...\n0%",
+        reply_markup=progress_markup(download_id)
     )
 
     with progress_lock:
         progress_messages[download_id] = (call.message.chat.id, progress_msg.message_id)
 
-    update_thread = Thread(target=_update_progress_loop, args=(download_id, user_id), daemon=True)
-    update_thread.start()
+    progress_notifier.track(download_id, user_id, call.message.chat.id, progress_msg.message_id)
 
     bot.answer_callback_query(call.id, "✅ Загрузка запущена", show_alert=False)
 
 
-def _update_progress_loop(download_id: int, user_id: int):
-    """Цикл обновления прогресса."""
-    start_time = time.time()
-    last_update = 0
-    last_progress = -1
-    last_status = ""
-    
-    while True:
-        download = db.get_download(download_id)
-        
-        if not download:
-            break
-        
-        status = download["status"]
-        
-        if status in ["completed", "failed"]:
-            break
-        
-        progress = download["progress"] or 0
-        speed = download["speed_mbps"] or 0
-        eta = download["eta_seconds"] or 0
-        
-        elapsed = time.time() - start_time
-        
-        # Обновлять только если прошло достаточно времени ИЛИ изменился прогресс/статус
-        should_update = (
-            elapsed - last_update > PROGRESS_UPDATE_INTERVAL or
-            progress != last_progress or
-            status != last_status
-        )
-        
-        if should_update:
-            with progress_lock:
-                if download_id in progress_messages:
-                    chat_id, message_id = progress_messages[download_id]
-                    
-                    # Создать progress bar (20 символов)
-                    filled = int(progress / 5)
-                    bar = "█" * filled + "░" * (20 - filled)
-                    
-                    text = None
-                    if status == "downloading":
-                        text = f"📥 ЗАГРУЖАЮ ВИДЕО\n\n{bar} {progress}%"
-                        if speed and speed > 0:
-                            text += f"\n⚡ Скорость: {speed:.1f} MB/s"
-                        if eta and eta > 0:
-                            text += f"\n⏱️ Осталось: {format_eta(int(eta))}"
-                    elif status == "converting":
-                        text = f"⚙️ КОНВЕРТИРУЮ ВИДЕО\n\n{bar}"
-                    elif status == "sending":
-                        text = f"📤 ОТПРАВЛЯЮ ФАЙЛ\n\n{bar}"
-                    else:
-                        text = f"⏳ ОБРАБОТКА\n\n{bar} {progress}%"
-                    
-                    # Только редактировать если текст изменился
-                    if text:
-                        try:
-                            bot.edit_message_text(text, chat_id, message_id)
-                            last_progress = progress
-                            last_status = status
-                        except Exception as e:
-                            logger.debug(f"Failed to update progress: {e}")
-            
-            last_update = elapsed
-        
-        time.sleep(0.5)  # Проверять чаще
-    
-    # Завершить
-    download = db.get_download(download_id)
-    if download and download["status"] == "completed":
-        _send_completed_download(user_id, download)
-    elif download and download["status"] == "failed":
-        with progress_lock:
-            if download_id in progress_messages:
-                chat_id, message_id = progress_messages[download_id]
-                error_msg = download.get("error_message", "Неизвестная ошибка")
-
-                # Дружелюбные сообщения об ошибках
-                friendly_error = "❌ ОШИБКА ЗАГРУЗКИ\n\n"
-                if "geo_blocked" in error_msg or "geo" in error_msg.lower():
-                    friendly_error += "🌍 Видео заблокировано в вашем регионе\n\n💡 Попробуйте VPN или другое видео"
-                elif "private" in error_msg or "private" in error_msg.lower():
-                    friendly_error += "🔒 Это приватное видео\n\n💡 Автор сделал его недоступным для просмотра"
-                elif "unavailable" in error_msg or "unavailable" in error_msg.lower():
-                    friendly_error += "🚫 Видео недоступно\n\n💡 Возможно, оно было удалено или скрыто"
-                elif "timeout" in error_msg.lower():
-                    friendly_error += "⏰ Превышено время ожидания\n\n💡 Попробуйте позже или выберите меньшее качество"
-                else:
-                    friendly_error += f"⚠️ {error_msg}\n\n💡 Попробуйте еще раз или обратитесь в поддержку"
-
+def _send_failed_download(user_id: int, download: dict):
+    """Показать пользователю ошибку загрузки."""
+    download_id = download["download_id"]
+    with progress_lock:
+        if download_id in progress_messages:
+            chat_id, message_id = progress_messages.pop(download_id)
+            if download["status"] == "cancelled":
                 try:
-                    bot.edit_message_text(friendly_error, chat_id, message_id)
+                    bot.edit_message_text(MESSAGES["cancelled"], chat_id, message_id)
                 except:
                     pass
+                return
+
+            error_msg = download.get("error_message") or "Неизвестная ошибка"
+
+            # Дружелюбные сообщения об ошибках
+            friendly_error = "❌ ОШИБКА ЗАГРУЗКИ\n\n"
+            if "geo_blocked" in error_msg or "geo" in error_msg.lower():
+                friendly_error += "🌍 Видео заблокировано в вашем регионе\n\n💡 Попробуйте VPN или другое видео"
+            elif "private" in error_msg or "private" in error_msg.lower():
+                friendly_error += "🔒 Это приватное видео\n\n💡 Автор сделал его недоступным для просмотра"
+            elif "unavailable" in error_msg or "unavailable" in error_msg.lower():
+                friendly_error += "🚫 Видео недоступно\n\n💡 Возможно, оно было удалено или скрыто"
+            elif "timeout" in error_msg.lower():
+                friendly_error += "⏰ Превышено время ожидания\n\n💡 Попробуйте позже или выберите меньшее качество"
+            else:
+                friendly_error += f"⚠️ {error_msg}\n\n💡 Попробуйте еще раз или обратитесь в поддержку"
+
+            try:
+                bot.edit_message_text(friendly_error, chat_id, message_id)
+            except:
+                pass
+
+
+VIDEO_EXTENSIONS = [".mp4", ".webm", ".mkv", ".avi", ".mov"]
+
+MEDIA_CAPTIONS = {
+    "audio": "🎵 Вот твое аудио!",
+    "video": "🎬 Вот твое видео!",
+    "document": "🎬 Вот твой файл!",
+}
+
+
+def _too_large_text(download_id: int, file_path: str, file_size: int) -> str:
+    """Сообщение со ссылкой на скачивание для файла больше лимита Telegram."""
+    url = get_download_url(download_id, Path(file_path))
+    filename = Path(file_path).name
+    return f"""📦 ФАЙЛ СЛИШКОМ БОЛЬШОЙ
+
+📊 Размер: {format_file_size(file_size)} ({file_size / (1024*1024):.1f} MB)
+⚠️ Лимит Telegram: {MAX_FILE_SIZE_MB} MB
+
+📥 СКАЧАТЬ ПО ССЫЛКЕ:
+{url}
+
+⏱️ Ссылка действует {HTTP_SERVER_TIMEOUT // 60} мин
+📝 Имя файла: {filename}"""
+
+
+def _media_type_for(file_path: str) -> str:
+    """Определить способ отправки файла по расширению."""
+    file_extension = Path(file_path).suffix.lower()
+    if file_extension == ".mp3":
+        return "audio"
+    if file_extension in VIDEO_EXTENSIONS:
+        return "video"
+    return "document"
+
+
+def _media_caption(media_type: str, from_cache: bool = False) -> str:
+    """Подпись к отправленному файлу."""
+    title = "✅ ГОТОВО! (из кеша)" if from_cache else "✅ ГОТОВО!"
+    return f"{title}\n\n{MEDIA_CAPTIONS[media_type]}\n\n💬 Хочешь еще? Отправь новую ссылку!"
+
+
+def _send_media(chat_id: int, media, media_type: str, caption: str) -> types.Message:
+    """Отправить файл (открытый файл или file_id) нужным методом API."""
+    if media_type == "audio":
+        # Отправить как аудио
+        return bot.send_audio(chat_id, media, caption=caption)
+    if media_type == "video":
+        # Отправить как видео с поддержкой стриминга
+        return bot.send_video(
+            chat_id,
+            media,
+            caption=caption,
+            supports_streaming=True,
+            width=1280,
+            height=720
+        )
+    # Отправить как документ (для других расширений)
+    return bot.send_document(chat_id, media, caption=caption)
+
+
+def _remember_file_id(video_key: str, format_type: str, message: types.Message, file_size: int = None):
+    """Сохранить file_id из ответа Telegram для мгновенной повторной отправки."""
+    for media_type in ("video", "audio", "document"):
+        media = getattr(message, media_type, None)
+        if media is not None:
+            db.save_telegram_file(video_key, format_type, media.file_id, media_type, file_size)
+            logger.info(f"Stored file_id for {video_key} {format_type} ({media_type})")
+            return
+
+
+def _delete_video_info_message(user_id: int, chat_id: int):
+    """Удалить сообщение с информацией о видео и кнопками."""
+    with video_info_lock:
+        if user_id in video_info_messages:
+            try:
+                bot.delete_message(chat_id, video_info_messages[user_id])
+                logger.info(f"Deleted video info message for user {user_id}")
+            except Exception as e:
+                logger.debug(f"Could not delete video info message: {e}")
+            del video_info_messages[user_id]
+
+
+def _send_cached_telegram_file(user_id: int, video_key: str, format_type: str, chat_id: int) -> bool:
+    """Отправить ранее загруженный в Telegram файл по file_id.
+    Возвращает False, если file_id нет или он больше не действителен.
+    """
+    cached = db.get_telegram_file(video_key, format_type)
+    if not cached:
+        return False
+
+    try:
+        _send_media(chat_id, cached["file_id"], cached["media_type"], _media_caption(cached["media_type"], from_cache=True))
+    except Exception as e:
+        logger.warning(f"Cached file_id for {video_key} {format_type} is not valid: {e}")
+        db.delete_telegram_file(video_key, format_type)
+        return False
+
+    _delete_video_info_message(user_id, chat_id)
+    logger.info(f"Sent cached file_id for {video_key} {format_type}")
+    return True
 
 
 def _send_cached_file(user_id: int, download: dict, chat_id: int):
@@ -928,175 +979,139 @@ def _send_cached_file(user_id: int, download: dict, chat_id: int):
         return
 
     # Удалить сообщение с информацией о видео и кнопками
-    with video_info_lock:
-        if user_id in video_info_messages:
-            try:
-                bot.delete_message(chat_id, video_info_messages[user_id])
-                logger.info(f"Deleted video info message for user {user_id}")
-            except Exception as e:
-                logger.debug(f"Could not delete video info message: {e}")
-            del video_info_messages[user_id]
+    _delete_video_info_message(user_id, chat_id)
 
     if file_size > MAX_FILE_SIZE_MB * 1024 * 1024:
-        url = get_download_url(Path(file_path))
-        filename = Path(file_path).name
-        text = f"""📦 ФАЙЛ СЛИШКОМ БОЛЬШОЙ
-
-📊 Размер: {format_file_size(file_size)} ({file_size / (1024*1024):.1f} MB)
-⚠️ Лимит Telegram: {MAX_FILE_SIZE_MB} MB
-
-📥 СКАЧАТЬ ПО ССЫЛКЕ:
-{url}
-
-⏱️ Ссылка действует 1 час
-📝 Имя файла: {filename}"""
+        text = _too_large_text(download["download_id"], file_path, file_size)
         bot.send_message(chat_id, text)
         logger.info(f"Sent cached download link for {file_path}")
     else:
         try:
-            file_extension = Path(file_path).suffix.lower()
-
-            with open(file_path, "rb") as f:
-                if file_extension == ".mp3":
-                    # Отправить как аудио
-                    bot.send_audio(
-                        chat_id,
-                        f,
-                        caption="✅ ГОТОВО! (из кеша)\n\n🎵 Вот твое аудио!\n\n💬 Хочешь еще? Отправь новую ссылку!"
-                    )
-                elif file_extension in [".mp4", ".webm", ".mkv", ".avi", ".mov"]:
-                    # Отправить как видео с поддержкой стриминга
-                    bot.send_video(
-                        chat_id,
-                        f,
-                        caption="✅ ГОТОВО! (из кеша)\n\n🎬 Вот твое видео!\n\n💬 Хочешь еще? Отправь новую ссылку!",
-                        supports_streaming=True,
-                        width=1280,
-                        height=720
-                    )
-                else:
-                    # Отправить как документ (для других расширений)
-                    bot.send_document(
-                        chat_id,
-                        f,
-                        caption="✅ ГОТОВО! (из кеша)\n\n🎬 Вот твой файл!\n\n💬 Хочешь еще? Отправь новую ссылку!"
-                    )
+            media_type = _media_type_for(file_path)
+
+            with storage_manager.in_use(file_path), open(file_path, "rb") as f:
+                sent_msg = _send_media(chat_id, f, media_type, _media_caption(media_type, from_cache=True))
+            _remember_file_id(download["video_key"], download["format"], sent_msg, file_size)
 
         except Exception as e:
             logger.error(f"Error sending cached file: {e}")
             bot.send_message(chat_id, f"❌ Ошибка при отправке файла из кеша\n\n⚠️ {str(e)[:100]}")
 
 
+# Отправки одного видео в одном формате идут по очереди: первая загружает файл
+# в Telegram, остальные (подписчики той же загрузки) отправляют его по file_id
+send_locks = KeyedLock()
+
+
 def _send_completed_download(user_id: int, download: dict):
     """Отправить завершенную загрузку."""
     from db import db  # Импорт здесь чтобы избежать циклического импорта
 
+    file_size = download.get("file_size_bytes", 0)
+    download_id = download["download_id"]
+    video_key = download["video_key"]
+    format_type = download["format"]
+
+    with progress_lock:
+        progress_entry = progress_messages.get(download_id)
+
+    with send_locks((video_key, format_type)):
+        # Файл уже отправлен другому подписчику - переслать по file_id
+        if progress_entry and _send_cached_telegram_file(user_id, video_key, format_type, progress_entry[0]):
+            try:
+                bot.delete_message(*progress_entry)
+            except:
+                pass
+            db.update_download_status(download_id, "completed", file_size_bytes=file_size)
+            return
+
+        _upload_completed_download(user_id, download, progress_entry)
+
+
+def _upload_completed_download(user_id: int, download: dict, progress_entry):
+    """Загрузить файл завершенной загрузки в Telegram (или отдать ссылку).
+    Статус 'sending' стоит только на время загрузки файла: любой выход оставляет
+    загрузку завершенной или неудачной, иначе она считалась бы активной.
+    """
     file_path = download.get("file_path")
     file_size = download.get("file_size_bytes", 0)
     download_id = download["download_id"]
 
     if not file_path or not Path(file_path).exists():
         logger.error(f"File not found: {file_path}")
+        db.update_download_status(download_id, "failed", error_message="File not found")
         return
 
     # Проверить размер файла
     if file_size == 0:
         logger.error(f"Downloaded file is empty: {file_path}")
-        with progress_lock:
-            if download_id in progress_messages:
-                chat_id, message_id = progress_messages[download_id]
-                try:
-                    bot.edit_message_text("❌ Ошибка: файл пустой", chat_id, message_id)
-                except:
-                    pass
+        if progress_entry:
+            chat_id, message_id = progress_entry
+            try:
+                bot.edit_message_text("❌ Ошибка: файл пустой", chat_id, message_id)
+            except:
+                pass
+        db.update_download_status(download_id, "failed", error_message="Downloaded file is empty")
         return
 
-    # Обновить статус на "sending"
-    db.update_download_status(download_id, "sending")
+    if not progress_entry:
+        # Некому отправлять (подписчик или перезапуск бота) - файл остается в хранилище
+        db.update_download_status(download_id, "completed")
+        return
 
-    with progress_lock:
-        if download_id in progress_messages:
-            chat_id, message_id = progress_messages[download_id]
+    chat_id, message_id = progress_entry
 
-            # Удалить сообщение с информацией о видео и кнопками
-            with video_info_lock:
-                if user_id in video_info_messages:
-                    try:
-                        bot.delete_message(chat_id, video_info_messages[user_id])
-                        logger.info(f"Deleted video info message for user {user_id}")
-                    except Exception as e:
-                        logger.debug(f"Could not delete video info message: {e}")
-                    del video_info_messages[user_id]
-
-            if file_size > MAX_FILE_SIZE_MB * 1024 * 1024:
-                url = get_download_url(Path(file_path))
-                filename = Path(file_path).name
-                text = f"""📦 ФАЙЛ СЛИШКОМ БОЛЬШОЙ
+    # Удалить сообщение с информацией о видео и кнопками
+    _delete_video_info_message(user_id, chat_id)
 
-📊 Размер: {format_file_size(file_size)} ({file_size / (1024*1024):.1f} MB)
-⚠️ Лимит Telegram: {MAX_FILE_SIZE_MB} MB
+    if file_size > MAX_FILE_SIZE_MB * 1024 * 1024:
+        text = _too_large_text(download["download_id"], file_path, file_size)
+        try:
+            bot.edit_message_text(text, chat_id, message_id)
+        except:
+            pass
+        db.update_download_status(download_id, "completed")
+        logger.info(f"Sent download link for {file_path}")
+    else:
+        try:
+            bot.edit_message_text("📤 Отправляю файл...", chat_id, message_id)
+            db.update_download_status(download_id, "sending")
 
-📥 СКАЧАТЬ ПО ССЫЛКЕ:
-{url}
+            media_type = _media_type_for(file_path)
 
-⏱️ Ссылка действует 1 час
-📝 Имя файла: {filename}"""
-                try:
-                    bot.edit_message_text(text, chat_id, message_id)
-                except:
-                    pass
-                logger.info(f"Sent download link for {file_path}")
-            else:
-                try:
-                    bot.edit_message_text("📤 Отправляю файл...", chat_id, message_id)
-
-                    file_extension = Path(file_path).suffix.lower()
-
-                    with open(file_path, "rb") as f:
-                        if file_extension == ".mp3":
-                            # Отправить как аудио
-                            bot.send_audio(
-                                chat_id,
-                                f,
-                                caption="✅ ГОТОВО!\n\n🎵 Вот твое аудио!\n\n💬 Хочешь еще? Отправь новую ссылку!"
-                            )
-                        elif file_extension in [".mp4", ".webm", ".mkv", ".avi", ".mov"]:
-                            # Отправить как видео с поддержкой стриминга
-                            bot.send_video(
-                                chat_id,
-                                f,
-                                caption="✅ ГОТОВО!\n\n🎬 Вот твое видео!\n\n💬 Хочешь еще? Отправь новую ссылку!",
-                                supports_streaming=True,
-                                width=1280,
-                                height=720
-                            )
-                        else:
-                            # Отправить как документ (для других расширений)
-                            bot.send_document(
-                                chat_id,
-                                f,
-                                caption="✅ ГОТОВО!\n\n🎬 Вот твой файл!\n\n💬 Хочешь еще? Отправь новую ссылку!"
-                            )
-
-                    # Удалить сообщение о прогрессе
-                    try:
-                        bot.delete_message(chat_id, message_id)
-                    except:
-                        pass
-
-                    # Удалить файл после отправки
-                    try:
-                        Path(file_path).unlink()
-                        logger.info(f"Deleted file after sending: {file_path}")
-                    except Exception as e:
-                        logger.warning(f"Could not delete file {file_path}: {e}")
-
-                except Exception as e:
-                    logger.error(f"Error sending file: {e}")
-                    try:
-                        bot.edit_message_text(f"❌ Ошибка при отправке файла\n\n⚠️ {str(e)[:100]}", chat_id, message_id)
-                    except:
-                        pass
+            with storage_manager.in_use(file_path), open(file_path, "rb") as f:
+                sent_msg = _send_media(chat_id, f, media_type, _media_caption(media_type))
+
+            # Запомнить file_id - следующие запросы получат файл без загрузки
+            _remember_file_id(download["video_key"], download["format"], sent_msg, file_size)
+
+            # Удалить сообщение о прогрессе
+            try:
+                bot.delete_message(chat_id, message_id)
+            except:
+                pass
+
+            # Удалить файл после отправки (дальше отправляется по file_id)
+            if storage_manager.delete(file_path):
+                logger.info(f"Deleted file after sending: {file_path}")
+
+            db.update_download_status(download_id, "completed", file_size_bytes=file_size)
+
+        except Exception as e:
+            logger.error(f"Error sending file: {e}")
+            db.update_download_status(download_id, "failed", error_message=str(e))
+            try:
+                bot.edit_message_text(f"❌ Ошибка при отправке файла\n\n⚠️ {str(e)[:100]}", chat_id, message_id)
+            except:
+                pass
+
+
+# Один сервис обновляет сообщения прогресса всех загрузок
+progress_notifier = ProgressNotifier(
+    bot,
+    on_completed=_send_completed_download,
+    on_failed=_send_failed_download,
+)
 
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("confirm_download_"))
@@ -1111,18 +1126,16 @@ def handle_confirm_download_callback(call: types.CallbackQuery):
         return
 
     try:
-        emoji_map = {
-            "4K": "📺", "2K": "🖥️", "1080p": "🎬", "720p": "🎥",
-            "480p": "📹", "360p": "🎞️", "240p": "📱", "144p": "📟", "mp3": "🎵"
-        }
-        emoji = emoji_map.get(format_type, "📥")
+        emoji = FORMAT_EMOJI.get(format_type, "📥")
         bot.edit_message_text(f"⚠️ ВНИМАНИЕ: Скачивание не-YouTube видео!\n\n⏳ Подготавливаю загрузку в качестве {emoji} {format_type}...", call.message.chat.id, call.message.message_id)
     except:
         pass
 
     # Получить URL из кеша
     with url_cache_lock:
-        url = url_cache.get(user_id)
+        cache_entry = url_cache.get(user_id)
+        url = cache_entry['url'] if cache_entry else None
+        video_key = cache_entry['key'] if cache_entry else None
 
     if not url:
         bot.answer_callback_query(call.id, "❌ Ошибка: ссылка потеряна", show_alert=True)
@@ -1130,33 +1143,34 @@ def handle_confirm_download_callback(call: types.CallbackQuery):
 
     logger.info(f"User {user_id} confirmed download for non-YouTube: {format_type}")
 
+    # Файл уже загружался в Telegram - отправить по file_id
+    if _send_cached_telegram_file(user_id, video_key, format_type, call.message.chat.id):
+        bot.answer_callback_query(call.id, "✅ Файл из кеша отправлен", show_alert=False)
+        return
+
     # Проверить кеш готовых файлов
-    cached_download = db.get_completed_download_by_url_format(url, format_type)
+    cached_download = db.get_completed_download_by_key_format(video_key, format_type)
     if cached_download and cached_download["file_path"] and Path(cached_download["file_path"]).exists():
         # Файл уже есть, отправить из кеша
-        logger.info(f"Using cached file for {url} {format_type}: {cached_download['file_path']}")
+        logger.info(f"Using cached file for {video_key} {format_type}: {cached_download['file_path']}")
         _send_cached_file(user_id, cached_download, call.message.chat.id)
         bot.answer_callback_query(call.id, "✅ Файл из кеша отправлен", show_alert=False)
         return
 
     # Добавить в БД
-    download_id = db.add_download(user_id, url, format_type=format_type)
+    download_id = db.add_download(user_id, url, format_type=format_type, video_key=video_key)
 
-    emoji_map = {
-        "4K": "📺", "2K": "🖥️", "1080p": "🎬", "720p": "🎥",
-        "480p": "📹", "360p": "🎞️", "240p": "📱", "144p": "📟", "mp3": "🎵"
-    }
-    emoji = emoji_map.get(format_type, "📥")
+    emoji = FORMAT_EMOJI.get(format_type, "📥")
     progress_msg = bot.send_message(
         call.message.chat.id,
-        f"⚠️ НЕ-YOUTUBE ВИДЕО\n📥 Стартую загрузку в качестве {emoji} {format_type}...\n0%"
+        f"⚠️ НЕ-YOUTUBE ВИДЕО\n📥 Стартую загрузку в качестве {emoji} {format_type}...\n0%",
+        reply_markup=progress_markup(download_id)
     )
 
     with progress_lock:
         progress_messages[download_id] = (call.message.chat.id, progress_msg.message_id)
 
-    update_thread = Thread(target=_update_progress_loop, args=(download_id, user_id), daemon=True)
-    update_thread.start()
+    progress_notifier.track(download_id, user_id, call.message.chat.id, progress_msg.message_id)
 
     bot.answer_callback_query(call.id, "✅ Загрузка запущена", show_alert=False)
 
@@ -1172,7 +1186,8 @@ def handle_proceed_anyway_callback(call: types.CallbackQuery):
 
     # Получить URL из кеша
     with url_cache_lock:
-        url = url_cache.get(user_id)
+        cache_entry = url_cache.get(user_id)
+        url = cache_entry['url'] if cache_entry else None
 
     if not url:
         bot.answer_callback_query(call.id, "❌ Ошибка: ссылка потеряна", show_alert=True)
@@ -1203,7 +1218,27 @@ def handle_proceed_anyway_callback(call: types.CallbackQuery):
         bot.answer_callback_query(call.id, "❌ Не удалось определить формат, попробуйте выбрать качество вручную", show_alert=True)
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("cancel_"))
+@bot.callback_query_handler(func=lambda c: c.data.startswith(CANCEL_DOWNLOAD_PREFIX))
+def handle_cancel_download_callback(call: types.CallbackQuery):
+    """Отмена загрузки кнопкой под сообщением прогресса."""
+    download_id = int(call.data[len(CANCEL_DOWNLOAD_PREFIX):])
+    download = db.get_download(download_id)
+    if not download or download["user_id"] != call.from_user.id:
+        bot.answer_callback_query(call.id, "❌ Это не твоя загрузка", show_alert=True)
+        return
+
+    if queue_worker.cancel(download_id):
+        # Сообщение заменит итоговое событие "cancelled"
+        bot.answer_callback_query(call.id, "❌ Загрузка отменяется", show_alert=False)
+    elif download["status"] in ("completed", "sending", "failed", "cancelled"):
+        bot.answer_callback_query(call.id, "Загрузка уже завершена", show_alert=False)
+    else:
+        bot.answer_callback_query(
+            call.id, "⚠️ Это видео загружается и для других пользователей, отменить нельзя", show_alert=True
+        )
+
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith("cancel_") and not c.data.startswith(CANCEL_DOWNLOAD_PREFIX))
 def handle_cancel_callback(call: types.CallbackQuery):
     """Обработка отмены."""
     try:
@@ -1266,14 +1301,24 @@ def handle_reject_priority_callback(call: types.CallbackQuery):
 
 # ==================== Точка входа ====================
 
-def run_bot():
-    """Запустить бота."""
-    logger.info("Starting KusokMedi bot...")
-
+def start_services():
+    """Запустить фоновые сервисы бота (общие для всех режимов запуска)."""
     # Инициализировать HTTP-сервер
-    init_http_server(STORAGE_DIR)
+    init_http_server(STORAGE_DIR, lambda download_id: (db.get_download(download_id) or {}).get("file_path"))
 
-    # Запустить worker очереди
+    # Кеш метаданных переживает перезапуск
+    if VIDEO_INFO_CACHE_PERSIST:
+        video_info_cache.attach_store(db)
+
+    # Учет файлов хранилища и вытеснение при превышении квоты
+    start_storage_manager()
+
+    # Пул обработчиков обновлений
+    update_pool.start()
+
+    # Запустить сервис прогресса и worker очереди
+    progress_notifier.start()
+    queue_worker.add_listener(progress_notifier.on_job_event)
     start_queue_worker()
 
     # Запустить очистку кешей каждые 10 минут
@@ -1286,16 +1331,64 @@ def run_bot():
     cleanup_thread = threading.Thread(target=cleanup_task, daemon=True)
     cleanup_thread.start()
 
+    # Прогреть пул yt-dlp в фоне, чтобы первая ссылка не ждала импорта экстракторов
+    threading.Thread(target=ytdl_info_pool.warm_up, daemon=True).start()
+
+
+def stop_services():
+    """Остановить фоновые сервисы бота."""
+    update_pool.stop()
+    stop_queue_worker()
+    progress_notifier.stop()
+    stop_storage_manager()
+
+
+def webhook_secret_token() -> str:
+    """Секрет для заголовка X-Telegram-Bot-Api-Secret-Token."""
+    if WEBHOOK_SECRET_TOKEN:
+        return WEBHOOK_SECRET_TOKEN
+    logger.warning("WEBHOOK_SECRET_TOKEN is not set, using a random token for this run")
+    return secrets.token_urlsafe(32)
+
+
+def run_webhook():
+    """Получать обновления через webhook и обрабатывать их в update_pool."""
+    secret_token = webhook_secret_token()
+    server = WebhookServer(WEBHOOK_LISTEN_HOST, WEBHOOK_LISTEN_PORT, WEBHOOK_PATH, secret_token, update_pool.submit)
+    server.start()
+
+    try:
+        bot.set_webhook(
+            url=WEBHOOK_PUBLIC_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret_token,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=["message", "callback_query"],
+        )
+        logger.info(f"Webhook set to {WEBHOOK_PUBLIC_URL.rstrip('/')}{WEBHOOK_PATH}")
+        while True:
+            time.sleep(3600)
+    finally:
+        server.stop()
+
+
+def run_bot():
+    """Запустить бота."""
+    logger.info("Starting KusokMedi bot...")
+    start_services()
+
     try:
-        logger.info("Bot polling started")
-        bot.infinity_polling(timeout=30, long_polling_timeout=30)
+        if BOT_UPDATE_MODE == "webhook":
+            run_webhook()
+        else:
+            logger.info("Bot polling started")
+            bot.remove_webhook()  # Polling не работает, пока установлен webhook
+            bot.infinity_polling(timeout=30, long_polling_timeout=30)
     except KeyboardInterrupt:
         logger.info("Bot interrupted")
     finally:
-        stop_queue_worker()
+        stop_services()
         logger.info("Bot stopped")
 
 
 if __name__ == "__main__":
     run_bot()
-
@@ -7,6 +7,29 @@ ADMIN_ID = 7563861429
 BOT_NAME = "KusokMedi Download Bot"
 OWNER_USERNAME = "@KusokMedi52"
 
+# Режим работы: "threaded" - TeleBot с пулом потоков, "async" - AsyncTeleBot (нужен aiohttp)
+BOT_RUNTIME = "threaded"
+
+# Получение обновлений: "polling" - long polling, "webhook" - Telegram сам присылает обновления
+BOT_UPDATE_MODE = "polling"
+WEBHOOK_PUBLIC_URL = ""  # Внешний адрес reverse proxy, например "https://bot.example.com"
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_LISTEN_HOST = "127.0.0.1"  # Снаружи доступен только через reverse proxy
+WEBHOOK_LISTEN_PORT = 8766
+WEBHOOK_SECRET_TOKEN = ""  # Пусто - случайный при запуске (для нескольких экземпляров задать общий)
+WEBHOOK_MAX_CONNECTIONS = 40  # Параллельных соединений от Telegram
+
+# Адрес Bot API (None - api.telegram.org). Для локальной проверки - fake_telegram.py:
+# "http://127.0.0.1:8081/bot{0}/{1}"
+TELEGRAM_API_URL = None
+
+# Обработка обновлений (и в polling, и в webhook режиме)
+HANDLER_WORKERS = 8  # Потоков обработчиков
+HANDLER_QUEUE_SIZE = 500  # Всего обновлений в очереди, сверх - ответ "бот занят"
+HANDLER_PER_USER_CONCURRENCY = 1  # Обработчиков одного пользователя одновременно
+HANDLER_PER_USER_QUEUE = 3  # Обновлений одного пользователя в очереди
+BUSY_NOTICE_INTERVAL = 10  # Не чаще раза в N секунд отвечать пользователю "бот занят"
+
 
 # Директории
 BASE_DIR = Path(__file__).parent.parent
@@ -21,6 +44,9 @@ LOGS_DIR.mkdir(exist_ok=True)
 
 # База данных
 DB_PATH = DATA_DIR / "kusokmed.db"
+DB_JOURNAL_MODE = "WAL"  # WAL - читатели не блокируют друг друга и писателя
+DB_SYNCHRONOUS = "NORMAL"  # NORMAL безопасен в режиме WAL и не делает fsync на каждый коммит
+DB_BUSY_TIMEOUT_MS = 5000  # Сколько ждать освобождения блокировки записи
 
 # Параметры очереди и приоритета
 MAX_CONCURRENT_DOWNLOADS = 3  # Максимум одновременных загрузок
@@ -31,12 +57,18 @@ PRIORITY_QUEUE_MULTIPLIER = 2  # Приоритетные пользовател
 MAX_FILE_SIZE_MB = 50  # Лимит Telegram для отправки файлов ботом
 MAX_VIDEO_DURATION_MINUTES = 120  # Максимальная длительность видео для обработки
 MAX_STORAGE_MB = 10000  # Максимальный размер папки storage в MB
+STORAGE_LOW_WATERMARK = 0.9  # При превышении квоты освобождать место до 90% от нее
+STORAGE_CHECK_INTERVAL = 60  # Проверка квоты в фоне, сек (и сразу после новой загрузки сверх квоты)
+STORAGE_RECONCILE_INTERVAL = 3600  # Сверка учета объема с диском (полный обход), сек
 
 # HTTP-сервер для больших файлов
 HTTP_SERVER_ENABLED = False
 HTTP_SERVER_HOST = "0.0.0.0"
 HTTP_SERVER_PORT = 8765
-HTTP_SERVER_TIMEOUT = 3600  # Ссылка действует 1 час
+HTTP_SERVER_TIMEOUT = 3600  # Сколько секунд действует ссылка
+HTTP_SERVER_SOCKET_TIMEOUT = 60  # Закрыть соединение, если клиент молчит дольше
+HTTP_SERVER_PUBLIC_URL = ""  # Внешний адрес для ссылок, например "https://files.example.com" (пусто - localhost)
+HTTP_SERVER_SECRET = ""  # Ключ подписи ссылок (пусто - случайный, ссылки не переживут перезапуск)
 
 # FFmpeg - требуется для обработки видео
 # Оставь пусто если FFmpeg в PATH (установлен через choco install ffmpeg)
@@ -56,11 +88,30 @@ YTDLP_CONFIG = {
     "geo_bypass": True,  # Обход geo-блокировок
     "extract_flat": False,
     "force_generic_extractor": False,
+    # Скорость загрузки (download_video передает эти опции yt-dlp)
+    "concurrent_fragment_downloads": 4,  # Фрагментов DASH/HLS одновременно
+    "http_chunk_size": 10 * 1024 * 1024,  # Качать файл кусками по 10 MB (YouTube режет скорость длинных запросов)
+    "buffersize": 1024 * 1024,  # Начальный размер блока чтения, байт
+    "throttledratelimit": 100 * 1024,  # Скорость ниже 100 KB/s - запросить ссылки заново и продолжить
+    "parallel_streams": True,  # Видео и звук (bestvideo+bestaudio) качать одновременно
+    # Переопределение опций скорости для отдельных format_type
+    "format_tuning": {
+        "4K": {"concurrent_fragment_downloads": 8},
+        "2K": {"concurrent_fragment_downloads": 8},
+    },
 }
 
-# Кэширование метаданных видео (URL -> {info, timestamp})
-VIDEO_INFO_CACHE = {}
+# Пул экземпляров yt_dlp.YoutubeDL для получения метаданных (без subprocess на каждую ссылку)
+YTDLP_INFO_POOL_SIZE = 4
+YTDLP_INFO_SOCKET_TIMEOUT = 20  # секунд на сетевой запрос при извлечении метаданных
+YTDLP_INFO_TIMEOUT = 60  # секунд на все извлечение метаданных с момента его начала
+YTDLP_INFO_QUEUE_TIMEOUT = 30  # секунд ожидания свободного потока извлечения
+
+# Кэширование метаданных видео (ключ видео -> info), см. video_info_cache.py
 VIDEO_INFO_CACHE_TIMEOUT = 3600  # 1 час
+VIDEO_INFO_CACHE_MAX_ENTRIES = 2000
+VIDEO_INFO_CACHE_MAX_BYTES = 32 * 1024 * 1024  # 32 MB в памяти
+VIDEO_INFO_CACHE_PERSIST = True  # Дублировать кеш в SQLite, чтобы после перезапуска он был теплым
 
 # Таймауты
 DOWNLOAD_TIMEOUT_SECONDS = 1800  # 30 минут максимально на загрузку
@@ -75,6 +126,14 @@ LOG_FILE = LOGS_DIR / "bot.log"
 
 # Частота обновления прогресса (в секундах)
 PROGRESS_UPDATE_INTERVAL = 1.5
+PROGRESS_FLUSH_INTERVAL = 5.0  # Как часто прогресс из памяти сбрасывается в БД одной транзакцией
+
+# Лимиты Telegram API для правок сообщений прогресса
+# Общий лимит бота ~30 запросов/с, правки прогресса получают только часть,
+# остальное остается для отправки файлов и ответов на кнопки
+TELEGRAM_EDIT_GLOBAL_RATE = 15  # Правок в секунду на весь бот
+TELEGRAM_EDIT_CHAT_RATE = 1.0  # Правок в секунду в личном чате
+TELEGRAM_EDIT_GROUP_RATE = 20 / 60  # В группах - 20 сообщений в минуту
 
 # Сообщения (используют BOT_NAME и OWNER_USERNAME)
 MESSAGES = {
@@ -166,4 +225,6 @@ https://www.youtube.com/watch?v=...""",
     "cancelled": """❌ Загрузка отменена
     
 📹 Готов к следующему видео!""",
+    
+    "busy": "⏳ Бот сейчас загружен, попробуй еще раз через несколько секунд",
 }
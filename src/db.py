@@ -5,24 +5,281 @@ Database wrapper for SQLite
 
 import sqlite3
 import json
+import heapq
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional, List, Dict, Tuple
+from typing import Optional, List, Dict, Tuple, Callable, Set
 import threading
+import logging
+import weakref
 
-from config import DB_PATH
+from config import DB_PATH, DB_JOURNAL_MODE, DB_SYNCHRONOUS, DB_BUSY_TIMEOUT_MS, PROGRESS_FLUSH_INTERVAL
+from utils import canonical_video_key
+
+logger = logging.getLogger(__name__)
+
+
+# Бесконечный приоритет хранится как максимальная дата, чтобы priority_until
+# оставался обычной ISO-датой и корректно сравнивался/сортировался в SQL
+INFINITE_PRIORITY_UNTIL = "9999-12-31T23:59:59"
+
+
+def _backfill_video_keys(conn: sqlite3.Connection) -> None:
+    """Заполнить downloads.video_key и перевести telegram_files на канонические ключи."""
+    rows = conn.execute("SELECT download_id, video_url FROM downloads WHERE video_key IS NULL").fetchall()
+    conn.executemany(
+        "UPDATE downloads SET video_key = ? WHERE download_id = ?",
+        [(canonical_video_key(video_url), download_id) for download_id, video_url in rows]
+    )
+    rows = conn.execute("SELECT video_key, format FROM telegram_files").fetchall()
+    conn.executemany(
+        "UPDATE OR REPLACE telegram_files SET video_key = ? WHERE video_key = ? AND format = ?",
+        [(canonical_video_key(video_key), video_key, format_type) for video_key, format_type in rows]
+    )
+
+
+# Миграции схемы: (версия, описание, шаги). Шаг - SQL-выражение или функция(conn).
+# Текущая версия хранится в PRAGMA user_version. Новые миграции добавлять только в конец списка.
+MIGRATIONS: List[Tuple[int, str, List]] = [
+    (1, "indexes for downloads and priority_purchases", [
+        # Очередь и count_active_downloads
+        "CREATE INDEX IF NOT EXISTS idx_downloads_status ON downloads (status, created_at)",
+        # get_completed_download_by_url_format: равенство по трем полям + сортировка по completed_at
+        "CREATE INDEX IF NOT EXISTS idx_downloads_url_format_status "
+        "ON downloads (video_url, format, status, completed_at)",
+        # get_user_active_downloads
+        "CREATE INDEX IF NOT EXISTS idx_downloads_user_status ON downloads (user_id, status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_priority_purchases_status ON priority_purchases (status, created_at)",
+    ]),
+    (2, "priority_until as ISO datetime instead of 'INFINITE'", [
+        f"UPDATE users SET priority_until = '{INFINITE_PRIORITY_UNTIL}' WHERE priority_until = 'INFINITE'",
+        f"UPDATE priority_purchases SET priority_until = '{INFINITE_PRIORITY_UNTIL}' WHERE priority_until = 'INFINITE'",
+        "CREATE INDEX IF NOT EXISTS idx_users_priority_until ON users (priority_until) "
+        "WHERE priority_until IS NOT NULL",
+    ]),
+    (3, "telegram_files: file_id cache for re-delivery", [
+        """
+        CREATE TABLE IF NOT EXISTS telegram_files (
+            video_key TEXT NOT NULL,
+            format TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            media_type TEXT NOT NULL,
+            file_size_bytes INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (video_key, format)
+        )
+        """,
+    ]),
+    (4, "downloads.video_key: canonical video id for cache lookups", [
+        "ALTER TABLE downloads ADD COLUMN video_key TEXT",
+        _backfill_video_keys,
+        "DROP INDEX IF EXISTS idx_downloads_url_format_status",
+        "CREATE INDEX IF NOT EXISTS idx_downloads_key_format_status "
+        "ON downloads (video_key, format, status, completed_at)",
+    ]),
+    (5, "video_info_cache: persistent metadata cache", [
+        """
+        CREATE TABLE IF NOT EXISTS video_info_cache (
+            video_key TEXT PRIMARY KEY,
+            info_json TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_video_info_cache_expires ON video_info_cache (expires_at)",
+    ]),
+    (6, "downloads.parent_download_id: subscribers of an in-flight download", [
+        "ALTER TABLE downloads ADD COLUMN parent_download_id INTEGER REFERENCES downloads (download_id)",
+        "CREATE INDEX IF NOT EXISTS idx_downloads_parent ON downloads (parent_download_id, status) "
+        "WHERE parent_download_id IS NOT NULL",
+    ]),
+]
+
+# Статусы задачи, к которой можно подписаться вместо повторной загрузки
+DEDUP_STATUSES = ("pending", "downloading", "converting")
+# Статусы выполнения: после падения или остановки процесса задача в них никем не выполняется
+STALE_RUNNING_STATUSES = ("downloading", "converting")
+
+
+def is_priority_active(priority_until: Optional[str]) -> bool:
+    """Проверить значение users.priority_until на активный приоритет."""
+    if not priority_until:
+        return False
+    try:
+        return datetime.fromisoformat(priority_until) > datetime.now()
+    except ValueError:
+        # Если не isoformat, считаем нет приоритета
+        return False
+
+
+class PendingQueue:
+    """Индекс ожидающих загрузок в памяти.
+
+    Heap упорядочен по (класс приоритета, created_at, download_id): 0 - приоритетные
+    пользователи, 1 - обычные. Удаление ленивое - запись из heap пропускается при pop,
+    если задачи уже нет в entries. Класс приоритета фиксируется при постановке в очередь.
+    """
+
+    PRIORITY = 0
+    REGULAR = 1
+
+    def __init__(self):
+        self.heap: List[Tuple[int, str, int]] = []
+        self.entries: Dict[int, Dict] = {}  # download_id -> download
+        self.lock = threading.Lock()
+
+    def push(self, download: Dict, priority_class: int) -> None:
+        """Добавить задачу в очередь. O(log n)."""
+        with self.lock:
+            download_id = download["download_id"]
+            self.entries[download_id] = download
+            heapq.heappush(self.heap, (priority_class, download["created_at"] or "", download_id))
+
+    def pop(self) -> Optional[Dict]:
+        """Извлечь следующую задачу. O(log n) амортизированно."""
+        with self.lock:
+            while self.heap:
+                _, _, download_id = heapq.heappop(self.heap)
+                download = self.entries.pop(download_id, None)
+                if download is not None:
+                    return download
+            return None
+
+    def discard(self, download_id: int) -> bool:
+        """Убрать задачу из очереди (например, если статус изменился).
+        Возвращает True, если задача была в очереди.
+        """
+        with self.lock:
+            found = self.entries.pop(download_id, None) is not None
+            # Не дать heap разрастаться из-за удаленных записей
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.heap = [item for item in self.heap if item[2] in self.entries]
+                heapq.heapify(self.heap)
+            return found
+
+    def promote(self, download_id: int, priority_class: int) -> None:
+        """Поднять класс приоритета ожидающей задачи (старая запись heap станет устаревшей)."""
+        with self.lock:
+            download = self.entries.get(download_id)
+            if download is not None:
+                heapq.heappush(self.heap, (priority_class, download["created_at"] or "", download_id))
+
+    def snapshot(self) -> List[Dict]:
+        """Все ожидающие задачи в порядке обработки."""
+        with self.lock:
+            result, seen = [], set()
+            # После promote у задачи две записи в heap: берется первая (с новым приоритетом)
+            for _, _, download_id in sorted(self.heap):
+                if download_id in self.entries and download_id not in seen:
+                    seen.add(download_id)
+                    result.append(self.entries[download_id])
+            return result
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class ProgressBuffer:
+    """Буфер прогресса загрузок.
+
+    Хранит последние (progress, speed_mbps, eta_seconds) каждой загрузки в памяти.
+    Фоновый поток раз в interval секунд отдает измененные записи во flush_callback,
+    который пишет их в БД одной транзакцией. Читатели получают значения из памяти.
+    """
+
+    def __init__(self, flush_callback: Callable[[List[Tuple]], None], interval: float = PROGRESS_FLUSH_INTERVAL):
+        self.flush_callback = flush_callback
+        self.interval = interval
+        self.latest: Dict[int, Tuple[int, Optional[float], Optional[int]]] = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def put(self, download_id: int, progress: int, speed_mbps: float = None, eta_seconds: int = None) -> None:
+        """Запомнить последний прогресс загрузки."""
+        with self.lock:
+            self.latest[download_id] = (progress, speed_mbps, eta_seconds)
+            self.dirty.add(download_id)
+            if self.thread is None:
+                self.stop_event.clear()
+                self.thread = threading.Thread(target=self._run_loop, daemon=True)
+                self.thread.start()
+
+    def get(self, download_id: int) -> Optional[Tuple[int, Optional[float], Optional[int]]]:
+        """Последний прогресс из памяти или None."""
+        with self.lock:
+            return self.latest.get(download_id)
+
+    def drop(self, download_id: int) -> None:
+        """Забыть загрузку (например, после завершения)."""
+        with self.lock:
+            self.latest.pop(download_id, None)
+            self.dirty.discard(download_id)
+
+    def flush(self) -> int:
+        """Записать накопленные изменения. Возвращает количество записей."""
+        with self.lock:
+            rows = [(*self.latest[download_id], download_id) for download_id in self.dirty]
+            self.dirty.clear()
+        if rows:
+            self.flush_callback(rows)
+        return len(rows)
+
+    def stop(self) -> None:
+        """Остановить фоновый поток и записать остаток."""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+            self.thread = None
+        self.flush()
+
+    def _run_loop(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Progress flush error: {e}")
+
+
+class _ConnectionHolder:
+    """Подключение потока в threading.local. Когда поток завершается, holder
+    удаляется вместе с его threading.local, и weakref.finalize закрывает подключение.
+    """
+
+    __slots__ = ("conn", "__weakref__")
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
 
 
 class Database:
+    """SQLite wrapper.
+
+    Каждый поток держит свое подключение (threading.local) в режиме autocommit
+    с WAL-журналом, поэтому чтения идут параллельно и без блокировки. Подключение
+    закрывается, когда поток завершается (короткие потоки HTTP-сервера и
+    asyncio.to_thread не накапливают открытые файлы).
+    self.lock сериализует только записи внутри процесса.
+    """
+
     def __init__(self, db_path: Path = DB_PATH):
         self.db_path = db_path
-        self.lock = threading.Lock()
+        self.lock = threading.Lock()  # Блокировка записи
+        self.local = threading.local()
+        self.connections: Set[sqlite3.Connection] = set()
+        self.connections_lock = threading.Lock()
+        self.download_listeners: List[Callable[[int], None]] = []
+        self.pending = PendingQueue()
+        self.running_ids: Set[int] = set()  # Взяты из очереди worker и еще выполняются
+        self.running_lock = threading.Lock()
+        self.progress_buffer = ProgressBuffer(self._write_progress_rows)
         self.init_db()
+        self.load_pending_queue()
 
     def init_db(self):
         """Инициализация базы данных со всеми таблицами."""
         with self.lock:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.get_connection()
             cursor = conn.cursor()
 
             # Таблица пользователей
@@ -74,13 +331,68 @@ class Database:
             """)
 
             conn.commit()
+
+            self.apply_migrations(conn)
+
+    def apply_migrations(self, conn: sqlite3.Connection) -> None:
+        """Применить недостающие миграции схемы по порядку."""
+        current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for version, description, statements in MIGRATIONS:
+            if version <= current_version:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logger.info(f"Applied DB migration {version}: {description}")
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Получить подключение к БД текущего потока (создается один раз на поток)."""
+        holder = getattr(self.local, "holder", None)
+        if holder is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                isolation_level=None,  # autocommit, транзакции открываются явно
+                # Подключением пользуется только свой поток, но закрыть его
+                # могут finalize или close() из другого потока
+                check_same_thread=False,
+            )
+            conn.row_factory = sqlite3.Row  # Возвращать результаты как dict-like объекты
+            conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+            conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+            conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT_MS)}")
+            holder = self.local.holder = _ConnectionHolder(conn)
+            with self.connections_lock:
+                self.connections.add(conn)
+            weakref.finalize(holder, self._release_connection, conn)
+        return holder.conn
+
+    def _release_connection(self, conn: sqlite3.Connection) -> None:
+        """Закрыть подключение завершившегося потока."""
+        with self.connections_lock:
+            self.connections.discard(conn)
+        try:
             conn.close()
+        except sqlite3.Error:
+            pass
 
-    def get_connection(self):
-        """Получить подключение к БД."""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row  # Возвращать результаты как dict-like объекты
-        return conn
+    def close(self) -> None:
+        """Закрыть все открытые подключения."""
+        self.progress_buffer.stop()
+        with self.connections_lock:
+            connections = list(self.connections)
+        for conn in connections:
+            self._release_connection(conn)
+        self.local = threading.local()
 
     # ==================== Пользователи ====================
 
@@ -97,57 +409,43 @@ class Database:
                     first_name = COALESCE(?, first_name)
             """, (user_id, username, first_name, username, first_name))
             conn.commit()
-            conn.close()
 
     def get_user(self, user_id: int) -> Optional[Dict]:
         """Получить информацию о пользователе."""
-        with self.lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            conn.close()
-            if result:
-                return {
-                    "user_id": result[0],
-                    "username": result[1],
-                    "first_name": result[2],
-                    "joined_at": result[3],
-                    "priority_until": result[4],
-                    "total_downloads": result[5],
-                    "total_bytes_downloaded": result[6],
-                }
-            return None
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        result = cursor.fetchone()
+        if result:
+            return {
+                "user_id": result[0],
+                "username": result[1],
+                "first_name": result[2],
+                "joined_at": result[3],
+                "priority_until": result[4],
+                "total_downloads": result[5],
+                "total_bytes_downloaded": result[6],
+            }
+        return None
 
     def has_priority(self, user_id: int) -> bool:
         """Проверить, есть ли активный приоритет у пользователя."""
-        with self.lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT priority_until FROM users WHERE user_id = ?",
-                (user_id,)
-            )
-            result = cursor.fetchone()
-            conn.close()
-            if result and result[0]:
-                # INFINITE - всегда есть приоритет
-                if result[0] == "INFINITE":
-                    return True
-                try:
-                    return datetime.fromisoformat(result[0]) > datetime.now()
-                except ValueError:
-                    # Если не isoformat, считаем нет приоритета
-                    return False
-            return False
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT priority_until FROM users WHERE user_id = ?",
+            (user_id,)
+        )
+        result = cursor.fetchone()
+        return bool(result) and is_priority_active(result[0])
 
     def set_priority(self, user_id: int, days: int) -> None:
         """Установить приоритет на пользователя на N дней.
-        Если days < 0 то приоритет бесконечный (INFINITE).
+        Если days < 0 то приоритет бесконечный (INFINITE_PRIORITY_UNTIL).
         """
         if days < 0:
             # Бесконечный приоритет
-            priority_until = "INFINITE"
+            priority_until = INFINITE_PRIORITY_UNTIL
         else:
             priority_until = (datetime.now() + timedelta(days=days)).isoformat()
         
@@ -159,7 +457,6 @@ class Database:
                 (priority_until, user_id)
             )
             conn.commit()
-            conn.close()
 
     def admin_give_priority(self, user_id: int, days: int) -> bool:
         """Админ выдает приоритет на N дней. Возвращает True если успешно."""
@@ -182,7 +479,6 @@ class Database:
                     (user_id,)
                 )
                 conn.commit()
-                conn.close()
             return True
         except Exception as e:
             print(f"Error removing priority: {e}")
@@ -190,230 +486,491 @@ class Database:
 
     def get_priority_duration(self, user_id: int) -> Optional[str]:
         """Получить, сколько дней осталось приоритета."""
-        with self.lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT priority_until FROM users WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            conn.close()
-            if result and result[0]:
-                # Спецсимвол INFINITE для бесконечного приоритета
-                if result[0] == "INFINITE":
-                    return "∞ Бесконечный"
-
-                try:
-                    priority_until = datetime.fromisoformat(result[0])
-                    remaining = priority_until - datetime.now()
-                    if remaining.total_seconds() > 0:
-                        days = remaining.days
-                        hours = remaining.seconds // 3600
-                        return f"{days}д {hours}ч"
-                    return "0д"
-                except ValueError:
-                    return None
-            return None
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT priority_until FROM users WHERE user_id = ?", (user_id,))
+        result = cursor.fetchone()
+        if result and result[0]:
+            # Максимальная дата - бесконечный приоритет
+            if result[0] == INFINITE_PRIORITY_UNTIL:
+                return "∞ Бесконечный"
+
+            try:
+                priority_until = datetime.fromisoformat(result[0])
+                remaining = priority_until - datetime.now()
+                if remaining.total_seconds() > 0:
+                    days = remaining.days
+                    hours = remaining.seconds // 3600
+                    return f"{days}д {hours}ч"
+                return "0д"
+            except ValueError:
+                return None
+        return None
 
     def get_users_with_priority(self) -> List[Dict]:
         """Получить всех пользователей с активным приоритетом."""
-        with self.lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT user_id, username, first_name, priority_until, total_downloads
-                FROM users
-                WHERE priority_until IS NOT NULL
-                ORDER BY 
-                    CASE WHEN priority_until = 'INFINITE' THEN 0 ELSE 1 END,
-                    priority_until DESC
-            """)
-            results = cursor.fetchall()
-            conn.close()
-            
-            users_list = []
-            for r in results:
-                priority_display = "∞ Бесконечный" if r[3] == "INFINITE" else r[3]
-                users_list.append({
-                    "user_id": r[0],
-                    "username": r[1],
-                    "first_name": r[2],
-                    "priority_until": priority_display,
-                    "total_downloads": r[4],
-                })
-            return users_list
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT user_id, username, first_name, priority_until, total_downloads
+            FROM users
+            WHERE priority_until IS NOT NULL
+            ORDER BY priority_until DESC
+        """)
+        results = cursor.fetchall()
+        
+        users_list = []
+        for r in results:
+            priority_display = "∞ Бесконечный" if r[3] == INFINITE_PRIORITY_UNTIL else r[3]
+            users_list.append({
+                "user_id": r[0],
+                "username": r[1],
+                "first_name": r[2],
+                "priority_until": priority_display,
+                "total_downloads": r[4],
+            })
+        return users_list
 
     # ==================== Загрузки ====================
 
-    def add_download(self, user_id: int, video_url: str, video_title: str = None, format_type: str = None) -> int:
-        """Добавить новую задачу загрузки. Возвращает download_id."""
+    def add_download_listener(self, callback: Callable[[int], None]) -> None:
+        """Подписаться на новые задачи. callback(download_id) вызывается после вставки."""
+        if callback not in self.download_listeners:
+            self.download_listeners.append(callback)
+
+    def remove_download_listener(self, callback: Callable[[int], None]) -> None:
+        """Отписаться от уведомлений о новых задачах."""
+        if callback in self.download_listeners:
+            self.download_listeners.remove(callback)
+
+    def load_pending_queue(self) -> None:
+        """Загрузить ожидающие задачи из БД в индекс очереди (при старте).
+        Задачи, оставшиеся в downloading/converting после падения или остановки
+        бота, возвращаются в очередь: иначе их никто не выполнит, а подписчики
+        будут ждать вечно.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        with self.lock:
+            cursor.execute(f"""
+                UPDATE downloads SET status = 'pending', progress = 0, speed_mbps = NULL, eta_seconds = NULL
+                WHERE status IN ({", ".join("?" * len(STALE_RUNNING_STATUSES))})
+            """, STALE_RUNNING_STATUSES)
+            if cursor.rowcount:
+                logger.info(f"Requeued {cursor.rowcount} interrupted downloads")
+            conn.commit()
+        cursor.execute("""
+            SELECT d.*, u.priority_until FROM downloads d
+            LEFT JOIN users u ON d.user_id = u.user_id
+            WHERE d.status = 'pending'
+        """)
+        results = cursor.fetchall()
+
+        self.pending = PendingQueue()
+        for r in results:
+            priority_class = PendingQueue.PRIORITY if is_priority_active(r["priority_until"]) else PendingQueue.REGULAR
+            self.pending.push(self._pending_row_to_dict(r), priority_class)
+
+    @staticmethod
+    def _pending_row_to_dict(r) -> Dict:
+        return {
+            "download_id": r[0],
+            "user_id": r[1],
+            "video_url": r[2],
+            "video_title": r[3],
+            "file_path": r[4],
+            "file_size_bytes": r[5],
+            "format": r[6],
+            "status": r[7],
+            "progress": r[8],
+            "created_at": r[11],
+            "video_key": r["video_key"],
+        }
+
+    def add_download(self, user_id: int, video_url: str, video_title: str = None,
+                     format_type: str = None, video_key: str = None) -> int:
+        """Добавить новую задачу загрузки. Возвращает download_id.
+
+        Если то же видео в том же формате уже ждет в очереди или выполняется worker,
+        новая задача не попадает в очередь: она получает статус 'subscribed' и
+        parent_download_id и завершится вместе с исходной (resolve_subscribers).
+        """
+        video_key = video_key or canonical_video_key(video_url)
+        priority_class = PendingQueue.PRIORITY if self.has_priority(user_id) else PendingQueue.REGULAR
+        # Тот же формат, что и CURRENT_TIMESTAMP в SQLite
+        created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
         with self.lock:
             conn = self.get_connection()
             cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT download_id, status FROM downloads
+                WHERE video_key = ? AND format = ? AND parent_download_id IS NULL
+                  AND status IN ({", ".join("?" * len(DEDUP_STATUSES))})
+                ORDER BY download_id
+            """, (video_key, format_type, *DEDUP_STATUSES))
+            # Только задачи, которые действительно кто-то выполнит: статус в БД мог
+            # остаться от прерванной загрузки
+            parent = next((row for row in cursor.fetchall() if self.is_download_live(row["download_id"])), None)
+
+            parent_download_id = parent["download_id"] if parent else None
+            status = "subscribed" if parent else "pending"
             cursor.execute("""
-                INSERT INTO downloads (user_id, video_url, video_title, format, status)
-                VALUES (?, ?, ?, ?, 'pending')
-            """, (user_id, video_url, video_title, format_type))
+                INSERT INTO downloads (user_id, video_url, video_title, format, status, created_at, video_key,
+                                       parent_download_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, video_url, video_title, format_type, status, created_at, video_key, parent_download_id))
             conn.commit()
             download_id = cursor.lastrowid
-            conn.close()
+
+        if parent:
+            # Приоритетный подписчик ускоряет общую задачу
+            if parent["status"] == "pending" and priority_class == PendingQueue.PRIORITY:
+                self.pending.promote(parent_download_id, priority_class)
             return download_id
 
+        self.pending.push({
+            "download_id": download_id,
+            "user_id": user_id,
+            "video_url": video_url,
+            "video_title": video_title,
+            "file_path": None,
+            "file_size_bytes": None,
+            "format": format_type,
+            "status": "pending",
+            "progress": 0,
+            "created_at": created_at,
+            "video_key": video_key,
+        }, priority_class)
+
+        # Уведомить подписчиков (queue worker) вне блокировки
+        for callback in list(self.download_listeners):
+            try:
+                callback(download_id)
+            except Exception as e:
+                logger.error(f"Download listener error: {e}")
+        return download_id
+
     def get_download(self, download_id: int) -> Optional[Dict]:
         """Получить информацию о загрузке."""
-        with self.lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM downloads WHERE download_id = ?", (download_id,))
-            result = cursor.fetchone()
-            conn.close()
-            if result:
-                return {
-                    "download_id": result[0],
-                    "user_id": result[1],
-                    "video_url": result[2],
-                    "video_title": result[3],
-                    "file_path": result[4],
-                    "file_size_bytes": result[5],
-                    "format": result[6],
-                    "status": result[7],
-                    "progress": result[8],
-                    "speed_mbps": result[9],
-                    "eta_seconds": result[10],
-                    "created_at": result[11],
-                    "completed_at": result[12],
-                    "error_message": result[13],
-                }
-            return None
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM downloads WHERE download_id = ?", (download_id,))
+        result = cursor.fetchone()
+        if result:
+            download = {
+                "download_id": result[0],
+                "user_id": result[1],
+                "video_url": result[2],
+                "video_title": result[3],
+                "file_path": result[4],
+                "file_size_bytes": result[5],
+                "format": result[6],
+                "status": result[7],
+                "progress": result[8],
+                "speed_mbps": result[9],
+                "eta_seconds": result[10],
+                "created_at": result[11],
+                "completed_at": result[12],
+                "error_message": result[13],
+                "video_key": result["video_key"],
+                "parent_download_id": result["parent_download_id"],
+            }
+            return self._apply_buffered_progress(download)
+        return None
+
+    def _apply_buffered_progress(self, download: Dict) -> Dict:
+        """Подставить свежий прогресс из памяти вместо записанного в БД."""
+        buffered = self.progress_buffer.get(download["download_id"])
+        if buffered:
+            download["progress"], download["speed_mbps"], download["eta_seconds"] = buffered
+        return download
 
     def update_download_progress(self, download_id: int, progress: int, speed_mbps: float = None, eta_seconds: int = None) -> None:
-        """Обновить прогресс загрузки."""
+        """Обновить прогресс загрузки (в памяти, в БД попадает пачкой через ProgressBuffer)."""
+        self.progress_buffer.put(download_id, progress, speed_mbps, eta_seconds)
+
+    def flush_progress(self) -> int:
+        """Немедленно записать накопленный прогресс в БД."""
+        return self.progress_buffer.flush()
+
+    def _write_progress_rows(self, rows: List[Tuple]) -> None:
+        """Записать пачку (progress, speed_mbps, eta_seconds, download_id) одной транзакцией."""
         with self.lock:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("""
-                UPDATE downloads
-                SET progress = ?, speed_mbps = ?, eta_seconds = ?
-                WHERE download_id = ?
-            """, (progress, speed_mbps, eta_seconds, download_id))
-            conn.commit()
-            conn.close()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("""
+                    UPDATE downloads
+                    SET progress = ?, speed_mbps = ?, eta_seconds = ?
+                    WHERE download_id = ?
+                """, rows)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
 
     def update_download_status(self, download_id: int, status: str, file_path: str = None, 
                               file_size_bytes: int = None, error_message: str = None) -> None:
-        """Обновить статус загрузки."""
+        """Обновить статус загрузки.
+        file_path, file_size_bytes и error_message меняются, только если переданы.
+        """
+        fields = {"status": status, "completed_at": datetime.now().isoformat() if status == "completed" else None}
+        for column, value in (("file_path", file_path), ("file_size_bytes", file_size_bytes),
+                              ("error_message", error_message)):
+            if value is not None:
+                fields[column] = value
         with self.lock:
             conn = self.get_connection()
             cursor = conn.cursor()
-            completed_at = datetime.now().isoformat() if status == "completed" else None
-            cursor.execute("""
+            cursor.execute(f"""
                 UPDATE downloads
-                SET status = ?, file_path = ?, file_size_bytes = ?, error_message = ?, completed_at = ?
+                SET {", ".join(f"{column} = ?" for column in fields)}
                 WHERE download_id = ?
-            """, (status, file_path, file_size_bytes, error_message, completed_at, download_id))
+            """, (*fields.values(), download_id))
             conn.commit()
-            conn.close()
 
-    def get_user_active_downloads(self, user_id: int) -> List[Dict]:
-        """Получить активные загрузки пользователя."""
+        if status not in ("downloading", "converting", "sending"):
+            self.progress_buffer.drop(download_id)
+
+        # Синхронизировать индекс очереди
+        if status == "pending":
+            download = self.get_download(download_id)
+            if download:
+                priority_class = PendingQueue.PRIORITY if self.has_priority(download["user_id"]) else PendingQueue.REGULAR
+                self.pending.push(download, priority_class)
+        else:
+            self.pending.discard(download_id)
+
+    def resolve_subscribers(self, parent_download_id: int, status: str, file_path: str = None,
+                            file_size_bytes: int = None, error_message: str = None) -> List[int]:
+        """Перевести подписчиков завершенной задачи в ее итоговый статус.
+        Возвращает download_id подписчиков.
+        """
         with self.lock:
             conn = self.get_connection()
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT * FROM downloads
-                WHERE user_id = ? AND status IN ('pending', 'downloading', 'converting', 'sending')
-                ORDER BY created_at
-            """, (user_id,))
-            results = cursor.fetchall()
-            conn.close()
-            return [
-                {
-                    "download_id": r[0],
-                    "user_id": r[1],
-                    "video_url": r[2],
-                    "video_title": r[3],
-                    "file_path": r[4],
-                    "file_size_bytes": r[5],
-                    "format": r[6],
-                    "status": r[7],
-                    "progress": r[8],
-                }
-                for r in results
-            ]
+                SELECT download_id FROM downloads
+                WHERE parent_download_id = ? AND status = 'subscribed'
+            """, (parent_download_id,))
+            subscriber_ids = [row[0] for row in cursor.fetchall()]
+            if subscriber_ids:
+                completed_at = datetime.now().isoformat() if status == "completed" else None
+                cursor.execute("""
+                    UPDATE downloads
+                    SET status = ?, file_path = ?, file_size_bytes = ?, error_message = ?, completed_at = ?
+                    WHERE parent_download_id = ? AND status = 'subscribed'
+                """, (status, file_path, file_size_bytes, error_message, completed_at, parent_download_id))
+                conn.commit()
+        return subscriber_ids
+
+    def get_subscriber_ids(self, parent_download_id: int) -> List[int]:
+        """download_id загрузок, ожидающих результата parent_download_id."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT download_id FROM downloads
+            WHERE parent_download_id = ? AND status = 'subscribed'
+        """, (parent_download_id,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def get_user_active_downloads(self, user_id: int) -> List[Dict]:
+        """Получить активные загрузки пользователя."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT * FROM downloads
+            WHERE user_id = ? AND status IN ('pending', 'subscribed', 'downloading', 'converting', 'sending')
+            ORDER BY created_at
+        """, (user_id,))
+        results = cursor.fetchall()
+        downloads = []
+        for r in results:
+            buffered = self.progress_buffer.get(r[0])
+            downloads.append({
+                "download_id": r[0],
+                "user_id": r[1],
+                "video_url": r[2],
+                "video_title": r[3],
+                "file_path": r[4],
+                "file_size_bytes": r[5],
+                "format": r[6],
+                "status": r[7],
+                "progress": buffered[0] if buffered else r[8],
+            })
+        return downloads
 
     def get_all_pending_downloads(self) -> List[Dict]:
         """Получить все ожидающие загрузки, отсортированные по приоритету."""
+        return self.pending.snapshot()
+
+    def pop_pending_download(self) -> Optional[Dict]:
+        """Извлечь следующую загрузку из очереди (приоритетные первыми). O(log n).
+        Загрузка считается выполняющейся до release_download.
+        """
+        with self.running_lock:
+            download = self.pending.pop()
+            if download is not None:
+                self.running_ids.add(download["download_id"])
+        return download
+
+    def discard_pending_download(self, download_id: int) -> bool:
+        """Убрать загрузку из очереди. False - ее там нет (например, worker уже взял ее)."""
+        with self.running_lock:
+            return self.pending.discard(download_id)
+
+    def release_download(self, download_id: int) -> None:
+        """Worker закончил (или не стал выполнять) загрузку, взятую pop_pending_download."""
+        with self.running_lock:
+            self.running_ids.discard(download_id)
+
+    def is_download_live(self, download_id: int) -> bool:
+        """Загрузка ждет в очереди или выполняется worker (к ней можно подписаться)."""
+        with self.running_lock:
+            return download_id in self.pending.entries or download_id in self.running_ids
+
+    def count_pending_downloads(self) -> int:
+        """Количество ожидающих загрузок. O(1)."""
+        return len(self.pending)
+
+    def count_active_downloads(self) -> int:
+        """Подсчитать активные загрузки (downloading, converting, sending)."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COUNT(*) FROM downloads
+            WHERE status IN ('downloading', 'converting', 'sending')
+        """)
+        count = cursor.fetchone()[0]
+        return count
+
+    def get_completed_download_by_key_format(self, video_key: str, format_type: str) -> Optional[Dict]:
+        """Найти завершенную загрузку по каноническому ключу видео и формату."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT * FROM downloads
+            WHERE video_key = ? AND format = ? AND status = 'completed' AND file_path IS NOT NULL
+            ORDER BY completed_at DESC
+            LIMIT 1
+        """, (video_key, format_type))
+        result = cursor.fetchone()
+        if result:
+            return {
+                "download_id": result[0],
+                "user_id": result[1],
+                "video_url": result[2],
+                "video_title": result[3],
+                "file_path": result[4],
+                "file_size_bytes": result[5],
+                "format": result[6],
+                "status": result[7],
+                "progress": result[8],
+                "speed_mbps": result[9],
+                "eta_seconds": result[10],
+                "created_at": result[11],
+                "completed_at": result[12],
+                "error_message": result[13],
+                "video_key": result["video_key"],
+            }
+        return None
+
+    # ==================== Кеш file_id Telegram ====================
+
+    def get_telegram_file(self, video_key: str, format_type: str) -> Optional[Dict]:
+        """Найти file_id ранее отправленного файла по ключу видео и формату."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT video_key, format, file_id, media_type, file_size_bytes, created_at
+            FROM telegram_files
+            WHERE video_key = ? AND format = ?
+        """, (video_key, format_type))
+        result = cursor.fetchone()
+        if result:
+            return {
+                "video_key": result[0],
+                "format": result[1],
+                "file_id": result[2],
+                "media_type": result[3],
+                "file_size_bytes": result[4],
+                "created_at": result[5],
+            }
+        return None
+
+    def save_telegram_file(self, video_key: str, format_type: str, file_id: str,
+                           media_type: str, file_size_bytes: int = None) -> None:
+        """Сохранить file_id отправленного файла для повторной отправки."""
         with self.lock:
             conn = self.get_connection()
             cursor = conn.cursor()
-            # Приоритетные пользователи сортируются первыми
             cursor.execute("""
-                SELECT d.* FROM downloads d
-                JOIN users u ON d.user_id = u.user_id
-                WHERE d.status = 'pending'
-                ORDER BY
-                    CASE WHEN u.priority_until = 'INFINITE' OR (u.priority_until IS NOT NULL AND u.priority_until > datetime('now')) THEN 0 ELSE 1 END,
-                    d.created_at
-            """)
-            results = cursor.fetchall()
-            conn.close()
-            return [
-                {
-                    "download_id": r[0],
-                    "user_id": r[1],
-                    "video_url": r[2],
-                    "video_title": r[3],
-                    "file_path": r[4],
-                    "file_size_bytes": r[5],
-                    "format": r[6],
-                    "status": r[7],
-                    "progress": r[8],
-                }
-                for r in results
-            ]
+                INSERT INTO telegram_files (video_key, format, file_id, media_type, file_size_bytes)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(video_key, format) DO UPDATE SET
+                    file_id = excluded.file_id,
+                    media_type = excluded.media_type,
+                    file_size_bytes = excluded.file_size_bytes,
+                    created_at = CURRENT_TIMESTAMP
+            """, (video_key, format_type, file_id, media_type, file_size_bytes))
+            conn.commit()
 
-    def count_active_downloads(self) -> int:
-        """Подсчитать активные загрузки (downloading, converting, sending)."""
+    def delete_telegram_file(self, video_key: str, format_type: str) -> None:
+        """Удалить недействительный file_id."""
         with self.lock:
             conn = self.get_connection()
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT COUNT(*) FROM downloads
-                WHERE status IN ('downloading', 'converting', 'sending')
-            """)
-            count = cursor.fetchone()[0]
-            conn.close()
-            return count
+            cursor.execute(
+                "DELETE FROM telegram_files WHERE video_key = ? AND format = ?",
+                (video_key, format_type)
+            )
+            conn.commit()
 
-    def get_completed_download_by_url_format(self, video_url: str, format_type: str) -> Optional[Dict]:
-        """Найти завершенную загрузку по URL и формату."""
+    # ==================== Кеш метаданных видео ====================
+
+    def load_video_info(self, video_key: str) -> Optional[Tuple[str, float]]:
+        """Прочитать сохраненные метаданные видео: (info_json, expires_at)."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT info_json, expires_at FROM video_info_cache WHERE video_key = ?",
+            (video_key,)
+        )
+        result = cursor.fetchone()
+        if result:
+            return result[0], result[1]
+        return None
+
+    def save_video_info(self, video_key: str, info_json: str, expires_at: float) -> None:
+        """Сохранить метаданные видео (expires_at - unix time)."""
         with self.lock:
             conn = self.get_connection()
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT * FROM downloads
-                WHERE video_url = ? AND format = ? AND status = 'completed' AND file_path IS NOT NULL
-                ORDER BY completed_at DESC
-                LIMIT 1
-            """, (video_url, format_type))
-            result = cursor.fetchone()
-            conn.close()
-            if result:
-                return {
-                    "download_id": result[0],
-                    "user_id": result[1],
-                    "video_url": result[2],
-                    "video_title": result[3],
-                    "file_path": result[4],
-                    "file_size_bytes": result[5],
-                    "format": result[6],
-                    "status": result[7],
-                    "progress": result[8],
-                    "speed_mbps": result[9],
-                    "eta_seconds": result[10],
-                    "created_at": result[11],
-                    "completed_at": result[12],
-                    "error_message": result[13],
-                }
-            return None
+                INSERT INTO video_info_cache (video_key, info_json, expires_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(video_key) DO UPDATE SET
+                    info_json = excluded.info_json,
+                    expires_at = excluded.expires_at
+            """, (video_key, info_json, expires_at))
+            conn.commit()
+
+    def delete_video_info(self, video_key: str) -> None:
+        """Удалить метаданные видео."""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM video_info_cache WHERE video_key = ?", (video_key,))
+            conn.commit()
+
+    def purge_video_info(self, now: float) -> int:
+        """Удалить просроченные метаданные. Возвращает количество удаленных."""
+        with self.lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM video_info_cache WHERE expires_at <= ?", (now,))
+            conn.commit()
+            return cursor.rowcount
 
     # ==================== Приоритетные покупки ====================
 
@@ -428,53 +985,48 @@ class Database:
             """, (user_id, amount_usd))
             conn.commit()
             purchase_id = cursor.lastrowid
-            conn.close()
             return purchase_id
 
     def get_priority_purchase(self, purchase_id: int) -> Optional[Dict]:
         """Получить информацию о покупке приоритета."""
-        with self.lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM priority_purchases WHERE purchase_id = ?", (purchase_id,))
-            result = cursor.fetchone()
-            conn.close()
-            if result:
-                return {
-                    "purchase_id": result[0],
-                    "user_id": result[1],
-                    "amount_usd": result[2],
-                    "status": result[3],
-                    "confirmed_at": result[4],
-                    "priority_until": result[5],
-                    "created_at": result[6],
-                }
-            return None
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM priority_purchases WHERE purchase_id = ?", (purchase_id,))
+        result = cursor.fetchone()
+        if result:
+            return {
+                "purchase_id": result[0],
+                "user_id": result[1],
+                "amount_usd": result[2],
+                "status": result[3],
+                "confirmed_at": result[4],
+                "priority_until": result[5],
+                "created_at": result[6],
+            }
+        return None
 
     def get_pending_priority_purchases(self) -> List[Dict]:
         """Получить все ожидающие покупки приоритета для админа."""
-        with self.lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT * FROM priority_purchases
-                WHERE status = 'pending'
-                ORDER BY created_at
-            """)
-            results = cursor.fetchall()
-            conn.close()
-            return [
-                {
-                    "purchase_id": r[0],
-                    "user_id": r[1],
-                    "amount_usd": r[2],
-                    "status": r[3],
-                    "confirmed_at": r[4],
-                    "priority_until": r[5],
-                    "created_at": r[6],
-                }
-                for r in results
-            ]
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT * FROM priority_purchases
+            WHERE status = 'pending'
+            ORDER BY created_at
+        """)
+        results = cursor.fetchall()
+        return [
+            {
+                "purchase_id": r[0],
+                "user_id": r[1],
+                "amount_usd": r[2],
+                "status": r[3],
+                "confirmed_at": r[4],
+                "priority_until": r[5],
+                "created_at": r[6],
+            }
+            for r in results
+        ]
 
     def confirm_priority_purchase(self, purchase_id: int, priority_days: int) -> None:
         """Подтвердить покупку приоритета и активировать его."""
@@ -482,27 +1034,30 @@ class Database:
         with self.lock:
             conn = self.get_connection()
             cursor = conn.cursor()
-            
-            # Получить user_id из покупки
-            cursor.execute("SELECT user_id FROM priority_purchases WHERE purchase_id = ?", (purchase_id,))
-            user_id = cursor.fetchone()[0]
-            
-            # Обновить статус покупки
-            cursor.execute("""
-                UPDATE priority_purchases
-                SET status = 'confirmed', confirmed_at = ?, priority_until = ?
-                WHERE purchase_id = ?
-            """, (datetime.now().isoformat(), priority_until, purchase_id))
-            
-            # Обновить приоритет пользователя
-            cursor.execute("""
-                UPDATE users
-                SET priority_until = ?
-                WHERE user_id = ?
-            """, (priority_until, user_id))
-            
-            conn.commit()
-            conn.close()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # Получить user_id из покупки
+                cursor.execute("SELECT user_id FROM priority_purchases WHERE purchase_id = ?", (purchase_id,))
+                user_id = cursor.fetchone()[0]
+                
+                # Обновить статус покупки
+                cursor.execute("""
+                    UPDATE priority_purchases
+                    SET status = 'confirmed', confirmed_at = ?, priority_until = ?
+                    WHERE purchase_id = ?
+                """, (datetime.now().isoformat(), priority_until, purchase_id))
+                
+                # Обновить приоритет пользователя
+                cursor.execute("""
+                    UPDATE users
+                    SET priority_until = ?
+                    WHERE user_id = ?
+                """, (priority_until, user_id))
+                
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
 
     def reject_priority_purchase(self, purchase_id: int) -> None:
         """Отклонить покупку приоритета."""
@@ -515,7 +1070,6 @@ class Database:
                 WHERE purchase_id = ?
             """, (purchase_id,))
             conn.commit()
-            conn.close()
 
 
 # Глобальный экземпляр БД
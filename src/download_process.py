@@ -0,0 +1,125 @@
+"""
+Выполнение загрузки в отдельном процессе
+yt-dlp и ffmpeg работают в дочернем процессе, который можно принудительно
+завершить по таймауту этапа или по отмене пользователем. Слот очереди
+освобождается сразу, зависший экстрактор не занимает его навсегда
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from config import DOWNLOAD_TIMEOUT_SECONDS, CONVERSION_TIMEOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.5  # Как часто проверять отмену и таймаут, сек
+STOP_GRACE_SECONDS = 5  # Сколько ждать завершения после terminate, потом kill
+
+# spawn одинаково работает на Windows и Linux и не копирует в процесс
+# потоки и соединения с БД родителя
+_context = multiprocessing.get_context("spawn")
+
+
+class DownloadCancelled(Exception):
+    """Загрузка отменена (пользователем или при остановке worker)."""
+
+
+def _job_main(conn, url: str, output_path: str, format_type: str):
+    """Точка входа дочернего процесса: загрузка с передачей прогресса через conn."""
+    if hasattr(os, "setsid"):
+        # Своя группа процессов: при остановке завершается и запущенный yt-dlp ffmpeg
+        os.setsid()
+
+    from utils import download_video
+
+    def progress_callback(stage, pct, speed, eta, downloaded, total, step=None):
+        conn.send(("progress", (stage, pct, speed, eta, downloaded, total), step))
+
+    try:
+        result = download_video(url, Path(output_path), format_type=format_type,
+                                progress_callback=progress_callback)
+    except Exception as e:
+        result = (False, None, {"error": str(e)})
+    conn.send(("result", result, None))
+    conn.close()
+
+
+def run_download(url: str, output_path: Path, format_type: str, progress_callback=None,
+                 cancel_event: Optional[threading.Event] = None,
+                 download_timeout: float = DOWNLOAD_TIMEOUT_SECONDS,
+                 conversion_timeout: float = CONVERSION_TIMEOUT_SECONDS) -> Tuple[bool, Optional[str], Dict]:
+    """
+    Выполнить download_video в отдельном процессе и дождаться результата.
+    На загрузку дается download_timeout секунд, на постобработку (с первого
+    события "converting") - conversion_timeout.
+    Отмена через cancel_event - DownloadCancelled, превышение времени - subprocess.TimeoutExpired.
+    В обоих случаях процесс завершается принудительно.
+    Возвращает: (success, file_path, metadata), как download_video.
+    """
+    receiver, sender = _context.Pipe(duplex=False)
+    process = _context.Process(
+        target=_job_main,
+        args=(sender, url, str(output_path), format_type),
+        name=f"download-{Path(output_path).name}",
+        daemon=True,
+    )
+    process.start()
+    sender.close()  # Иначе recv не получит EOF, если процесс упадет
+
+    stage, timeout = "downloading", download_timeout
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise DownloadCancelled()
+            if time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(f"{stage} {url}", timeout)
+            if not receiver.poll(POLL_INTERVAL):
+                continue
+
+            try:
+                kind, payload, step = receiver.recv()
+            except EOFError:
+                process.join(STOP_GRACE_SECONDS)
+                return False, None, {"error": f"Download process exited with code {process.exitcode}"}
+
+            if kind == "result":
+                process.join(STOP_GRACE_SECONDS)
+                return payload
+            if payload[0] == "converting" and stage != "converting":
+                stage, timeout = "converting", conversion_timeout
+                deadline = time.monotonic() + timeout
+            if progress_callback:
+                progress_callback(*payload, step=step)
+    finally:
+        _stop_process(process)
+        receiver.close()
+
+
+def _stop_process(process):
+    """Завершить процесс загрузки (вместе с его дочерними процессами), если он еще работает."""
+    if process.is_alive():
+        _signal_process(process, getattr(signal, "SIGTERM", None), process.terminate)
+        process.join(STOP_GRACE_SECONDS)
+        if process.is_alive():
+            logger.warning(f"Process {process.name} ignored terminate, killing")
+            _signal_process(process, getattr(signal, "SIGKILL", None), process.kill)
+    process.join()
+
+
+def _signal_process(process, signum, fallback):
+    """Отправить сигнал группе процесса (POSIX) или только самому процессу."""
+    if signum is not None and hasattr(os, "killpg"):
+        try:
+            os.killpg(process.pid, signum)
+            return
+        except OSError:
+            pass  # Процесс еще не успел создать группу
+    fallback()
@@ -0,0 +1,236 @@
+"""
+Планировщик редактирования сообщений с учетом лимитов Telegram API
+Token bucket на весь бот и на каждый чат, склейка правок и обработка 429 (retry_after)
+"""
+
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple, Optional
+
+from config import TELEGRAM_EDIT_GLOBAL_RATE, TELEGRAM_EDIT_CHAT_RATE, TELEGRAM_EDIT_GROUP_RATE
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен (0 - уже есть)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def drain(self, now: float):
+        """Обнулить запас (после 429)."""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0)
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class EditScheduler:
+    """Отправляет правки сообщений не быстрее лимитов Telegram.
+
+    На каждое сообщение хранится только последний текст (промежуточные правки
+    выбрасываются), правки без изменений пропускаются. После forget сообщение
+    больше не редактируется: у каждого сообщения есть поколение, и правка,
+    взятая из очереди до forget, не отправляется. Правки прогресса расходуют
+    лишь часть общего лимита бота, поэтому отправка файлов и ответы на кнопки
+    не упираются в flood control.
+    """
+
+    def __init__(self, bot, global_rate: float = TELEGRAM_EDIT_GLOBAL_RATE,
+                 chat_rate: float = TELEGRAM_EDIT_CHAT_RATE,
+                 group_rate: float = TELEGRAM_EDIT_GROUP_RATE):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.blocked_until: Dict[int, float] = {}  # chat_id -> monotonic time (retry_after)
+        self.pending: "OrderedDict[Tuple[int, int], str]" = OrderedDict()
+        self.last_sent: Dict[Tuple[int, int], str] = {}
+        self.markups: Dict[Tuple[int, int], object] = {}  # Клавиатура, которую сохранить при правке
+        self.generations: Dict[Tuple[int, int], int] = {}  # Поколение сообщения, меняется при forget
+        self.generation_ids = itertools.count(1)
+        self.sending: Optional[Tuple[int, int]] = None  # Сообщение, правка которого сейчас отправляется
+        self.condition = threading.Condition()
+        self.is_running = False
+        self.thread = None
+
+    def start(self):
+        """Запустить поток отправки."""
+        if self.is_running:
+            return
+        self.is_running = True
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+        logger.info("Edit scheduler started")
+
+    def stop(self):
+        """Остановить поток отправки."""
+        with self.condition:
+            self.is_running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout=5)
+        logger.info("Edit scheduler stopped")
+
+    def submit(self, chat_id: int, message_id: int, text: str, reply_markup=None):
+        """Запланировать правку. Более новая правка того же сообщения заменяет старую.
+        reply_markup - клавиатура сообщения (без нее правка убирает кнопки).
+        """
+        key = (chat_id, message_id)
+        with self.condition:
+            if key not in self.generations:
+                self.generations[key] = next(self.generation_ids)
+            if reply_markup is not None:
+                self.markups[key] = reply_markup
+            else:
+                self.markups.pop(key, None)
+            if self.last_sent.get(key) == text:
+                self.pending.pop(key, None)
+                return
+            self.pending[key] = text
+            self.condition.notify()
+
+    def forget(self, chat_id: int, message_id: int):
+        """Отменить запланированные правки сообщения (оно завершено или удалено).
+        Если правка этого сообщения уже отправляется, дождаться ее, чтобы она не
+        пришла после итогового текста.
+        """
+        key = (chat_id, message_id)
+        with self.condition:
+            self.pending.pop(key, None)
+            self.last_sent.pop(key, None)
+            self.markups.pop(key, None)
+            self.generations.pop(key, None)
+            while self.sending == key:
+                self.condition.wait()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательный chat_id - группа или канал, там лимит строже
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate)
+        return bucket
+
+    def _next_edit(self, now: float) -> Tuple[Optional[Tuple[int, int]], float]:
+        """Выбрать первую правку, которую можно отправить сейчас.
+        Возвращает (ключ, 0) или (None, сколько ждать).
+        """
+        global_wait = self.global_bucket.wait_time(now)
+        if global_wait > 0:
+            return None, global_wait
+
+        min_wait = None
+        for key in self.pending:
+            chat_id = key[0]
+            wait = max(
+                self.blocked_until.get(chat_id, 0) - now,
+                self._chat_bucket(chat_id).wait_time(now),
+            )
+            if wait <= 0:
+                return key, 0.0
+            min_wait = wait if min_wait is None else min(min_wait, wait)
+        return None, min_wait if min_wait is not None else 1.0
+
+    def _cleanup(self, now: float):
+        """Убрать состояние простаивающих чатов."""
+        for chat_id in [c for c, until in self.blocked_until.items() if until <= now]:
+            del self.blocked_until[chat_id]
+        if len(self.chat_buckets) > 1000:
+            active_chats = {key[0] for key in self.pending}
+            for chat_id in [c for c, b in self.chat_buckets.items() if c not in active_chats and b.is_idle(now)]:
+                del self.chat_buckets[chat_id]
+
+    def _run_loop(self):
+        while True:
+            with self.condition:
+                while self.is_running and not self.pending:
+                    self.condition.wait()
+                if not self.is_running:
+                    break
+
+                now = time.monotonic()
+                key, wait = self._next_edit(now)
+                if key is None:
+                    self.condition.wait(wait)
+                    continue
+
+                text = self.pending.pop(key)
+                markup = self.markups.get(key)
+                generation = self.generations.get(key)
+                self.sending = key
+                self.global_bucket.consume(now)
+                self._chat_bucket(key[0]).consume(now)
+                self._cleanup(now)
+
+            try:
+                self._send(key, text, markup, generation)
+            finally:
+                with self.condition:
+                    self.sending = None
+                    self.condition.notify_all()
+
+    def _send(self, key: Tuple[int, int], text: str, reply_markup=None, generation: Optional[int] = None):
+        chat_id, message_id = key
+        with self.condition:
+            if self.generations.get(key) != generation:
+                return  # forget после того, как правку взяли из очереди
+        try:
+            self.bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup)
+            sent = True
+        except Exception as e:
+            sent = self._handle_error(key, text, e, generation)
+
+        if sent:
+            with self.condition:
+                # После forget состояние сообщения не восстанавливается
+                if self.generations.get(key) == generation:
+                    self.last_sent[key] = text
+
+    def _handle_error(self, key: Tuple[int, int], text: str, error: Exception,
+                      generation: Optional[int] = None) -> bool:
+        """Обработать ошибку API. Возвращает True, если текст уже в сообщении."""
+        description = str(getattr(error, "description", error)).lower()
+        if "message is not modified" in description:
+            return True
+
+        if getattr(error, "error_code", None) == 429:
+            result_json = getattr(error, "result_json", None) or {}
+            retry_after = (result_json.get("parameters") or {}).get("retry_after", 5)
+            now = time.monotonic()
+            with self.condition:
+                self.blocked_until[key[0]] = now + retry_after
+                self.global_bucket.drain(now)
+                # Вернуть правку, если за это время не пришла более новая и не было forget
+                if key not in self.pending and self.generations.get(key) == generation:
+                    self.pending[key] = text
+            logger.warning(f"Telegram flood control for chat {key[0]}: retry after {retry_after}s")
+            return False
+
+        logger.debug(f"Failed to edit message {key}: {error}")
+        return False
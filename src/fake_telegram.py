@@ -0,0 +1,199 @@
+"""
+Локальная имитация Telegram Bot API для проверки бота без сети
+Запуск: python src/fake_telegram.py, затем в config.py:
+TELEGRAM_API_URL = "http://127.0.0.1:8081/bot{0}/{1}", для webhook-режима еще
+BOT_UPDATE_MODE = "webhook", WEBHOOK_PUBLIC_URL = "http://127.0.0.1:8766".
+Пока webhook не установлен, обновления отдаются через getUpdates (polling)
+"""
+
+import itertools
+import json
+import logging
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlsplit, parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+FAKE_BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+# Методы, которые возвращают новое сообщение
+MESSAGE_METHODS = {"sendMessage", "sendPhoto", "sendVideo", "sendAudio", "sendDocument", "editMessageText"}
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    """Отвечает на /bot<token>/<method> как Bot API и записывает вызовы."""
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        parts = urlsplit(self.path)
+        method = parts.path.rstrip("/").rsplit("/", 1)[-1]
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        params = dict(parse_qsl(parts.query))
+        params.update(self._body_params(body, self.headers.get("Content-Type", "")))
+        result = self.server.fake.handle_call(method, params)
+
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    @staticmethod
+    def _body_params(body: bytes, content_type: str) -> Dict:
+        """Параметры из тела запроса (JSON или form-urlencoded; файлы multipart не разбираются)."""
+        try:
+            if "json" in content_type:
+                return json.loads(body or b"{}")
+            if "x-www-form-urlencoded" in content_type:
+                return dict(parse_qsl(body.decode()))
+        except ValueError:
+            pass
+        return {}
+
+    def log_message(self, format, *args):
+        logger.debug(f"fake telegram: {format % args}")
+
+
+class FakeTelegram:
+    """Сервер-имитация Bot API: хранит вызовы бота и отправляет ему обновления на webhook."""
+
+    MAX_POLL_WAIT = 1  # Сколько getUpdates ждет новых обновлений, сек
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081):
+        self.host = host
+        self.port = port
+        self.calls: List[Dict] = []  # {"method", "params"}
+        self.webhook_url: Optional[str] = None
+        self.secret_token = ""
+        self.message_ids = itertools.count(1)
+        self.update_ids = itertools.count(1)
+        self.updates: List[Dict] = []  # Обновления для getUpdates (polling)
+        self.poll_offsets: List[int] = []  # offset каждого вызова getUpdates
+        self.lock = threading.Lock()
+        self.new_update = threading.Condition(self.lock)
+        self.server = None
+
+    @property
+    def api_url(self) -> str:
+        """Значение для TELEGRAM_API_URL."""
+        return f"http://{self.host}:{self.port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), FakeTelegramHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info(f"Fake Telegram API on {self.api_url}")
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def handle_call(self, method: str, params: Dict):
+        """Записать вызов и вернуть правдоподобный результат."""
+        with self.lock:
+            self.calls.append({"method": method, "params": params})
+            if method == "setWebhook":
+                self.webhook_url = params.get("url")
+                self.secret_token = params.get("secret_token", "")
+            elif method == "deleteWebhook":
+                self.webhook_url = None
+
+        if method == "getMe":
+            return FAKE_BOT_USER
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method in MESSAGE_METHODS:
+            return {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+                "from": FAKE_BOT_USER,
+                "text": params.get("text", ""),
+            }
+        return True
+
+    def _get_updates(self, params: Dict) -> List[Dict]:
+        """getUpdates: обновления с update_id >= offset. Как в Bot API, offset
+        подтверждает все предыдущие обновления, и они больше не отдаются.
+        """
+        offset = int(params.get("offset") or 0)
+        wait = min(float(params.get("timeout") or 0), self.MAX_POLL_WAIT)
+        with self.new_update:
+            self.poll_offsets.append(offset)
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            if not self.updates and wait:
+                self.new_update.wait(wait)
+            return list(self.updates)
+
+    def send_update(self, update: Dict) -> int:
+        """Отправить обновление боту: на webhook, если он установлен, иначе
+        поставить в очередь getUpdates (polling). Возвращает HTTP-статус.
+        """
+        update = dict(update, update_id=update.get("update_id") or next(self.update_ids))
+        if not self.webhook_url:
+            with self.new_update:
+                self.updates.append(update)
+                self.new_update.notify_all()
+            return 200
+        request = urllib.request.Request(
+            self.webhook_url,
+            data=json.dumps(update).encode(),
+            headers={
+                "Content-Type": "application/json",
+                "X-Telegram-Bot-Api-Secret-Token": self.secret_token,
+            },
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def send_text(self, user_id: int, text: str) -> int:
+        """Имитировать текстовое сообщение пользователя."""
+        user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        return self.send_update({"message": {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+        }})
+
+    def methods(self) -> List[str]:
+        """Имена вызванных методов по порядку."""
+        with self.lock:
+            return [call["method"] for call in self.calls]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    fake = FakeTelegram()
+    fake.start()
+    print(f"TELEGRAM_API_URL = \"{fake.api_url}\"")
+    print("Введи user_id и текст через пробел, чтобы отправить сообщение боту")
+    print("(на webhook, если бот его установил, иначе через getUpdates)")
+    try:
+        while True:
+            line = input("> ").strip()
+            if not line:
+                continue
+            user_id, _, text = line.partition(" ")
+            status = fake.send_text(int(user_id), text)
+            print(f"HTTP {status}; вызовы бота: {fake.methods()[-5:]}")
+    except (KeyboardInterrupt, EOFError):
+        fake.stop()
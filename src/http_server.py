@@ -1,100 +1,400 @@
 """
 HTTP-сервер для раздачи больших файлов (> 50 MB)
-Простой встроенный сервер на Python
+Встроенный многопоточный сервер на Python с поддержкой докачки
 """
 
 import logging
 from pathlib import Path
-from threading import Thread
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote, unquote, urlsplit
 import os
+import hmac
+import json
+import time
+import base64
+import socket
+import hashlib
+import secrets
 import mimetypes
-from config import HTTP_SERVER_HOST, HTTP_SERVER_PORT, HTTP_SERVER_TIMEOUT
-from typing import Optional
+from config import (
+    HTTP_SERVER_HOST, HTTP_SERVER_PORT, HTTP_SERVER_TIMEOUT, HTTP_SERVER_SOCKET_TIMEOUT,
+    HTTP_SERVER_PUBLIC_URL, HTTP_SERVER_SECRET,
+)
+from typing import Optional, Callable, Dict, Tuple
+from storage import storage_manager
+
+from telebot import types
 
 logger = logging.getLogger(__name__)
 
+LINK_EXPIRY_STEP = 300  # Шаг округления срока ссылки, сек
+
+
+class FileDownloadHandler(BaseHTTPRequestHandler):
+    """Раздача файлов: GET/HEAD, докачка через Range/If-Range, ETag и отправка через sendfile.
+    Каждое соединение обслуживается в своем потоке (ThreadingHTTPServer).
+    """
+
+    protocol_version = "HTTP/1.1"  # keep-alive, без него менеджеры загрузок не докачивают
+    timeout = HTTP_SERVER_SOCKET_TIMEOUT
 
-class FileDownloadHandler(SimpleHTTPRequestHandler):
-    """Обработчик для скачивания файлов с таймаутом."""
-    
-    timeout = HTTP_SERVER_TIMEOUT
-    
     def do_GET(self):
         """Обработать GET-запрос для скачивания файла."""
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        """Заголовки без тела (размер, ETag, поддержка Range)."""
+        self._serve(send_body=False)
+
+    def _serve(self, send_body: bool):
+        headers_sent = False
         try:
-            file_path = Path(self.path.lstrip("/"))
+            link = self._resolve_link()
+            if link is None:
+                return
+            download_id, expires, file_path = link
 
-            if not file_path.exists() or not file_path.is_file():
+            try:
+                f = open(file_path, "rb")
+            except FileNotFoundError:
+                self.server.file_server.forget(download_id)
                 self.send_error(404, "File not found")
                 return
 
-            # Отправить файл
-            self.send_response(200)
-            self.send_header("Content-Type", mimetypes.guess_type(str(file_path))[0] or "application/octet-stream")
-            self.send_header("Content-Length", str(file_path.stat().st_size))
-            self.send_header("Content-Disposition", f"attachment; filename={file_path.name}")
-            self.end_headers()
+            with f:
+                stat = os.fstat(f.fileno())
+                size = stat.st_size
+                etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+                last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+                if self._not_modified(etag, stat.st_mtime):
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Last-Modified", last_modified)
+                    self.end_headers()
+                    return
 
-            # Читать и отправлять файл по кускам для больших файлов
-            with open(file_path, "rb") as f:
-                while chunk := f.read(8192):  # 8KB chunks
-                    self.wfile.write(chunk)
+                byte_range = None
+                if self._if_range_matches(etag, stat.st_mtime):
+                    byte_range = parse_range(self.headers.get("Range"), size)
+                if byte_range is False:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
 
-            logger.info(f"Sent file: {file_path.name}")
+                start, end = byte_range or (0, size - 1)
+                length = end - start + 1 if size else 0
 
+                self.send_response(206 if byte_range else 200)
+                self.send_header("Content-Type", mimetypes.guess_type(file_path.name)[0] or "application/octet-stream")
+                self.send_header("Content-Length", str(length))
+                if byte_range:
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
+                self.send_header("Content-Disposition", content_disposition(file_path.name))
+                # Ссылка неизменна до истечения срока - прокси и браузер могут ее кешировать
+                self.send_header("Cache-Control", f"public, max-age={max(int(expires - time.time()), 0)}")
+                self.end_headers()
+                headers_sent = True
+
+                if send_body and length:
+                    # socket.sendfile использует os.sendfile (без копирования в Python),
+                    # а где его нет - обычную отправку кусками
+                    with storage_manager.in_use(file_path):
+                        self.connection.sendfile(f, start, length)
+                    logger.info(f"Sent file: {file_path.name} ({start}-{end}/{size})")
+
+        except (BrokenPipeError, ConnectionResetError, socket.timeout):
+            # Клиент оборвал загрузку - докачает через Range
+            logger.debug(f"Client {self.client_address[0]} disconnected")
+            self.close_connection = True
         except Exception as e:
             logger.error(f"Error serving file: {e}")
-            self.send_error(500, "Internal server error")
-    
+            self.close_connection = True
+            if not headers_sent:
+                self.send_error(500, "Internal server error")
+
+    def _resolve_link(self) -> Optional[Tuple[int, int, Path]]:
+        """Проверить подписанную ссылку.
+        Возвращает (download_id, expires, путь к файлу) или None, если ошибка уже отправлена.
+        """
+        link = parse_file_link(unquote(urlsplit(self.path).path))
+        if link is None:
+            self.send_error(404, "File not found")
+            return None
+
+        download_id, expires, signature, name = link
+        file_server = self.server.file_server
+        if not hmac.compare_digest(signature, file_server.sign(download_id, expires, name)):
+            self.send_error(403, "Forbidden")
+            return None
+        if expires < time.time():
+            self.send_error(410, "Link expired")
+            return None
+
+        file_path = file_server.lookup(download_id)
+        if file_path is None or file_path.name != name:
+            self.send_error(404, "File not found")
+            return None
+        return download_id, expires, file_path
+
+    def _not_modified(self, etag: str, mtime: float) -> bool:
+        """Условный запрос If-None-Match / If-Modified-Since совпал с файлом."""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match:
+            return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+        return self._not_modified_since(self.headers.get("If-Modified-Since"), mtime)
+
+    def _if_range_matches(self, etag: str, mtime: float) -> bool:
+        """Range применяется, только если файл не менялся с момента первой загрузки."""
+        if_range = self.headers.get("If-Range")
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith(("\"", "W/")):
+            return if_range == etag  # Для If-Range нужно строгое сравнение
+        return self._not_modified_since(if_range, mtime)
+
+    @staticmethod
+    def _not_modified_since(value: Optional[str], mtime: float) -> bool:
+        if not value:
+            return False
+        try:
+            since = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return False
+        return since is not None and int(mtime) <= since.timestamp()
+
     def log_message(self, format, *args):
         """Переопределить логирование."""
         logger.info(f"{self.client_address[0]} - {format % args}")
 
 
+def parse_range(header: Optional[str], size: int):
+    """Разобрать заголовок Range.
+    None - заголовка нет (или несколько диапазонов - отдаем файл целиком),
+    (start, end) - включительный диапазон, False - диапазон вне файла (416).
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, sep, last = header[len("bytes="):].strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # bytes=-N - последние N байт
+            suffix = int(last)
+            if suffix <= 0:
+                return False
+            start, end = max(size - suffix, 0), size - 1
+    except ValueError:
+        return None
+    if start < 0 or start > end or start >= size:
+        return False
+    return start, min(end, size - 1)
+
+
+def parse_file_link(path: str) -> Optional[Tuple[int, int, str, str]]:
+    """Разобрать путь /d/<download_id>/<expires>/<signature>/<имя файла>."""
+    parts = path.split("/")
+    if len(parts) != 6 or parts[0] or parts[1] != "d" or not parts[5]:
+        return None
+    try:
+        return int(parts[2]), int(parts[3]), parts[4], parts[5]
+    except ValueError:
+        return None
+
+
+def content_disposition(filename: str) -> str:
+    """Content-Disposition с именем файла в том числе не из ASCII (RFC 6266)."""
+    fallback = filename.encode("ascii", "replace").decode().replace("?", "_").replace('"', "_")
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
 class HTTPFileServer:
-    """Встроенный HTTP-сервер для раздачи файлов."""
-    
-    def __init__(self, storage_dir: Path):
-        self.storage_dir = storage_dir
+    """Встроенный HTTP-сервер для раздачи файлов по подписанным ссылкам.
+
+    Ссылка /d/<download_id>/<expires>/<signature>/<имя файла> подписана HMAC и
+    действует до expires. Путь к файлу берется из индекса download_id -> путь
+    (при промахе - через resolve_path, обычно из БД), а не из URL.
+    """
+
+    def __init__(self, storage_dir: Path, resolve_path: Optional[Callable[[int], Optional[str]]] = None):
+        self.storage_dir = storage_dir.resolve()
+        self.resolve_path = resolve_path
+        self.secret = self._load_secret()
+        self.public_url = (HTTP_SERVER_PUBLIC_URL or f"http://localhost:{HTTP_SERVER_PORT}").rstrip("/")
+        self.index: Dict[int, Path] = {}
+        self.index_lock = Lock()
         self.server = None
         self.thread = None
-    
+
+    @staticmethod
+    def _load_secret() -> bytes:
+        if HTTP_SERVER_SECRET:
+            return HTTP_SERVER_SECRET.encode()
+        logger.warning("HTTP_SERVER_SECRET is not set, download links will not survive a restart")
+        return secrets.token_bytes(32)
+
     def start(self):
         """Запустить сервер."""
         try:
-            os.chdir(self.storage_dir)
-            self.server = HTTPServer((HTTP_SERVER_HOST, HTTP_SERVER_PORT), FileDownloadHandler)
+            self.server = ThreadingHTTPServer((HTTP_SERVER_HOST, HTTP_SERVER_PORT), FileDownloadHandler)
+            self.server.daemon_threads = True
+            self.server.file_server = self
             self.thread = Thread(target=self.server.serve_forever, daemon=True)
             self.thread.start()
             logger.info(f"HTTP server started on {HTTP_SERVER_HOST}:{HTTP_SERVER_PORT}")
         except Exception as e:
             logger.error(f"Failed to start HTTP server: {e}")
-    
+
     def stop(self):
         """Остановить сервер."""
         if self.server:
             self.server.shutdown()
+            self.server.server_close()
             logger.info("HTTP server stopped")
-    
-    def get_file_url(self, file_path: Path) -> str:
-        """Получить URL для скачивания файла."""
-        return f"http://localhost:{HTTP_SERVER_PORT}/{file_path.name}"
+
+    def sign(self, download_id: int, expires: int, name: str) -> str:
+        """Подпись ссылки (первые 128 бит HMAC-SHA256 в base64url)."""
+        message = f"{download_id}:{expires}:{name}".encode()
+        digest = hmac.new(self.secret, message, hashlib.sha256).digest()[:16]
+        return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+    def get_file_url(self, download_id: int, file_path: Path) -> str:
+        """Получить подписанный URL для скачивания файла загрузки."""
+        file_path = Path(file_path)
+        with self.index_lock:
+            self.index[download_id] = file_path.resolve()
+
+        # Срок округляется вверх, чтобы повторные ссылки на файл совпадали (кеш прокси)
+        expires = int(time.time()) + HTTP_SERVER_TIMEOUT
+        expires += -expires % LINK_EXPIRY_STEP
+        name = file_path.name
+        signature = self.sign(download_id, expires, name)
+        # Пока ссылка действует, файл не вытесняется из хранилища
+        storage_manager.pin(file_path, expires)
+        return f"{self.public_url}/d/{download_id}/{expires}/{signature}/{quote(name)}"
+
+    def lookup(self, download_id: int) -> Optional[Path]:
+        """Путь к файлу загрузки внутри storage_dir или None."""
+        with self.index_lock:
+            file_path = self.index.get(download_id)
+        if file_path is None and self.resolve_path is not None:
+            resolved = self.resolve_path(download_id)
+            if resolved:
+                file_path = Path(resolved).resolve()
+                with self.index_lock:
+                    self.index[download_id] = file_path
+        if file_path is None or self.storage_dir not in file_path.parents:
+            return None
+        return file_path
+
+    def forget(self, download_id: int):
+        """Удалить загрузку из индекса (файл удален)."""
+        with self.index_lock:
+            self.index.pop(download_id, None)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Прием обновлений Telegram: POST на webhook_path с заголовком секрета."""
+
+    MAX_BODY_SIZE = 1024 * 1024
+
+    def do_POST(self):
+        server = self.server
+        if self.path != server.webhook_path:
+            self.send_error(404, "Not found")
+            return
+
+        secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret, server.secret_token):
+            self.send_error(403, "Forbidden")
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0 or length > self.MAX_BODY_SIZE:
+            self.send_error(400, "Bad request")
+            return
+
+        try:
+            update = types.Update.de_json(json.loads(self.rfile.read(length)))
+        except Exception as e:
+            logger.warning(f"Invalid webhook update: {e}")
+            self.send_error(400, "Bad request")
+            return
+
+        # Обновление не принято (бот останавливается) - Telegram повторит доставку позже.
+        # Отброшенные при перегрузке обновления принимаются: пользователю уже ответили "бот занят"
+        if not server.dispatch(update):
+            self.send_error(503, "Unavailable")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        """Не логировать каждый запрос Telegram."""
+        logger.debug(f"{self.client_address[0]} - {format % args}")
+
+
+class WebhookServer:
+    """HTTP-приемник webhook. Слушает локальный адрес, снаружи его публикует reverse proxy (TLS).
+    dispatch(update) возвращает False, если обновление не принято и его нужно доставить снова.
+    """
+
+    def __init__(self, host: str, port: int, webhook_path: str, secret_token: str,
+                 dispatch: Callable[[types.Update], bool]):
+        self.host = host
+        self.port = port
+        self.webhook_path = webhook_path
+        self.secret_token = secret_token
+        self.dispatch = dispatch
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        """Запустить сервер."""
+        self.server = ThreadingHTTPServer((self.host, self.port), WebhookHandler)
+        self.server.daemon_threads = True
+        self.server.webhook_path = self.webhook_path
+        self.server.secret_token = self.secret_token
+        self.server.dispatch = self.dispatch
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"Webhook server started on {self.host}:{self.port}{self.webhook_path}")
+
+    def stop(self):
+        """Остановить сервер."""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            logger.info("Webhook server stopped")
 
 
 # Глобальный экземпляр сервера
 http_server: Optional[HTTPFileServer] = None
 
 
-def init_http_server(storage_dir: Path):
+def init_http_server(storage_dir: Path, resolve_path: Optional[Callable[[int], Optional[str]]] = None):
     """Инициализировать HTTP-сервер."""
     global http_server
-    http_server = HTTPFileServer(storage_dir)
+    http_server = HTTPFileServer(storage_dir, resolve_path)
     http_server.start()
 
 
-def get_download_url(file_path: Path) -> str:
-    """Получить URL для скачивания файла."""
+def get_download_url(download_id: int, file_path: Path) -> str:
+    """Получить подписанный URL для скачивания файла загрузки."""
     if http_server:
-        return http_server.get_file_url(file_path)
+        return http_server.get_file_url(download_id, file_path)
     return ""
@@ -0,0 +1,227 @@
+"""
+Единый сервис сообщений о прогрессе загрузок
+Получает события от queue_worker и редактирует сообщения в Telegram из одного потока
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Callable, Dict, Set
+
+from telebot import types
+
+from config import PROGRESS_UPDATE_INTERVAL
+from db import db
+from edit_scheduler import EditScheduler
+from utils import format_eta
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+# Загрузку в этих статусах можно отменить кнопкой под сообщением прогресса
+CANCELLABLE_STATUSES = ("pending", "subscribed", "downloading", "converting")
+CANCEL_DOWNLOAD_PREFIX = "cancel_download_"
+
+
+def progress_markup(download_id: int, status: str = "pending") -> Optional[types.InlineKeyboardMarkup]:
+    """Кнопка отмены под сообщением прогресса (None - загрузку уже не отменить)."""
+    if status not in CANCELLABLE_STATUSES:
+        return None
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("❌ Отменить загрузку", callback_data=f"{CANCEL_DOWNLOAD_PREFIX}{download_id}"))
+    return markup
+
+
+def render_progress_text(status: str, progress: int, speed: float = 0, eta: int = 0,
+                         step: Optional[str] = None) -> str:
+    """Сформировать текст сообщения о прогрессе."""
+    progress = progress or 0
+
+    # Создать progress bar (20 символов)
+    filled = int(progress / 5)
+    bar = "█" * filled + "░" * (20 - filled)
+
+    if status == "downloading":
+        text = f"📥 ЗАГРУЖАЮ ВИДЕО\n\n{bar} {progress}%"
+        if speed and speed > 0:
+            text += f"\n⚡ Скорость: {speed:.1f} MB/s"
+        if eta and eta > 0:
+            text += f"\n⏱️ Осталось: {format_eta(int(eta))}"
+    elif status == "converting":
+        text = f"⚙️ КОНВЕРТИРУЮ ВИДЕО\n\n{bar}"
+        if step:
+            text += f"\n🔧 {step}"
+    elif status == "sending":
+        text = f"📤 ОТПРАВЛЯЮ ФАЙЛ\n\n{bar}"
+    elif status == "subscribed":
+        text = f"⏳ ЭТО ВИДЕО УЖЕ ЗАГРУЖАЕТСЯ\n\n{bar} {progress}%"
+    else:
+        text = f"⏳ ОБРАБОТКА\n\n{bar} {progress}%"
+    return text
+
+
+class ProgressNotifier:
+    """Один поток обновляет сообщения прогресса всех активных загрузок.
+
+    Worker присылает события (on_job_event), notifier хранит последнее состояние
+    каждой загрузки в памяти и раз в interval редактирует только изменившиеся
+    сообщения через EditScheduler (лимиты Telegram). Завершенные загрузки передаются в on_completed / on_failed на
+    небольшом пуле потоков, чтобы отправка файла не задерживала остальные сообщения.
+    Загрузки-подписчики (parent_download_id) показывают прогресс исходной задачи.
+    """
+
+    def __init__(self, bot, on_completed: Callable[[int, dict], None],
+                 on_failed: Callable[[int, dict], None],
+                 interval: float = PROGRESS_UPDATE_INTERVAL, finish_workers: int = 4):
+        self.bot = bot
+        self.scheduler = EditScheduler(bot)
+        self.on_completed = on_completed
+        self.on_failed = on_failed
+        self.interval = interval
+        self.finish_workers = finish_workers
+        self.tracked: Dict[int, dict] = {}  # download_id -> состояние сообщения
+        self.subscribers: Dict[int, Set[int]] = {}  # parent_download_id -> download_id подписчиков
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.is_running = False
+        self.thread = None
+        self.finish_executor: Optional[ThreadPoolExecutor] = None
+
+    def start(self):
+        """Запустить поток обновлений."""
+        if self.is_running:
+            return
+        self.is_running = True
+        self.stop_event.clear()
+        self.scheduler.start()
+        self.finish_executor = ThreadPoolExecutor(
+            max_workers=self.finish_workers,
+            thread_name_prefix="notify-finish"
+        )
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+        logger.info("Progress notifier started")
+
+    def stop(self):
+        """Остановить поток обновлений."""
+        self.is_running = False
+        self.stop_event.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.scheduler.stop()
+        if self.finish_executor:
+            self.finish_executor.shutdown(wait=False)
+            self.finish_executor = None
+        logger.info("Progress notifier stopped")
+
+    def track(self, download_id: int, user_id: int, chat_id: int, message_id: int):
+        """Начать отслеживать сообщение прогресса загрузки."""
+        with self.lock:
+            self.tracked[download_id] = {
+                "user_id": user_id,
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "status": "pending",
+                "progress": 0,
+                "speed_mbps": 0,
+                "eta_seconds": 0,
+                "step": None,
+                "last_text": None,
+                "dirty": False,
+            }
+
+        # Задача могла завершиться до регистрации - событие тогда уже пропущено
+        download = db.get_download(download_id)
+        if not download:
+            return
+        if download["status"] in TERMINAL_STATUSES:
+            self._finish(download_id, download["status"])
+            return
+
+        parent_download_id = download.get("parent_download_id")
+        if parent_download_id:
+            with self.lock:
+                entry = self.tracked.get(download_id)
+                if entry:
+                    entry["status"] = "subscribed"
+                    entry["dirty"] = True
+                self.subscribers.setdefault(parent_download_id, set()).add(download_id)
+            self.wakeup.set()
+
+    def on_job_event(self, download_id: int, status: str, data: dict):
+        """Обработчик событий queue_worker."""
+        if status in TERMINAL_STATUSES:
+            # Подписчики получают свои итоговые события от worker
+            with self.lock:
+                self.subscribers.pop(download_id, None)
+            self._finish(download_id, status)
+            return
+
+        with self.lock:
+            subscriber_ids = self.subscribers.get(download_id, ())
+            for tracked_id in (download_id, *subscriber_ids):
+                entry = self.tracked.get(tracked_id)
+                if not entry:
+                    continue
+                if tracked_id == download_id:
+                    entry["status"] = status
+                for key in ("progress", "speed_mbps", "eta_seconds", "step"):
+                    if key in data and data[key] is not None:
+                        entry[key] = data[key]
+                entry["dirty"] = True
+        self.wakeup.set()
+
+    def _finish(self, download_id: int, status: str):
+        """Передать завершенную загрузку обработчику (один раз)."""
+        with self.lock:
+            entry = self.tracked.pop(download_id, None)
+        if not entry or not self.finish_executor:
+            return
+
+        callback = self.on_completed if status == "completed" else self.on_failed
+        self.finish_executor.submit(self._run_finish, callback, entry, download_id)
+
+    def _run_finish(self, callback, entry: Dict, download_id: int):
+        try:
+            # Устаревший прогресс не должен перезаписать итоговое сообщение
+            # (forget ждет правку, которая уже отправляется)
+            self.scheduler.forget(entry["chat_id"], entry["message_id"])
+            user_id = entry["user_id"]
+            download = db.get_download(download_id)
+            if download:
+                callback(user_id, download)
+        except Exception as e:
+            logger.error(f"Error finishing download {download_id}: {e}")
+
+    def _run_loop(self):
+        """Цикл редактирования сообщений."""
+        while self.is_running:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if not self.is_running:
+                break
+
+            with self.lock:
+                updates = []
+                for download_id, entry in self.tracked.items():
+                    if not entry["dirty"]:
+                        continue
+                    entry["dirty"] = False
+                    text = render_progress_text(
+                        entry["status"], entry["progress"], entry["speed_mbps"], entry["eta_seconds"], entry["step"]
+                    )
+                    # Не редактировать, если текст не изменился
+                    if text == entry["last_text"]:
+                        continue
+                    entry["last_text"] = text
+                    markup = progress_markup(download_id, entry["status"])
+                    updates.append((entry["chat_id"], entry["message_id"], text, markup))
+
+            for chat_id, message_id, text, markup in updates:
+                self.scheduler.submit(chat_id, message_id, text, reply_markup=markup)
+
+            # Не чаще одного прохода за interval
+            self.stop_event.wait(self.interval)
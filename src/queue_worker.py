@@ -6,9 +6,10 @@ Background worker для обработки приоритетной очере
 import logging
 import time
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Callable, List
 import subprocess
 import os
 
@@ -16,21 +17,41 @@ from config import (
     MAX_CONCURRENT_DOWNLOADS,
     PROGRESS_UPDATE_INTERVAL,
     DOWNLOAD_TIMEOUT_SECONDS,
-    STORAGE_DIR,
 )
 from db import db
-from utils import download_video, get_video_info, format_file_size, format_speed, format_eta
+from storage import storage_manager
+from utils import get_video_info, format_file_size, format_speed, format_eta
+from download_process import run_download, DownloadCancelled
 
 logger = logging.getLogger(__name__)
 
 
 class QueueWorker:
-    """Рабочий для обработки очереди загрузок."""
+    """Рабочий для обработки очереди загрузок.
+
+    Диспетчер выбирает задачи из очереди и отдает их в пул потоков,
+    так что одновременно выполняется до max_workers загрузок.
+    Диспетчер спит на condition и просыпается только когда появилась
+    новая задача или освободился слот.
+    Изменения состояния задач рассылаются подписчикам (add_listener),
+    чтобы интерфейс не опрашивал БД. Итоговый статус получают и задачи,
+    подписанные на эту загрузку (тот же video_key и формат).
+    Сама загрузка идет в отдельном процессе (download_process), поэтому задачу
+    можно отменить (cancel) или прервать по таймауту без ожидания yt-dlp.
+    """
     
-    def __init__(self):
+    def __init__(self, max_workers: int = MAX_CONCURRENT_DOWNLOADS):
         self.is_running = False
         self.thread = None
-        self.active_downloads = {}  # download_id -> (start_time, total_bytes)
+        self.max_workers = max_workers
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.active_downloads = {}  # download_id -> start_time
+        self.cancel_events = {}  # download_id -> threading.Event выполняющейся задачи
+        self.cancelled_pending = set()  # Отменены, когда диспетчер уже взял их из очереди, но не запустил
+        self.active_lock = threading.Lock()
+        self.wakeup = threading.Condition()
+        self.wakeup_pending = False
+        self.listeners: List[Callable[[int, str, dict], None]] = []
     
     def start(self):
         """Запустить worker."""
@@ -39,35 +60,159 @@ class QueueWorker:
             return
         
         self.is_running = True
+        self.wakeup_pending = True  # Разобрать очередь, оставшуюся с прошлого запуска
+        db.add_download_listener(self.notify)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="download"
+        )
         self.thread = threading.Thread(target=self._run_loop, daemon=True)
         self.thread.start()
-        logger.info("Queue worker started")
+        logger.info(f"Queue worker started ({self.max_workers} slots)")
     
     def stop(self):
         """Остановить worker."""
         self.is_running = False
+        db.remove_download_listener(self.notify)
+        self.notify()
+        # Прервать выполняющиеся загрузки, они вернутся в очередь
+        with self.active_lock:
+            for event in self.cancel_events.values():
+                event.set()
         if self.thread:
             self.thread.join(timeout=5)
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        db.flush_progress()
         logger.info("Queue worker stopped")
     
+    def add_listener(self, callback: Callable[[int, str, dict], None]):
+        """Подписаться на события задач: callback(download_id, status, data)."""
+        if callback not in self.listeners:
+            self.listeners.append(callback)
+    
+    def _emit(self, download_id: int, status: str, **data):
+        """Разослать событие задачи подписчикам."""
+        for callback in list(self.listeners):
+            try:
+                callback(download_id, status, data)
+            except Exception as e:
+                logger.error(f"Listener error for {download_id}: {e}")
+    
+    def _set_status(self, download_id: int, status: str, **fields):
+        """Записать статус в БД и уведомить подписчиков."""
+        db.update_download_status(download_id, status, **fields)
+        self._emit(download_id, status, **fields)
+    
+    def _finish(self, download_id: int, status: str, **fields):
+        """Записать итоговый статус задачи и разослать его ее подписчикам."""
+        self._set_status(download_id, status, **fields)
+        for subscriber_id in db.resolve_subscribers(download_id, status, **fields):
+            self._emit(subscriber_id, status, **fields)
+    
+    def cancel(self, download_id: int) -> bool:
+        """Отменить загрузку: ожидающую - убрать из очереди, выполняющуюся - остановить.
+        Загрузку, на которую подписаны другие пользователи, отменить нельзя (False).
+        """
+        download = db.get_download(download_id)
+        if not download:
+            return False
+        status = download["status"]
+
+        if status == "subscribed":
+            # Подписчик просто перестает ждать, исходная загрузка продолжается
+            self._set_status(download_id, "cancelled")
+            return True
+        if status not in ("pending", "downloading", "converting") or db.get_subscriber_ids(download_id):
+            return False
+
+        with self.active_lock:
+            event = self.cancel_events.get(download_id)
+            if event is not None:
+                event.set()
+                logger.info(f"Cancelling running download {download_id}")
+                return True
+            if not db.discard_pending_download(download_id) and db.is_download_live(download_id):
+                # Диспетчер взял задачу из очереди и пропустит ее (_dispatch_pending)
+                self.cancelled_pending.add(download_id)
+        self._finish(download_id, "cancelled")
+        logger.info(f"Cancelled pending download {download_id}")
+        return True
+    
+    def count_active(self) -> int:
+        """Количество задач, которые сейчас выполняются в пуле."""
+        with self.active_lock:
+            return len(self.active_downloads)
+    
+    def notify(self, download_id: Optional[int] = None):
+        """Разбудить диспетчер (новая задача или освободился слот)."""
+        with self.wakeup:
+            self.wakeup_pending = True
+            self.wakeup.notify()
+    
     def _run_loop(self):
         """Основной цикл обработки очереди."""
         while self.is_running:
+            with self.wakeup:
+                while self.is_running and not self.wakeup_pending:
+                    self.wakeup.wait()
+                self.wakeup_pending = False
+            
+            if not self.is_running:
+                break
+            
             try:
-                active_count = db.count_active_downloads()
-                
-                # Если есть место в очереди, запустить следующую задачу
-                if active_count < MAX_CONCURRENT_DOWNLOADS:
-                    pending = db.get_all_pending_downloads()
-                    if pending:
-                        download = pending[0]
-                        self._process_download(download)
-                
-                time.sleep(2)  # Проверка каждые 2 секунды
+                self._dispatch_pending()
             
             except Exception as e:
                 logger.error(f"Worker error: {e}")
                 time.sleep(5)
+                self.notify()  # Повторить попытку
+    
+    def _dispatch_pending(self) -> int:
+        """Отдать в пул столько задач, сколько есть свободных слотов.
+        Возвращает количество запущенных задач.
+        """
+        free_slots = self.max_workers - self.count_active()
+        if free_slots <= 0:
+            return 0
+        
+        dispatched = 0
+        
+        while dispatched < free_slots:
+            download = db.pop_pending_download()
+            if not download:
+                break
+            
+            download_id = download["download_id"]
+            with self.active_lock:
+                if download_id in self.active_downloads:
+                    continue
+                if download_id in self.cancelled_pending:
+                    self.cancelled_pending.discard(download_id)
+                    db.release_download(download_id)
+                    continue
+                self.active_downloads[download_id] = time.time()
+                self.cancel_events[download_id] = threading.Event()
+            
+            # Статус меняется до запуска, чтобы следующий проход не взял задачу повторно
+            self._set_status(download_id, "downloading")
+            future = self.executor.submit(self._process_download, download)
+            future.add_done_callback(lambda _, d=download_id: self._release_slot(d))
+            dispatched += 1
+        
+        return dispatched
+    
+    def _release_slot(self, download_id: int):
+        """Освободить слот после завершения задачи."""
+        with self.active_lock:
+            started_at = self.active_downloads.pop(download_id, None)
+            self.cancel_events.pop(download_id, None)
+        db.release_download(download_id)
+        if started_at is not None:
+            logger.info(f"Slot released for {download_id} after {time.time() - started_at:.1f}s")
+        self.notify()
     
     def _process_download(self, download: dict):
         """Обработать одну загрузку."""
@@ -78,42 +223,53 @@ class QueueWorker:
         
         logger.info(f"Processing download {download_id}: {video_url} ({format_type})")
         
+        job_dir = None
         try:
-            # Создать директорию пользователя
-            user_dir = STORAGE_DIR / str(user_id)
-            user_dir.mkdir(exist_ok=True)
-            
-            # Обновить статус на "downloading"
-            db.update_download_status(download_id, "downloading")
+            # Отдельный каталог задачи: параллельные загрузки пользователя не смешиваются
+            job_dir = storage_manager.job_dir(user_id, download_id)
             
             # Функция для обновления прогресса
-            progress_data = {"last_update": time.time()}
+            progress_data = {"last_update": time.time(), "stage": ("downloading", None)}
             
-            def progress_callback(stage, pct, speed, eta, downloaded, total):
+            def progress_callback(stage, pct, speed, eta, downloaded, total, step=None):
+                if stage == "completed":
+                    return  # Итоговый статус записывает _finish вместе с путем к файлу
                 now = time.time()
-                if now - progress_data["last_update"] > PROGRESS_UPDATE_INTERVAL:
+                # Смена этапа показывается сразу, прогресс внутри этапа - не чаще интервала
+                stage_changed = (stage, step) != progress_data["stage"]
+                if stage_changed or now - progress_data["last_update"] > PROGRESS_UPDATE_INTERVAL:
+                    if stage_changed and stage != progress_data["stage"][0]:
+                        db.update_download_status(download_id, stage)
                     db.update_download_progress(download_id, pct, speed, eta)
+                    self._emit(download_id, stage, progress=pct, speed_mbps=speed, eta_seconds=eta, step=step)
                     progress_data["last_update"] = now
+                    progress_data["stage"] = (stage, step)
+            
+            with self.active_lock:
+                cancel_event = self.cancel_events.get(download_id)
             
-            # Загрузить видео
-            success, file_path, metadata = download_video(
+            # Загрузить видео (в отдельном процессе)
+            success, file_path, metadata = run_download(
                 video_url,
-                user_dir,
+                job_dir,
                 format_type=format_type,
-                progress_callback=progress_callback
+                progress_callback=progress_callback,
+                cancel_event=cancel_event,
             )
 
             if not success:
+                storage_manager.discard_job_dir(job_dir)
                 error_msg = metadata.get("error", "Download failed")
-                db.update_download_status(download_id, "failed", error_message=error_msg)
+                self._finish(download_id, "failed", error_message=error_msg)
                 logger.error(f"Download failed for {download_id}: {error_msg}")
                 return
 
-            # Конвертация обрабатывается внутри download_video, статус остается downloading до completed
-
             # Обновить статус на "completed"
+            storage_manager.finish_job_dir(job_dir)
             file_size = Path(file_path).stat().st_size if file_path else 0
-            db.update_download_status(
+            if file_path:
+                storage_manager.add(file_path)
+            self._finish(
                 download_id,
                 "completed",
                 file_path=file_path,
@@ -122,11 +278,25 @@ class QueueWorker:
             
             logger.info(f"Download completed {download_id}: {file_size} bytes")
         
-        except subprocess.TimeoutExpired:
-            db.update_download_status(download_id, "failed", error_message="Download timeout")
-            logger.error(f"Download timeout for {download_id}")
+        except DownloadCancelled:
+            if job_dir:
+                storage_manager.discard_job_dir(job_dir)
+            if self.is_running:
+                self._finish(download_id, "cancelled")
+                logger.info(f"Download cancelled {download_id}")
+            else:
+                # Worker останавливается - задача продолжится после перезапуска
+                self._set_status(download_id, "pending")
+                logger.info(f"Download {download_id} interrupted by shutdown, requeued")
+        except subprocess.TimeoutExpired as e:
+            if job_dir:
+                storage_manager.discard_job_dir(job_dir)
+            self._finish(download_id, "failed", error_message="Download timeout")
+            logger.error(f"Download timeout for {download_id}: {e.cmd} took longer than {e.timeout}s")
         except Exception as e:
-            db.update_download_status(download_id, "failed", error_message=str(e))
+            if job_dir:
+                storage_manager.discard_job_dir(job_dir)
+            self._finish(download_id, "failed", error_message=str(e))
             logger.error(f"Error processing download {download_id}: {e}")
 
 
@@ -0,0 +1,347 @@
+"""
+Учет файлов в STORAGE_DIR и соблюдение квоты MAX_STORAGE_MB
+Для каждого файла хранится размер, время последнего обращения, число
+текущих отправок и срок выданной на него ссылки. При превышении квоты
+фоновый поток удаляет давно не использованные файлы, которые сейчас никому
+не отправляются и на которые нет действующих ссылок.
+Общий объем ведется по добавлениям и удалениям, полный обход каталога
+выполняется только при запуске и для периодической сверки в фоне
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Union
+
+from config import (
+    STORAGE_DIR,
+    MAX_STORAGE_MB,
+    STORAGE_LOW_WATERMARK,
+    STORAGE_CHECK_INTERVAL,
+    STORAGE_RECONCILE_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+PathLike = Union[str, Path]
+
+# Каждая загрузка пишет в свой каталог STORAGE_DIR/<user_id>/job-<download_id>/,
+# незаконченные файлы лежат в его подкаталоге JOB_TEMP_DIR и в учет не попадают.
+# Постпроцессоры yt-dlp (склейка, конвертация) пишут промежуточные файлы прямо
+# в каталог задачи, поэтому пока задача идет, ее каталог не учитывается целиком
+JOB_DIR_PREFIX = "job-"
+JOB_TEMP_DIR = ".tmp"
+
+
+class StoredFile:
+    """Файл в хранилище."""
+
+    __slots__ = ("size", "last_access", "refs", "pinned_until")
+
+    def __init__(self, size: int, last_access: float):
+        self.size = size
+        self.last_access = last_access
+        self.refs = 0  # Сколько отправок (Telegram, HTTP) сейчас читают файл
+        self.pinned_until = 0.0  # До какого времени (time.time()) действует ссылка на файл
+
+    def is_evictable(self, now: float) -> bool:
+        return not self.refs and self.pinned_until <= now
+
+
+class StorageManager:
+    """Учет файлов хранилища и LRU-вытеснение при превышении квоты.
+
+    Файлы добавляются через add() после загрузки, чтение оборачивается в
+    in_use(), на время действия ссылки файл закрепляется pin() - такие файлы
+    не удаляются. Если объем больше quota_bytes,
+    удаляются файлы с самым старым обращением, пока объем не опустится до
+    low_watermark * quota_bytes.
+    """
+
+    def __init__(self, storage_dir: Path = STORAGE_DIR, quota_bytes: int = MAX_STORAGE_MB * 1024 * 1024,
+                 low_watermark: float = STORAGE_LOW_WATERMARK, check_interval: float = STORAGE_CHECK_INTERVAL,
+                 reconcile_interval: float = STORAGE_RECONCILE_INTERVAL):
+        self.storage_dir = Path(storage_dir).resolve()
+        self.quota_bytes = quota_bytes
+        self.low_watermark = low_watermark
+        self.check_interval = check_interval
+        self.reconcile_interval = reconcile_interval
+        self.last_reconcile = 0.0
+        self.files: Dict[Path, StoredFile] = {}
+        self.active_jobs: Set[Path] = set()  # Каталоги задач, которые еще скачиваются
+        self.total_bytes = 0
+        self.evicted_files = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.is_running = False
+
+    def start(self):
+        """Просканировать хранилище и запустить фоновое вытеснение."""
+        if self.is_running:
+            return
+        self.scan()
+        self.is_running = True
+        self.thread = threading.Thread(target=self._run_loop, name="storage", daemon=True)
+        self.thread.start()
+        logger.info(f"Storage manager started: {self.total_bytes / (1024 * 1024):.1f} MB "
+                    f"in {len(self.files)} files, quota {self.quota_bytes / (1024 * 1024):.0f} MB")
+
+    def stop(self):
+        """Остановить фоновый поток."""
+        self.is_running = False
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+            self.thread = None
+
+    def scan(self) -> int:
+        """Сверить учет с диском (новые файлы получают время обращения = mtime).
+        Возвращает расхождение учтенного объема с реальным в байтах.
+        """
+        started = time.time()
+        files = {}
+        for path, size, mtime in self._walk(self.storage_dir):
+            files[path] = StoredFile(size, mtime)
+
+        with self.lock:
+            for path, current in self.files.items():
+                stored = files.get(path)
+                if stored is not None:
+                    # Не потерять время обращения, счетчики отправок и ссылки
+                    stored.refs = current.refs
+                    stored.pinned_until = current.pinned_until
+                    stored.last_access = max(stored.last_access, current.last_access)
+                elif current.last_access >= started:
+                    # Добавлен во время обхода
+                    files[path] = current
+            # Файлы незаконченных задач учитываются только после add()
+            files = {path: stored for path, stored in files.items() if path.parent not in self.active_jobs}
+            drift = sum(stored.size for stored in files.values()) - self.total_bytes
+            self.files = files
+            self.total_bytes += drift
+            self.last_reconcile = time.time()
+        return drift
+
+    @staticmethod
+    def _walk(directory: Path):
+        """(путь, размер, mtime) всех файлов каталога; scandir не делает лишних stat."""
+        stack = [directory]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if entry.name != JOB_TEMP_DIR:
+                                    stack.append(Path(entry.path))
+                            elif entry.is_file(follow_symlinks=False):
+                                stat = entry.stat(follow_symlinks=False)
+                                yield Path(entry.path), stat.st_size, stat.st_mtime
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+
+    def add(self, path: PathLike):
+        """Учесть новый (или перезаписанный) файл."""
+        path = Path(path).resolve()
+        try:
+            size = path.stat().st_size
+        except OSError as e:
+            logger.warning(f"Cannot add {path} to storage: {e}")
+            return
+
+        with self.lock:
+            stored = self.files.get(path)
+            if stored is None:
+                self.files[path] = stored = StoredFile(0, 0)
+            self.total_bytes += size - stored.size
+            stored.size = size
+            stored.last_access = time.time()
+            over_quota = self.total_bytes > self.quota_bytes
+
+        if over_quota:
+            self.wakeup.set()
+
+    def touch(self, path: PathLike):
+        """Отметить обращение к файлу (отодвигает его вытеснение)."""
+        path = Path(path).resolve()
+        with self.lock:
+            stored = self.files.get(path)
+            if stored is not None:
+                stored.last_access = time.time()
+
+    def pin(self, path: PathLike, until: float):
+        """Не вытеснять файл до until: на него выдана ссылка с этим сроком."""
+        path = Path(path).resolve()
+        with self.lock:
+            stored = self.files.get(path)
+            if stored is not None:
+                stored.pinned_until = max(stored.pinned_until, until)
+                stored.last_access = time.time()
+
+    @contextmanager
+    def in_use(self, path: PathLike):
+        """Файл читается (отправка в Telegram, раздача по HTTP) и не может быть вытеснен."""
+        path = Path(path).resolve()
+        with self.lock:
+            stored = self.files.get(path)
+            if stored is not None:
+                stored.refs += 1
+                stored.last_access = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                stored = self.files.get(path)
+                if stored is not None and stored.refs > 0:
+                    stored.refs -= 1
+
+    def delete(self, path: PathLike) -> bool:
+        """Удалить файл с диска и из учета (и опустевший каталог задачи)."""
+        path = Path(path).resolve()
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not delete file {path}: {e}")
+            return False
+
+        with self.lock:
+            stored = self.files.pop(path, None)
+            if stored is not None:
+                self.total_bytes -= stored.size
+
+        if path.parent.name.startswith(JOB_DIR_PREFIX):
+            try:
+                path.parent.rmdir()
+            except OSError:
+                pass  # В каталоге есть другие файлы
+        return True
+
+    def job_dir(self, user_id: int, download_id: int) -> Path:
+        """Создать пустой каталог для загрузки download_id.
+        До finish_job_dir или discard_job_dir его файлы не попадают в учет.
+        """
+        job_dir = self.storage_dir / str(user_id) / f"{JOB_DIR_PREFIX}{download_id}"
+        # Остатки прерванной попытки этой же загрузки
+        self.discard_job_dir(job_dir)
+        with self.lock:
+            self.active_jobs.add(job_dir)
+        job_dir.mkdir(parents=True)
+        return job_dir
+
+    def finish_job_dir(self, job_dir: Path):
+        """Удалить временные файлы задачи (итоговый файл остается в job_dir)."""
+        shutil.rmtree(job_dir / JOB_TEMP_DIR, ignore_errors=True)
+        with self.lock:
+            self.active_jobs.discard(job_dir)
+
+    def discard_job_dir(self, job_dir: Path):
+        """Удалить каталог неудачной задачи вместе со всеми файлами."""
+        with self.lock:
+            self.active_jobs.discard(job_dir)
+        if not job_dir.exists():
+            return
+        with self.lock:
+            for path in [path for path in self.files if job_dir in path.parents]:
+                self.total_bytes -= self.files.pop(path).size
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+    def remove_older_than(self, max_age_seconds: float) -> int:
+        """Удалить файлы без обращений дольше max_age_seconds. Возвращает количество удаленных."""
+        now = time.time()
+        deadline = now - max_age_seconds
+        with self.lock:
+            candidates = [path for path, stored in self.files.items()
+                          if stored.is_evictable(now) and stored.last_access < deadline]
+        return sum(1 for path in candidates if self.delete(path))
+
+    def enforce_quota(self) -> int:
+        """Вытеснить давно не использованные файлы, если объем больше квоты.
+        Возвращает количество удаленных файлов.
+        """
+        now = time.time()
+        with self.lock:
+            if self.total_bytes <= self.quota_bytes:
+                return 0
+            target = self.quota_bytes * self.low_watermark
+            excess = self.total_bytes - target
+            victims: List[Path] = []
+            for path, stored in sorted(self.files.items(), key=lambda item: item[1].last_access):
+                if excess <= 0:
+                    break
+                if not stored.is_evictable(now):
+                    continue
+                victims.append(path)
+                excess -= stored.size
+
+        removed = 0
+        for path in victims:
+            with self.lock:
+                stored = self.files.get(path)
+                # Файл могли начать отправлять, пока мы выбирали жертв
+                if stored is None or not stored.is_evictable(now):
+                    continue
+            if self.delete(path):
+                removed += 1
+                logger.info(f"Evicted from storage: {path}")
+
+        if removed:
+            with self.lock:
+                self.evicted_files += removed
+        if self.total_bytes > self.quota_bytes:
+            logger.warning(f"Storage is over quota ({self.total_bytes / (1024 * 1024):.1f} MB), "
+                           f"all remaining files are in use or have live links")
+        return removed
+
+    def size_mb(self) -> float:
+        """Объем хранилища в MB (по учету, без обхода диска)."""
+        return self.total_bytes / (1024 * 1024)
+
+    def stats(self) -> Dict:
+        """Состояние хранилища для панели администратора."""
+        with self.lock:
+            return {
+                "files": len(self.files),
+                "bytes": self.total_bytes,
+                "quota_bytes": self.quota_bytes,
+                "in_use": sum(1 for stored in self.files.values() if stored.refs),
+                "linked": sum(1 for stored in self.files.values() if stored.pinned_until > time.time()),
+                "evicted": self.evicted_files,
+            }
+
+    def _run_loop(self):
+        while self.is_running:
+            self.wakeup.wait(self.check_interval)
+            self.wakeup.clear()
+            if not self.is_running:
+                break
+            try:
+                if time.time() - self.last_reconcile >= self.reconcile_interval:
+                    drift = self.scan()
+                    if drift:
+                        logger.info(f"Storage ledger reconciled, drift {drift / (1024 * 1024):+.1f} MB")
+                self.enforce_quota()
+            except Exception as e:
+                logger.error(f"Storage maintenance error: {e}")
+
+
+# Глобальный менеджер хранилища
+storage_manager = StorageManager()
+
+
+def start_storage_manager():
+    """Запустить глобальный менеджер хранилища."""
+    storage_manager.start()
+
+
+def stop_storage_manager():
+    """Остановить глобальный менеджер хранилища."""
+    storage_manager.stop()
@@ -0,0 +1,194 @@
+"""
+Пул потоков для обработки входящих обновлений Telegram
+Очередь на каждого пользователя, обход пользователей по кругу и ограничение
+одновременных обработчиков одного пользователя. Лишние обновления не ждут
+бесконечно, а отбрасываются с ответом "бот занят"
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, List, Optional, Set
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+
+def update_user_id(update: types.Update) -> Optional[int]:
+    """Пользователь, от которого пришло обновление (None - неизвестен)."""
+    for event in (update.message, update.callback_query, update.edited_message):
+        if event is not None and event.from_user is not None:
+            return event.from_user.id
+    return None
+
+
+class UpdateWorkerPool:
+    """Пул обработчиков: handler([update]) выполняется в одном из workers потоков.
+
+    У каждого пользователя своя очередь (не больше per_user_queue обновлений) и не
+    больше per_user_limit обновлений в обработке. Потоки берут пользователей по кругу,
+    поэтому один пользователь, присылающий много ссылок, не занимает все потоки.
+    Всего в очередях не больше queue_size обновлений. Не принятое обновление передается
+    в on_reject (ответить пользователю, что бот занят). on_reject выполняется в отдельных
+    потоках, а не в потоке submit: запрос к Telegram не задерживает ответ на webhook и
+    прием следующих обновлений. Ответов в ожидании не больше queue_size, остальные
+    отказы проходят молча.
+    """
+
+    REJECT_WORKERS = 2
+
+    def __init__(self, handler: Callable[[List[types.Update]], None], workers: int, queue_size: int,
+                 per_user_limit: int = 1, per_user_queue: int = 3,
+                 on_reject: Optional[Callable[[types.Update], None]] = None):
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.per_user_limit = per_user_limit
+        self.per_user_queue = per_user_queue
+        self.on_reject = on_reject
+        self.queues: Dict[Optional[int], Deque[types.Update]] = {}  # user_id -> ожидающие обновления
+        self.running: Dict[Optional[int], int] = {}  # user_id -> обновлений в обработке
+        self.ready: Deque[Optional[int]] = deque()  # пользователи, чьи обновления можно брать
+        self.ready_set: Set[Optional[int]] = set()
+        self.queued = 0
+        self.rejected = 0
+        self.reject_backlog = 0  # ответов on_reject в ожидании
+        self.reject_executor: Optional[ThreadPoolExecutor] = None
+        self.condition = threading.Condition()
+        self.threads: List[threading.Thread] = []
+        self.is_running = False
+
+    def start(self):
+        """Запустить потоки обработки."""
+        if self.is_running:
+            return
+        self.is_running = True
+        self.reject_executor = ThreadPoolExecutor(self.REJECT_WORKERS, thread_name_prefix="update-reject")
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run_loop, name=f"update-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"Update worker pool started ({self.workers} workers)")
+
+    def stop(self):
+        """Остановить потоки (необработанные обновления отбрасываются)."""
+        with self.condition:
+            self.is_running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout=5)
+        self.threads = []
+        if self.reject_executor:
+            self.reject_executor.shutdown(wait=False)
+        logger.info("Update worker pool stopped")
+
+    def submit(self, update: types.Update) -> bool:
+        """Поставить обновление в очередь.
+        True - обновление принято или отброшено с ответом "бот занят" (либо молча, если
+        ответов в ожидании слишком много). False - пул остановлен или нет on_reject.
+        """
+        user_id = update_user_id(update)
+        with self.condition:
+            if not self.is_running:
+                return False
+            user_queue = self.queues.get(user_id)
+            accepted = self.queued < self.queue_size and (
+                user_queue is None or len(user_queue) < self.per_user_queue
+            )
+            if accepted:
+                if user_queue is None:
+                    user_queue = self.queues[user_id] = deque()
+                user_queue.append(update)
+                self.queued += 1
+                self._mark_ready(user_id)
+                self.condition.notify()
+            else:
+                self.rejected += 1
+                if self.on_reject is None:
+                    notify = False
+                else:
+                    notify = self.reject_backlog < self.queue_size
+                    if notify:
+                        self.reject_backlog += 1
+                reject_executor = self.reject_executor
+
+        if accepted:
+            return True
+        logger.warning(f"Update queue is full for user {user_id}, rejecting update {update.update_id}")
+        if self.on_reject is None:
+            return False
+        if notify:
+            try:
+                reject_executor.submit(self._reject, update)
+            except RuntimeError:
+                # Пул остановлен между проверкой и отправкой
+                self._reject_done()
+        return True
+
+    def _reject(self, update: types.Update):
+        """Ответить на отброшенное обновление (в потоке reject_executor)."""
+        try:
+            self.on_reject(update)
+        except Exception as e:
+            logger.debug(f"Reject handler error: {e}")
+        finally:
+            self._reject_done()
+
+    def _reject_done(self):
+        with self.condition:
+            self.reject_backlog -= 1
+
+    def stats(self) -> Dict:
+        """Состояние очереди для панели администратора."""
+        with self.condition:
+            return {
+                "queued": self.queued,
+                "running": sum(self.running.values()),
+                "users": len(self.queues),
+                "rejected": self.rejected,
+            }
+
+    def _mark_ready(self, user_id: Optional[int]):
+        """Поставить пользователя в круг, если у него есть обновления и свободный лимит."""
+        if (user_id not in self.ready_set and self.queues.get(user_id)
+                and self.running.get(user_id, 0) < self.per_user_limit):
+            self.ready.append(user_id)
+            self.ready_set.add(user_id)
+
+    def _take(self):
+        """Взять следующее обновление (под condition)."""
+        user_id = self.ready.popleft()
+        self.ready_set.discard(user_id)
+        user_queue = self.queues[user_id]
+        update = user_queue.popleft()
+        if not user_queue:
+            del self.queues[user_id]
+        self.queued -= 1
+        self.running[user_id] = self.running.get(user_id, 0) + 1
+        # В конец круга - следующим обслуживается другой пользователь
+        self._mark_ready(user_id)
+        return user_id, update
+
+    def _run_loop(self):
+        while True:
+            with self.condition:
+                while self.is_running and not self.ready:
+                    self.condition.wait()
+                if not self.is_running:
+                    break
+                user_id, update = self._take()
+
+            try:
+                self.handler([update])
+            except Exception as e:
+                logger.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                with self.condition:
+                    self.running[user_id] -= 1
+                    if not self.running[user_id]:
+                        del self.running[user_id]
+                    self._mark_ready(user_id)
+                    if self.ready:
+                        self.condition.notify()
@@ -3,15 +3,22 @@
 """
 
 import re
-import subprocess
-import json
+import queue
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from typing import Optional, Dict, List, Tuple
 import time
 import threading
 import logging
 
-from config import YTDLP_CONFIG, AUDIO_FORMAT, MAX_VIDEO_DURATION_MINUTES, FFMPEG_PATH, DOWNLOAD_TIMEOUT_SECONDS, CONVERSION_TIMEOUT_SECONDS, VIDEO_INFO_CACHE, VIDEO_INFO_CACHE_TIMEOUT
+from config import (
+    YTDLP_CONFIG, AUDIO_FORMAT, MAX_VIDEO_DURATION_MINUTES, FFMPEG_PATH, DOWNLOAD_TIMEOUT_SECONDS, CONVERSION_TIMEOUT_SECONDS,
+    YTDLP_INFO_POOL_SIZE, YTDLP_INFO_SOCKET_TIMEOUT, YTDLP_INFO_TIMEOUT, YTDLP_INFO_QUEUE_TIMEOUT
+)
+from video_info_cache import VideoInfoCache
+from storage import JOB_TEMP_DIR
 
 
 logger = logging.getLogger(__name__)
@@ -19,159 +26,397 @@ logger = logging.getLogger(__name__)
 
 def is_youtube_url(url: str) -> bool:
     """Проверить, что это ссылка на YouTube."""
-    youtube_regex = r"^(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/"
+    youtube_regex = r"^(https?://)?((www|m|music)\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/"
     return bool(re.match(youtube_regex, url))
 
 
-def get_video_info(url: str) -> Optional[Dict]:
+YOUTUBE_ID_REGEX = re.compile(r"^[A-Za-z0-9_-]{11}$")
+YOUTUBE_PATH_PREFIXES = ("shorts", "embed", "live", "v", "e")
+
+# Трекинговые параметры, которые не влияют на видео (плюс все utm_*)
+IGNORED_QUERY_PARAMS = {"si", "feature", "fbclid", "gclid", "igshid"}
+
+
+def parse_video_url(url: str) -> Tuple[str, str]:
     """
-    Получить информацию о видео с YouTube используя yt-dlp.
-    Возвращает: {title, duration, thumbnail, ext, filesize, id, available_formats}
-    available_formats - список доступных разрешений видео
-    Использует кэширование для снижения запросов.
+    Разобрать ссылку в канонический (extractor, video_id) без запросов к yt-dlp.
+    youtu.be/X, youtube.com/watch?v=X&t=10, m.youtube.com/..., /shorts/X -> ("youtube", "X").
+    Для остальных сайтов video_id - нормализованный URL (без трекинга и фрагмента).
     """
-    # Проверить кэш
-    current_time = time.time()
-    if url in VIDEO_INFO_CACHE:
-        cache_entry = VIDEO_INFO_CACHE[url]
-        if current_time - cache_entry['timestamp'] < VIDEO_INFO_CACHE_TIMEOUT:
-            logger.info(f"Using cached video info for {url}")
-            return cache_entry['info']
-        else:
-            # Удалить просроченный кэш
-            del VIDEO_INFO_CACHE[url]
+    url = url.strip()
+    if "://" not in url:
+        url = "https://" + url
+
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    path_parts = [p for p in parts.path.split("/") if p]
+
+    if is_youtube_url(url):
+        video_id = None
+        if host == "youtu.be" and path_parts:
+            video_id = path_parts[0]
+        elif path_parts and path_parts[0] == "watch":
+            video_id = dict(parse_qsl(parts.query)).get("v")
+        elif len(path_parts) >= 2 and path_parts[0] in YOUTUBE_PATH_PREFIXES:
+            video_id = path_parts[1]
+        if video_id and YOUTUBE_ID_REGEX.match(video_id):
+            return "youtube", video_id
+
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in IGNORED_QUERY_PARAMS and not k.startswith("utm_")
+    )
+    path = parts.path.rstrip("/") or "/"
+    normalized = urlunsplit(("https", host, path, urlencode(query), ""))
+    return "generic", normalized
+
+
+def canonical_video_key(url: str) -> str:
+    """Ключ видео для всех кешей: "youtube:<id>" или "generic:<нормализованный URL>"."""
+    extractor, video_id = parse_video_url(url)
+    return f"{extractor}:{video_id}"
+
+
+def canonical_video_url(url: str) -> str:
+    """URL для загрузки: для YouTube - короткая каноническая ссылка без плейлиста и тайм-кода."""
+    extractor, video_id = parse_video_url(url)
+    if extractor == "youtube":
+        return f"https://www.youtube.com/watch?v={video_id}"
+    return url.strip()
+
+
+class _YtdlLogger:
+    """Логгер для yt-dlp: сообщения не пишутся в stderr, ошибки логирует вызывающий код."""
+
+    def debug(self, msg):
+        logger.debug(msg)
+
+    def warning(self, msg):
+        logger.debug(msg)
+
+    def error(self, msg):
+        logger.debug(msg)
+
+
+class YoutubeDLPool:
+    """
+    Пул долгоживущих экземпляров yt_dlp.YoutubeDL для извлечения метаданных.
+    Экземпляр YoutubeDL не потокобезопасен, поэтому каждый поток берет свой
+    из очереди и возвращает после запроса. Экстракторы импортируются и
+    инициализируются один раз (warm_up), а не в новом процессе на каждую ссылку.
+    """
+
+    def __init__(self, size: int = YTDLP_INFO_POOL_SIZE, socket_timeout: int = YTDLP_INFO_SOCKET_TIMEOUT):
+        self.size = size
+        self.socket_timeout = socket_timeout
+        self.instances: "queue.Queue" = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _options(self) -> Dict:
+        return {
+            'quiet': True,
+            'no_warnings': True,
+            'skip_download': True,
+            'noplaylist': True,
+            'geo_bypass': YTDLP_CONFIG.get('geo_bypass', True),
+            'socket_timeout': self.socket_timeout,
+            'logger': _YtdlLogger(),
+        }
+
+    def _create(self):
+        import yt_dlp
+
+        ydl = yt_dlp.YoutubeDL(self._options())
+        # Инициализировать экстрактор YouTube заранее (импорт модулей, регулярки)
+        ydl.get_info_extractor('Youtube')
+        return ydl
+
+    def warm_up(self):
+        """Создать все экземпляры пула заранее (вызывается при старте бота)."""
+        while True:
+            with self.lock:
+                if self.created >= self.size:
+                    break
+                self.created += 1
+            try:
+                self.instances.put(self._create())
+            except Exception as e:
+                with self.lock:
+                    self.created -= 1
+                logger.error(f"Failed to create YoutubeDL instance: {e}")
+                break
+        logger.info(f"YoutubeDL pool ready: {self.created} instances")
+
+    def _acquire(self):
+        try:
+            return self.instances.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            can_create = self.created < self.size
+            if can_create:
+                self.created += 1
+        if can_create:
+            try:
+                return self._create()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+
+        return self.instances.get()
+
+    def extract_info(self, url: str) -> Dict:
+        """Получить метаданные видео (аналог `yt-dlp -j`). Ошибки yt-dlp пробрасываются."""
+        ydl = self._acquire()
+        try:
+            info = ydl.extract_info(url, download=False)
+            return ydl.sanitize_info(info)
+        finally:
+            self.instances.put(ydl)
+
+
+ytdl_info_pool = YoutubeDLPool()
+video_info_cache = VideoInfoCache()
+
+# Извлечения метаданных "в полете": ключ видео -> Future с результатом (single-flight)
+_video_info_inflight: Dict[str, Future] = {}
+_video_info_inflight_lock = threading.Lock()
 
+# Извлечение идет в отдельном потоке, и вызывающий ждет не дольше YTDLP_INFO_TIMEOUT:
+# socket_timeout ограничивает только один сетевой запрос, а не все извлечение.
+# Таймаут отсчитывается с начала извлечения, ожидание свободного потока ограничено
+# отдельно (YTDLP_INFO_QUEUE_TIMEOUT)
+_video_info_executor = ThreadPoolExecutor(YTDLP_INFO_POOL_SIZE, thread_name_prefix="video-info")
+
+# Загрузка _video_info_executor: извлечения в очереди, в работе и брошенные по таймауту
+# (зависшее извлечение занимает поток, пока не завершится само)
+_video_info_load = {"queued": 0, "running": 0, "abandoned": 0}
+_video_info_load_lock = threading.Lock()
+
+
+def _video_info_load_text() -> str:
+    with _video_info_load_lock:
+        return ", ".join(f"{name} {count}" for name, count in _video_info_load.items())
+
+
+def _run_video_info_task(url: str, cache_key: str, task: Dict) -> Optional[Dict]:
+    """Выполнить извлечение в потоке _video_info_executor, отмечая его в _video_info_load."""
+    with _video_info_load_lock:
+        _video_info_load["queued"] -= 1
+        _video_info_load["running"] += 1
+    task["started"].set()
+    started = time.monotonic()
     try:
-        cmd = [
-            "yt-dlp",
-            "-j",  # JSON output
-            "--no-warnings",
-            "--skip-download",
-            url
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=DOWNLOAD_TIMEOUT_SECONDS)
-        if result.returncode != 0:
-            logger.error(f"yt-dlp error: {result.stderr}")
-            return None
-        
-        data = json.loads(result.stdout)
-        
-        # Получить примерный размер и доступные форматы
-        duration = data.get("duration", 0)
-        filesize_approx = 0
-        
-        # Собрать доступные разрешения
-        formats = data.get("formats", [])
-        available_heights = set()
-        format_sizes = {}  # height -> filesize
-        best_audio_size = 0
-        
-        if formats:
-            for fmt in formats:
-                fmt_filesize = fmt.get("filesize") or fmt.get("filesize_approx") or 0
-                height = fmt.get("height") or 0
-                vcodec = fmt.get("vcodec", "none")
-                acodec = fmt.get("acodec", "none")
-                
-                # Видео форматы
-                if vcodec != "none" and vcodec != "none" and height > 0:
-                    available_heights.add(height)
-                    # Сохранить максимальный размер для каждого разрешения
-                    if height not in format_sizes or fmt_filesize > format_sizes[height]:
-                        format_sizes[height] = fmt_filesize
-                
-                # Аудио формат
-                if acodec != "none" and vcodec == "none" and fmt_filesize > best_audio_size:
-                    best_audio_size = fmt_filesize
+        return _extract_video_info(url, cache_key)
+    finally:
+        with _video_info_load_lock:
+            _video_info_load["running"] -= 1
+            task["done"] = True
+            abandoned = task["abandoned"]
+            if abandoned:
+                _video_info_load["abandoned"] -= 1
+        if abandoned:
+            logger.warning(f"Abandoned video info extraction for {url} finished after "
+                           f"{time.monotonic() - started:.0f}s")
+
+
+def _submit_video_info_task(url: str, cache_key: str) -> Optional[Dict]:
+    """Извлечь метаданные в _video_info_executor. None при ошибке, таймауте или занятом пуле."""
+    task = {"started": threading.Event(), "done": False, "abandoned": False}
+    with _video_info_load_lock:
+        saturated = _video_info_load["running"] >= YTDLP_INFO_POOL_SIZE
+        _video_info_load["queued"] += 1
+    if saturated:
+        logger.warning(f"Video info pool is saturated ({_video_info_load_text()})")
+
+    extraction = _video_info_executor.submit(_run_video_info_task, url, cache_key, task)
+    if not task["started"].wait(YTDLP_INFO_QUEUE_TIMEOUT) and extraction.cancel():
+        with _video_info_load_lock:
+            _video_info_load["queued"] -= 1
+        logger.error(f"get_video_info for {url}: no free worker in {YTDLP_INFO_QUEUE_TIMEOUT}s "
+                     f"({_video_info_load_text()})")
+        return None
+
+    try:
+        return extraction.result(timeout=YTDLP_INFO_TIMEOUT)
+    except FutureTimeoutError:
+        # Зависшее извлечение остается в своем потоке, ждущие получают None
+        with _video_info_load_lock:
+            if not task["done"]:
+                task["abandoned"] = True
+                _video_info_load["abandoned"] += 1
+        logger.error(f"get_video_info timeout for {url} after {YTDLP_INFO_TIMEOUT}s "
+                     f"({_video_info_load_text()})")
+        return None
+
+
+def _build_video_info(data: Dict) -> Dict:
+    """Собрать описание видео и доступных форматов из метаданных yt-dlp."""
+    # Получить примерный размер и доступные форматы
+    duration = data.get("duration", 0)
+    filesize_approx = 0
+    
+    # Собрать доступные разрешения
+    formats = data.get("formats", [])
+    available_heights = set()
+    format_sizes = {}  # height -> filesize
+    best_audio_size = 0
+    
+    if formats:
+        for fmt in formats:
+            fmt_filesize = fmt.get("filesize") or fmt.get("filesize_approx") or 0
+            height = fmt.get("height") or 0
+            vcodec = fmt.get("vcodec", "none")
+            acodec = fmt.get("acodec", "none")
+            
+            # Видео форматы
+            if vcodec != "none" and vcodec != "none" and height > 0:
+                available_heights.add(height)
+                # Сохранить максимальный размер для каждого разрешения
+                if height not in format_sizes or fmt_filesize > format_sizes[height]:
+                    format_sizes[height] = fmt_filesize
+            
+            # Аудио формат
+            if acodec != "none" and vcodec == "none" and fmt_filesize > best_audio_size:
+                best_audio_size = fmt_filesize
+    
+    # Создать список доступных форматов (отсортировано по убыванию)
+    available_formats = []
+    sorted_heights = sorted(available_heights, reverse=True)
+    
+    for height in sorted_heights:
+        # Стандартные названия для распространенных разрешений
+        if height >= 2160:
+            label = "4K"
+        elif height >= 1440:
+            label = "2K"
+        elif height >= 1080:
+            label = "1080p"
+        elif height >= 720:
+            label = "720p"
+        elif height >= 480:
+            label = "480p"
+        elif height >= 360:
+            label = "360p"
+        elif height >= 240:
+            label = "240p"
+        elif height >= 144:
+            label = "144p"
+        else:
+            label = f"{height}p"
         
-        # Создать список доступных форматов (отсортировано по убыванию)
-        available_formats = []
-        sorted_heights = sorted(available_heights, reverse=True)
+        # Оценить размер (видео + аудио)
+        video_size = format_sizes.get(height, 0)
+        estimated_size = video_size + best_audio_size
         
-        for height in sorted_heights:
-            # Стандартные названия для распространенных разрешений
+        # Если нет размера, оценить по битрейту
+        if estimated_size == 0 and duration > 0:
+            # Примерные битрейты для разных разрешений
             if height >= 2160:
-                label = "4K"
+                bitrate = 15.0  # Mbps
             elif height >= 1440:
-                label = "2K"
+                bitrate = 10.0
             elif height >= 1080:
-                label = "1080p"
+                bitrate = 5.0
             elif height >= 720:
-                label = "720p"
+                bitrate = 2.5
             elif height >= 480:
-                label = "480p"
-            elif height >= 360:
-                label = "360p"
-            elif height >= 240:
-                label = "240p"
-            elif height >= 144:
-                label = "144p"
+                bitrate = 1.5
             else:
-                label = f"{height}p"
-            
-            # Оценить размер (видео + аудио)
-            video_size = format_sizes.get(height, 0)
-            estimated_size = video_size + best_audio_size
-            
-            # Если нет размера, оценить по битрейту
-            if estimated_size == 0 and duration > 0:
-                # Примерные битрейты для разных разрешений
-                if height >= 2160:
-                    bitrate = 15.0  # Mbps
-                elif height >= 1440:
-                    bitrate = 10.0
-                elif height >= 1080:
-                    bitrate = 5.0
-                elif height >= 720:
-                    bitrate = 2.5
-                elif height >= 480:
-                    bitrate = 1.5
-                else:
-                    bitrate = 0.8
-                estimated_size = int(duration * bitrate * 1024 * 1024 / 8)
-            
-            available_formats.append({
-                "height": height,
-                "label": label,
-                "filesize": estimated_size
-            })
-        
-        # Ограничить до разумного количества (убрать дубликаты по label)
-        seen_labels = set()
-        unique_formats = []
-        for fmt in available_formats:
-            if fmt["label"] not in seen_labels:
-                seen_labels.add(fmt["label"])
-                unique_formats.append(fmt)
-        
-        # Взять максимальный размер для основного отображения
-        if unique_formats:
-            filesize_approx = unique_formats[0]["filesize"]
-        elif duration > 0:
-            # Fallback оценка
-            bitrate_mbps = 3.0
-            filesize_approx = int(duration * bitrate_mbps * 1024 * 1024 / 8)
+                bitrate = 0.8
+            estimated_size = int(duration * bitrate * 1024 * 1024 / 8)
         
-        video_info = {
-            "title": data.get("title", "Unknown"),
-            "duration": duration,  # в секундах
-            "thumbnail": data.get("thumbnail", ""),
-            "ext": data.get("ext", "mp4"),
-            "filesize": filesize_approx,
-            "id": data.get("id", ""),
-            "available_formats": unique_formats[:8],  # Максимум 8 форматов
-        }
+        available_formats.append({
+            "height": height,
+            "label": label,
+            "filesize": estimated_size
+        })
+    
+    # Ограничить до разумного количества (убрать дубликаты по label)
+    seen_labels = set()
+    unique_formats = []
+    for fmt in available_formats:
+        if fmt["label"] not in seen_labels:
+            seen_labels.add(fmt["label"])
+            unique_formats.append(fmt)
+    
+    # Взять максимальный размер для основного отображения
+    if unique_formats:
+        filesize_approx = unique_formats[0]["filesize"]
+    elif duration > 0:
+        # Fallback оценка
+        bitrate_mbps = 3.0
+        filesize_approx = int(duration * bitrate_mbps * 1024 * 1024 / 8)
+    
+    return {
+        "title": data.get("title", "Unknown"),
+        "duration": duration,  # в секундах
+        "thumbnail": data.get("thumbnail", ""),
+        "ext": data.get("ext", "mp4"),
+        "filesize": filesize_approx,
+        "id": data.get("id", ""),
+        "available_formats": unique_formats[:8],  # Максимум 8 форматов
+    }
+
+
+def get_video_info(url: str) -> Optional[Dict]:
+    """
+    Получить информацию о видео с YouTube используя yt-dlp.
+    Возвращает: {title, duration, thumbnail, ext, filesize, id, available_formats}
+    available_formats - список доступных разрешений видео
+    Использует кэширование для снижения запросов.
+    """
+    # Проверить кэш (по каноническому ключу, а не по тексту ссылки)
+    cache_key = canonical_video_key(url)
+    cached_info = video_info_cache.get(cache_key)
+    if cached_info is not None:
+        logger.info(f"Using cached video info for {cache_key}")
+        return cached_info
+
+    # Одновременные запросы одного видео ждут одно извлечение
+    with _video_info_inflight_lock:
+        future = _video_info_inflight.get(cache_key)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _video_info_inflight[cache_key] = future
+
+    if not is_leader:
+        logger.info(f"Waiting for in-flight video info for {cache_key}")
+        try:
+            return future.result(timeout=YTDLP_INFO_QUEUE_TIMEOUT + YTDLP_INFO_TIMEOUT)
+        except FutureTimeoutError:
+            logger.error(f"Timed out waiting for in-flight video info for {cache_key}")
+            return None
+
+    video_info = None
+    try:
+        # Предыдущее извлечение могло завершиться между проверкой кеша и регистрацией
+        video_info = video_info_cache.get(cache_key)
+        if video_info is None:
+            video_info = _submit_video_info_task(url, cache_key)
+    finally:
+        with _video_info_inflight_lock:
+            del _video_info_inflight[cache_key]
+        future.set_result(video_info)
+    return video_info
+
+
+def _extract_video_info(url: str, cache_key: str) -> Optional[Dict]:
+    """Извлечь метаданные через yt-dlp и сохранить в кеш. None при ошибке."""
+    try:
+        data = ytdl_info_pool.extract_info(url)
+        video_info = _build_video_info(data)
 
         # Сохранить в кэш
-        VIDEO_INFO_CACHE[url] = {
-            'info': video_info,
-            'timestamp': current_time
-        }
+        video_info_cache.put(cache_key, video_info)
 
         return video_info
-    except subprocess.TimeoutExpired:
-        logger.error(f"yt-dlp timeout for {url}")
-        return None
     except Exception as e:
         logger.error(f"get_video_info error: {e}")
         return None
@@ -211,73 +456,195 @@ def format_eta(seconds: int) -> str:
     return f"{minutes:02d}:{secs:02d}"
 
 
+# Имя файла ограничено по байтам: длинные названия не упираются в лимит файловой системы
+OUTPUT_TEMPLATE = "%(title).150B.%(ext)s"
+
+
+def _downloaded_file_path(ydl, info: Dict) -> Optional[Path]:
+    """Итоговый файл загрузки по данным yt-dlp (после склейки и конвертации)."""
+    requested = (info or {}).get("requested_downloads") or [info or {}]
+    for entry in requested:
+        # filepath обновляется постпроцессорами (например, .webm -> .mp3)
+        candidates = [entry.get("filepath"), entry.get("_filename")]
+        for candidate in candidates:
+            if candidate and Path(candidate).is_file():
+                return Path(candidate)
+    try:
+        candidate = Path(ydl.prepare_filename(info))
+    except Exception:
+        return None
+    return candidate if candidate.is_file() else None
+
+
+# Опции YTDLP_CONFIG, которые download_video передает yt-dlp
+DOWNLOAD_TUNING_OPTIONS = ("concurrent_fragment_downloads", "http_chunk_size", "buffersize", "throttledratelimit")
+
+
+def _download_tuning(format_type: str) -> Dict:
+    """Опции скорости загрузки из YTDLP_CONFIG с переопределениями для format_type."""
+    tuning = {key: YTDLP_CONFIG[key] for key in DOWNLOAD_TUNING_OPTIONS if YTDLP_CONFIG.get(key) is not None}
+    tuning.update(YTDLP_CONFIG.get("format_tuning", {}).get(format_type, {}))
+    return tuning
+
+
+# Имя файла отдельного потока (видео или звук) до склейки
+STREAM_OUTPUT_TEMPLATE = "%(title).150B.f%(format_id)s.%(ext)s"
+
+
+def _copy_ie_result(ie_result: Dict) -> Dict:
+    """Копия необработанного результата экстрактора: process_ie_result меняет словари форматов."""
+    return dict(ie_result, formats=[dict(fmt) for fmt in ie_result.get("formats") or ()])
+
+
+def _download_streams_parallel(ydl, ydl_opts: Dict, ie_result: Dict, info: Dict,
+                               reporter: "DownloadProgressReporter") -> Path:
+    """
+    Скачать потоки формата (bestvideo+bestaudio) одновременно и склеить их.
+    yt-dlp качает потоки по очереди, поэтому каждый поток скачивается своим
+    экземпляром YoutubeDL (format = format_id потока) в отдельном потоке,
+    а затем файлы склеивает FFmpegMergerPP, как это сделал бы сам yt-dlp.
+    ydl - экземпляр с опциями ydl_opts, ie_result - результат его
+    extract_info(url, process=False), info - ie_result после выбора формата
+    (с requested_formats).
+    Возвращает путь к склеенному файлу. Ошибки yt-dlp пробрасываются.
+    """
+    import yt_dlp
+    from yt_dlp.postprocessor import FFmpegMergerPP
+
+    merger = FFmpegMergerPP(ydl)
+    if not merger.available:
+        raise yt_dlp.utils.DownloadError("ffmpeg is not installed, cannot merge formats")
+
+    formats = info["requested_formats"]
+    temp_dir = ydl_opts["paths"]["temp"]
+    reporter.expect_streams(info)
+
+    def download_stream(fmt: Dict) -> Path:
+        options = dict(ydl_opts, format=fmt["format_id"], outtmpl=STREAM_OUTPUT_TEMPLATE,
+                       paths={"home": temp_dir, "temp": temp_dir})
+        options.pop("merge_output_format", None)
+        with yt_dlp.YoutubeDL(options) as stream_ydl:
+            stream_ydl.add_progress_hook(reporter.progress_hook)
+            # Метаданные не извлекаются заново: каждый поток выбирает свой формат из копии ie_result
+            result = stream_ydl.process_ie_result(_copy_ie_result(ie_result), download=True)
+            path = _downloaded_file_path(stream_ydl, result)
+        if path is None:
+            raise yt_dlp.utils.DownloadError(f"Stream {fmt['format_id']} was not downloaded")
+        return path
+
+    with ThreadPoolExecutor(len(formats), thread_name_prefix="stream") as executor:
+        downloads = [executor.submit(download_stream, fmt) for fmt in formats]
+    paths = [future.result() for future in downloads]
+
+    merged = dict(info)
+    merged["filepath"] = ydl.prepare_filename(info)
+    merged["requested_formats"] = [dict(fmt, filepath=str(path)) for fmt, path in zip(formats, paths)]
+    merged["__files_to_merge"] = [str(path) for path in paths]
+    merger.add_progress_hook(reporter.postprocessor_hook)
+    files_to_delete, _ = merger.run(merged)
+    for path in files_to_delete:
+        Path(path).unlink(missing_ok=True)
+    return Path(merged["filepath"])
+
+
+def _download_options(output_path: Path, format_type: str) -> Dict:
+    """Опции yt_dlp.YoutubeDL для загрузки format_type в каталог задачи output_path."""
+    # Определить формат для yt-dlp
+    if format_type == "mp3":
+        ydl_opts = {
+            'format': AUDIO_FORMAT,
+            'outtmpl': OUTPUT_TEMPLATE,
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '192',
+            }],
+        }
+    else:
+        # Определить высоту из format_type
+        height = None
+        if format_type == "4K":
+            height = 2160
+        elif format_type == "2K":
+            height = 1440
+        elif format_type.endswith("p"):
+            try:
+                height = int(format_type[:-1])
+            except ValueError:
+                height = 720  # fallback
+        else:
+            height = 720  # fallback
+
+        ydl_opts = {
+            'format': f'bestvideo[height<={height}][vcodec!=none]+bestaudio/best[height<={height}]',
+            'outtmpl': OUTPUT_TEMPLATE,
+            'merge_output_format': 'mp4',
+        }
+
+    # Добавить общие опции
+    ydl_opts.update({
+        'paths': {'home': str(output_path), 'temp': str(output_path / JOB_TEMP_DIR)},
+        'quiet': True,
+        'noprogress': True,  # Прогресс передается через DownloadProgressReporter
+        'no_warnings': True,
+        'geo_bypass': True,
+    })
+    ydl_opts.update(_download_tuning(format_type))
+    return ydl_opts
+
+
+# Сколько раз заново получить ссылки, если скорость упала ниже throttledratelimit
+REEXTRACT_ATTEMPTS = 3
+
+
+def _extract_and_download(ydl, ydl_opts: Dict, url: str, reporter: "DownloadProgressReporter") -> Optional[Path]:
+    """
+    Извлечь метаданные, выбрать формат и скачать его. Возвращает итоговый файл.
+    Метаданные извлекаются без обработки (process=False), поэтому повторное
+    извлечение после ThrottledDownload (ReExtractInfo) делается здесь, а не в
+    extract_info. Уже скачанные потоки при повторе не качаются заново.
+    """
+    import yt_dlp
+
+    for attempt in range(1, REEXTRACT_ATTEMPTS + 1):
+        try:
+            # Сначала только выбор формата: по нему видно, из скольких потоков он состоит
+            ie_result = ydl.extract_info(url, download=False, process=False)
+            info = ydl.process_ie_result(_copy_ie_result(ie_result), download=False)
+
+            if YTDLP_CONFIG.get("parallel_streams") and len(info.get("requested_formats") or ()) > 1:
+                return _download_streams_parallel(ydl, ydl_opts, ie_result, info, reporter)
+            info = ydl.process_ie_result(_copy_ie_result(ie_result), download=True)
+            return _downloaded_file_path(ydl, info)
+        except yt_dlp.utils.ReExtractInfo as e:
+            if attempt == REEXTRACT_ATTEMPTS:
+                raise yt_dlp.utils.DownloadError(str(e)) from e
+            logger.warning(f"{e}; re-extracting {url} (attempt {attempt + 1})")
+
+
 def download_video(url: str, output_path: Path, format_type: str = "1080p",
                    progress_callback=None) -> Tuple[bool, Optional[str], Dict]:
     """
     Загрузить видео с YouTube.
+    output_path - каталог этой задачи (в нем не должно быть других загрузок),
+    промежуточные файлы пишутся в его подкаталог JOB_TEMP_DIR.
     format_type может быть: "mp3", "1080p", "720p", "480p", "360p", "4K", "2K", и т.д.
-    progress_callback(stage, progress_pct, speed, eta, downloaded, total)
+    progress_callback(stage, progress_pct, speed, eta, downloaded, total, step=None)
     Возвращает: (success, file_path, metadata)
-    Использует прогресс-хуки yt-dlp для точного отслеживания.
+    Прогресс считает DownloadProgressReporter по хукам yt-dlp.
+    Если YTDLP_CONFIG["parallel_streams"], видео и звук скачиваются одновременно.
     """
     try:
         import yt_dlp
 
-        # Определить формат для yt-dlp
-        if format_type == "mp3":
-            ydl_opts = {
-                'format': AUDIO_FORMAT,
-                'outtmpl': str(output_path / "%(title)s.%(ext)s"),
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-            }
-        else:
-            # Определить высоту из format_type
-            height = None
-            if format_type == "4K":
-                height = 2160
-            elif format_type == "2K":
-                height = 1440
-            elif format_type.endswith("p"):
-                try:
-                    height = int(format_type[:-1])
-                except ValueError:
-                    height = 720  # fallback
-            else:
-                height = 720  # fallback
-
-            ydl_opts = {
-                'format': f'bestvideo[height<={height}][vcodec!=none]+bestaudio/best[height<={height}]',
-                'outtmpl': str(output_path / "%(title)s.%(ext)s"),
-                'merge_output_format': 'mp4',
-            }
-
-        # Добавить общие опции
-        ydl_opts.update({
-            'quiet': True,
-            'no_warnings': True,
-            'geo_bypass': True,
-            'progress_hooks': [lambda d: self._progress_hook(d, progress_callback)],
-        })
+        ydl_opts = _download_options(output_path, format_type)
 
         try:
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                reporter = DownloadProgressReporter(progress_callback)
+                reporter.attach(ydl)
                 logger.info(f"Starting download: {url} ({format_type})")
-                info = ydl.extract_info(url, download=True)
-
-                # Найти скачанный файл
-                downloaded_file = None
-                newest_time = 0
-                for file in output_path.glob("*"):
-                    if file.is_file() and file.suffix.lower() in [".mp4", ".mkv", ".webm", ".mp3", ".m4a"]:
-                        file_time = file.stat().st_mtime
-                        if file_time > newest_time:
-                            newest_time = file_time
-                            downloaded_file = file
-
+                downloaded_file = _extract_and_download(ydl, ydl_opts, url, reporter)
                 if not downloaded_file:
                     logger.error("Downloaded file not found")
                     return False, None, {}
@@ -315,68 +682,24 @@ def download_video(url: str, output_path: Path, format_type: str = "1080p",
         logger.error(f"Download error: {e}")
         return False, None, {"error": str(e)}
 
-    def _progress_hook(self, d, progress_callback):
-        """Обработчик прогресса yt-dlp."""
-        if d['status'] == 'downloading':
-            try:
-                downloaded = d.get('downloaded_bytes', 0)
-                total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-                speed = d.get('speed', 0)
-                eta = d.get('eta', 0)
-
-                if total > 0:
-                    pct = int((downloaded / total) * 100)
-                else:
-                    pct = 0
-
-                # Конвертировать скорость в MB/s
-                speed_mbps = speed / (1024 * 1024) if speed else 0
-
-                if progress_callback:
-                    progress_callback("downloading", pct, speed_mbps, eta, downloaded, total)
-
-            except Exception as e:
-                logger.debug(f"Progress hook error: {e}")
-
-        elif d['status'] == 'finished':
-            if progress_callback:
-                progress_callback("converting", 90, 0, 0, 0, 0)
-
-
-def cleanup_old_files(storage_path: Path, max_age_hours: int = 72) -> int:
-    """Удалить старые файлы старше max_age_hours. Возвращает количество удаленных."""
-    import time
-    current_time = time.time()
-    removed_count = 0
-    
-    for file in storage_path.glob("*"):
-        if file.is_file():
-            file_age_hours = (current_time - file.stat().st_mtime) / 3600
-            if file_age_hours > max_age_hours:
-                try:
-                    file.unlink()
-                    removed_count += 1
-                    logger.info(f"Removed old file: {file.name}")
-                except Exception as e:
-                    logger.error(f"Failed to remove {file.name}: {e}")
-    
-    return removed_count
-
-
-def get_storage_size_mb(storage_path: Path) -> float:
-    """Получить размер папки storage в MB."""
-    total_size = sum(f.stat().st_size for f in storage_path.rglob("*") if f.is_file())
-    return total_size / (1024 * 1024)
 
 
 class ProgressTracker:
-    """Трекер прогресса загрузки с расчетом скорости и ETA."""
+    """Трекер прогресса загрузки с расчетом скорости и ETA.
+    Скорость сглаживается экспоненциальным средним, чтобы ETA не скакал
+    между фрагментами.
+    """
+    
+    SMOOTHING = 0.3  # Вес нового замера скорости
+    MIN_INTERVAL = 0.5  # Чаще скорость не пересчитывается
     
     def __init__(self):
         self.start_time = time.time()
         self.last_bytes = 0
         self.last_time = self.start_time
         self.total_bytes = 0
+        self.speed = 0.0  # байт/с, сглаженная
+        self.eta_seconds = 0
     
     def update(self, bytes_downloaded: int, total_bytes: int) -> Tuple[int, float, int]:
         """
@@ -385,20 +708,130 @@ class ProgressTracker:
         """
         current_time = time.time()
         time_delta = current_time - self.last_time
-        
-        if time_delta < 0.5:
-            return 0, 0, 0
-        
-        bytes_delta = bytes_downloaded - self.last_bytes
-        speed_mbps = (bytes_delta / time_delta) / (1024 * 1024) if time_delta > 0 else 0
-        
-        pct = int((bytes_downloaded / total_bytes) * 100) if total_bytes > 0 else 0
-        
-        remaining_bytes = total_bytes - bytes_downloaded
-        eta_seconds = int(remaining_bytes / (bytes_delta / time_delta)) if bytes_delta > 0 else 0
-        
-        self.last_bytes = bytes_downloaded
-        self.last_time = current_time
+        pct = min(int((bytes_downloaded / total_bytes) * 100), 100) if total_bytes > 0 else 0
         self.total_bytes = total_bytes
         
-        return pct, speed_mbps, eta_seconds
+        if time_delta >= self.MIN_INTERVAL:
+            bytes_delta = max(bytes_downloaded - self.last_bytes, 0)
+            current_speed = bytes_delta / time_delta
+            if self.speed:
+                self.speed = self.SMOOTHING * current_speed + (1 - self.SMOOTHING) * self.speed
+            else:
+                self.speed = current_speed
+            
+            remaining_bytes = max(total_bytes - bytes_downloaded, 0)
+            self.eta_seconds = int(remaining_bytes / self.speed) if self.speed > 0 else 0
+            
+            self.last_bytes = bytes_downloaded
+            self.last_time = current_time
+        
+        return pct, self.speed / (1024 * 1024), self.eta_seconds
+
+
+class DownloadProgressReporter:
+    """Хуки прогресса yt-dlp -> progress_callback.
+
+    Видео и звук (bestvideo+bestaudio) скачиваются отдельными потоками (возможно,
+    одновременно), процент считается по сумме байт всех потоков. Хук потока не знает о соседних потоках,
+    поэтому их размеры заранее берутся из requested_formats (attach добавляет
+    постпроцессор, который yt-dlp вызывает перед загрузкой). После загрузки
+    сообщает этапы постобработки (склейка, конвертация) со статусом "converting".
+    """
+
+    # Постпроцессоры yt-dlp -> название этапа для пользователя
+    POSTPROCESSOR_STEPS = {
+        "Merger": "Склеиваю видео и звук",
+        "ExtractAudio": "Конвертирую в MP3",
+        "VideoConvertor": "Конвертирую видео",
+        "VideoRemuxer": "Перепаковываю видео",
+        "FixupM3u8": "Исправляю контейнер",
+        "FixupM4a": "Исправляю контейнер",
+    }
+
+    def __init__(self, progress_callback=None):
+        self.progress_callback = progress_callback
+        self.tracker = ProgressTracker()
+        self.streams: Dict[str, List[int]] = {}  # format_id -> [скачано, всего]
+        self.lock = threading.Lock()
+
+    def attach(self, ydl):
+        """Подключить хуки к экземпляру YoutubeDL."""
+        from yt_dlp.postprocessor import PostProcessor
+
+        reporter = self
+
+        class ExpectStreamsPP(PostProcessor):
+            def run(self, info):
+                reporter.expect_streams(info)
+                return [], info
+
+        ydl.add_post_processor(ExpectStreamsPP(ydl), when="before_dl")
+        ydl.add_progress_hook(self.progress_hook)
+        ydl.add_postprocessor_hook(self.postprocessor_hook)
+
+    def progress_hook(self, d: Dict):
+        """progress_hooks: состояние загрузки одного потока."""
+        if not self.progress_callback or d.get("status") not in ("downloading", "finished"):
+            return
+        try:
+            info = d.get("info_dict") or {}
+            with self.lock:
+                stream = self.streams.setdefault(self._stream_key(info, d), [0, 0])
+                total = d.get("total_bytes") or d.get("total_bytes_estimate") or stream[1]
+                downloaded = d.get("downloaded_bytes") or 0
+                if d["status"] == "finished":
+                    downloaded = total = max(downloaded, total)
+                stream[0], stream[1] = downloaded, max(total, downloaded)
+
+                downloaded_sum = sum(stream[0] for stream in self.streams.values())
+                total_sum = sum(stream[1] for stream in self.streams.values())
+                pct, speed_mbps, eta = self.tracker.update(downloaded_sum, total_sum)
+                # Под блокировкой: хуки параллельных потоков не должны писать в callback одновременно
+                self.progress_callback("downloading", pct, speed_mbps, eta, downloaded_sum, total_sum)
+        except Exception as e:
+            logger.debug(f"Progress hook error: {e}")
+
+    def postprocessor_hook(self, d: Dict):
+        """postprocessor_hooks: начало этапа постобработки."""
+        if not self.progress_callback or d.get("status") != "started":
+            return
+        step = self.POSTPROCESSOR_STEPS.get(d.get("postprocessor"))
+        if step:
+            self.progress_callback("converting", 100, 0, 0, 0, 0, step=step)
+
+    def expect_streams(self, info: Dict):
+        """Заранее учесть все потоки формата, чтобы процент не откатывался назад."""
+        with self.lock:
+            for fmt in info.get("requested_formats") or ():
+                key = str(fmt.get("format_id"))
+                if key not in self.streams:
+                    self.streams[key] = [0, fmt.get("filesize") or fmt.get("filesize_approx") or 0]
+
+    @staticmethod
+    def _stream_key(info: Dict, d: Dict) -> str:
+        format_id = info.get("format_id")
+        return str(format_id) if format_id is not None else d.get("filename", "")
+
+
+class KeyedLock:
+    """Набор блокировок по ключу: with keyed_lock(key) сериализует работу с одним ключом.
+    Блокировка удаляется, когда ее никто не держит и не ждет.
+    """
+
+    def __init__(self):
+        self.locks: Dict[object, list] = {}  # key -> [Lock, число пользователей]
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def __call__(self, key):
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[key]
@@ -0,0 +1,160 @@
+"""
+Кеш метаданных видео для get_video_info
+LRU с ограничением по числу записей и объему, TTL, счетчики попаданий и
+опциональная запись в SQLite, чтобы после перезапуска кеш не был пустым
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict
+
+from config import (
+    VIDEO_INFO_CACHE_TIMEOUT, VIDEO_INFO_CACHE_MAX_ENTRIES, VIDEO_INFO_CACHE_MAX_BYTES
+)
+
+logger = logging.getLogger(__name__)
+
+
+class VideoInfoCache:
+    """Потокобезопасный LRU/TTL кеш: ключ видео -> словарь video_info.
+
+    store - объект с методами load_video_info(key) -> (info_json, expires_at) | None,
+    save_video_info(key, info_json, expires_at), delete_video_info(key) и
+    purge_video_info(now) (обычно db). Подключается через attach_store, чтобы
+    этот модуль не зависел от db.
+    """
+
+    def __init__(self, ttl: float = VIDEO_INFO_CACHE_TIMEOUT,
+                 max_entries: int = VIDEO_INFO_CACHE_MAX_ENTRIES,
+                 max_bytes: int = VIDEO_INFO_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()  # key -> {info, expires_at, size}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.store = None
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def attach_store(self, store):
+        """Включить запись в постоянное хранилище (и чтение из него при промахе)."""
+        self.store = store
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Вернуть video_info или None (нет записи или она просрочена)."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry["expires_at"] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry["info"]
+                self._remove(key)
+
+        info = self._load_from_store(key, now)
+        with self.lock:
+            if info is None:
+                self.misses += 1
+            else:
+                self.store_hits += 1
+        return info
+
+    def put(self, key: str, info: Dict):
+        """Сохранить video_info на ttl секунд."""
+        expires_at = time.time() + self.ttl
+        info_json = json.dumps(info, ensure_ascii=False)
+        self._put_memory(key, info, expires_at, len(info_json))
+
+        if self.store is not None:
+            try:
+                self.store.save_video_info(key, info_json, expires_at)
+            except Exception as e:
+                logger.error(f"Failed to persist video info for {key}: {e}")
+
+    def delete(self, key: str):
+        """Удалить запись."""
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+        if self.store is not None:
+            try:
+                self.store.delete_video_info(key)
+            except Exception as e:
+                logger.error(f"Failed to delete video info for {key}: {e}")
+
+    def purge_expired(self) -> int:
+        """Удалить просроченные записи. Возвращает число удаленных из памяти."""
+        now = time.time()
+        with self.lock:
+            expired = [key for key, entry in self.entries.items() if entry["expires_at"] <= now]
+            for key in expired:
+                self._remove(key)
+
+        if self.store is not None:
+            try:
+                self.store.purge_video_info(now)
+            except Exception as e:
+                logger.error(f"Failed to purge video info cache: {e}")
+        return len(expired)
+
+    def stats(self) -> Dict:
+        """Счетчики для панели администратора."""
+        with self.lock:
+            lookups = self.hits + self.store_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.store_hits) / lookups if lookups else 0.0,
+            }
+
+    def _load_from_store(self, key: str, now: float) -> Optional[Dict]:
+        if self.store is None:
+            return None
+        try:
+            row = self.store.load_video_info(key)
+        except Exception as e:
+            logger.error(f"Failed to load video info for {key}: {e}")
+            return None
+        if not row:
+            return None
+
+        info_json, expires_at = row
+        if expires_at <= now:
+            return None
+        try:
+            info = json.loads(info_json)
+        except ValueError:
+            return None
+
+        self._put_memory(key, info, expires_at, len(info_json))
+        return info
+
+    def _put_memory(self, key: str, info: Dict, expires_at: float, size: int):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            # Запись больше всего лимита не кешируется в памяти
+            if size > self.max_bytes:
+                return
+            self.entries[key] = {"info": info, "expires_at": expires_at, "size": size}
+            self.total_bytes += size
+
+            while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                oldest_key = next(iter(self.entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry["size"]
@@ -0,0 +1,127 @@
+"""
+Проверка download_video на локальном HTTP-сервере: видео и звук отдельными
+потоками (как bestvideo+bestaudio на YouTube), загрузка и склейка через ffmpeg
+Запуск: python -m unittest discover tests
+"""
+
+import functools
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import yt_dlp  # noqa: E402
+
+import utils  # noqa: E402
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@unittest.skipIf(shutil.which("ffmpeg") is None, "ffmpeg is not installed")
+class DownloadStreamsTest(unittest.TestCase):
+    """download_video для формата из двух потоков: параллельно и средствами yt-dlp."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_dir = Path(tempfile.mkdtemp())
+        ffmpeg = ["ffmpeg", "-loglevel", "error", "-y", "-f", "lavfi"]
+        subprocess.run(ffmpeg + ["-i", "testsrc=duration=2:size=320x240:rate=25", "-c:v", "libx264", "-an",
+                                 str(cls.media_dir / "video.mp4")], check=True)
+        subprocess.run(ffmpeg + ["-i", "sine=duration=2", "-c:a", "aac", "-vn",
+                                 str(cls.media_dir / "audio.m4a")], check=True)
+
+        handler = functools.partial(QuietHandler, directory=str(cls.media_dir))
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        cls.info = {
+            "id": "test", "title": "test video", "webpage_url": base_url,
+            "extractor": "generic", "extractor_key": "Generic",
+            "formats": [
+                {"format_id": "v240", "url": f"{base_url}/video.mp4", "ext": "mp4", "protocol": "http",
+                 "vcodec": "avc1", "acodec": "none", "height": 240, "width": 320,
+                 "filesize": (cls.media_dir / "video.mp4").stat().st_size},
+                {"format_id": "a", "url": f"{base_url}/audio.m4a", "ext": "m4a", "protocol": "http",
+                 "vcodec": "none", "acodec": "mp4a.40.2",
+                 "filesize": (cls.media_dir / "audio.m4a").stat().st_size},
+            ],
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.media_dir, ignore_errors=True)
+
+    def setUp(self):
+        self.job_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.job_dir, ignore_errors=True)
+        self.events = []
+
+    def progress(self, stage, pct, speed, eta, downloaded, total, step=None):
+        self.events.append((stage, pct, step))
+
+    def download(self, parallel_streams: bool):
+        info = self.info
+
+        def extract_info(ydl, url, download=True, process=True, **kwargs):
+            ie_result = utils._copy_ie_result(info)
+            return ydl.process_ie_result(ie_result, download=download) if process else ie_result
+
+        with mock.patch.object(yt_dlp.YoutubeDL, "extract_info", extract_info), \
+                mock.patch.dict(utils.YTDLP_CONFIG, parallel_streams=parallel_streams), \
+                mock.patch.object(utils, "_download_streams_parallel",
+                                  wraps=utils._download_streams_parallel) as parallel:
+            result = utils.download_video(info["webpage_url"], self.job_dir, "720p", self.progress)
+        return result, parallel.called
+
+    def assert_merged(self, file_path: str):
+        path = Path(file_path)
+        self.assertTrue(path.is_file())
+        self.assertEqual(path.suffix, ".mp4")
+        self.assertEqual(path.parent, self.job_dir)
+        probe = subprocess.run(["ffmpeg", "-i", str(path)], capture_output=True, text=True).stderr
+        self.assertIn("Video:", probe)
+        self.assertIn("Audio:", probe)
+
+    def test_parallel_streams_are_merged(self):
+        (success, file_path, metadata), parallel = self.download(parallel_streams=True)
+        self.assertTrue(success, metadata)
+        self.assertTrue(parallel)
+        self.assert_merged(file_path)
+        self.assertEqual(metadata["file_size"], Path(file_path).stat().st_size)
+        # Файлы потоков удалены после склейки
+        self.assertEqual(list((self.job_dir / utils.JOB_TEMP_DIR).glob("*.f*")), [])
+        downloading = [pct for stage, pct, _ in self.events if stage == "downloading"]
+        self.assertEqual(downloading[-1], 100)
+        self.assertIn(("converting", 100, utils.DownloadProgressReporter.POSTPROCESSOR_STEPS["Merger"]),
+                      self.events)
+
+    def test_sequential_download_is_merged(self):
+        (success, file_path, metadata), parallel = self.download(parallel_streams=False)
+        self.assertTrue(success, metadata)
+        self.assertFalse(parallel)
+        self.assert_merged(file_path)
+
+    def test_missing_stream_fails_download(self):
+        broken = dict(self.info, formats=[dict(self.info["formats"][0]),
+                                          dict(self.info["formats"][1], url=self.info["formats"][1]["url"] + ".missing")])
+        with mock.patch.object(type(self), "info", broken):
+            (success, file_path, metadata), parallel = self.download(parallel_streams=True)
+        self.assertTrue(parallel)
+        self.assertFalse(success)
+        self.assertIsNone(file_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
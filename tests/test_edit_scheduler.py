@@ -0,0 +1,106 @@
+"""
+Проверка EditScheduler.forget: после forget сообщение больше не редактируется,
+а правка, которая уже отправляется, завершается до возврата из forget
+Запуск: python -m unittest discover tests
+"""
+
+import sys
+import threading
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from edit_scheduler import EditScheduler  # noqa: E402
+
+
+class FakeBot:
+    """Записывает правки; block задерживает отправку, пока не выставлен release."""
+
+    def __init__(self, block: bool = False):
+        self.edits = []
+        self.block = block
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def edit_message_text(self, text, chat_id, message_id, reply_markup=None):
+        self.started.set()
+        if self.block:
+            self.release.wait(5)
+        self.edits.append((chat_id, message_id, text))
+
+
+def wait_for(predicate, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+class ForgetTest(unittest.TestCase):
+    def make_scheduler(self, bot: FakeBot) -> EditScheduler:
+        scheduler = EditScheduler(bot, global_rate=100, chat_rate=100, group_rate=100)
+        self.addCleanup(scheduler.stop)
+        return scheduler
+
+    def test_forget_drops_pending_edit(self):
+        bot = FakeBot()
+        scheduler = self.make_scheduler(bot)
+        scheduler.submit(1, 10, "50%")
+        scheduler.submit(1, 11, "10%")
+        scheduler.forget(1, 10)
+        scheduler.start()
+
+        self.assertTrue(wait_for(lambda: bot.edits))
+        time.sleep(0.1)
+        self.assertEqual(bot.edits, [(1, 11, "10%")])
+        self.assertNotIn((1, 10), scheduler.generations)
+
+    def test_forget_waits_for_edit_in_flight(self):
+        bot = FakeBot(block=True)
+        scheduler = self.make_scheduler(bot)
+        scheduler.start()
+        scheduler.submit(1, 10, "50%")
+        self.assertTrue(bot.started.wait(5))
+
+        forgotten = threading.Event()
+        forgetter = threading.Thread(target=lambda: (scheduler.forget(1, 10), forgotten.set()))
+        forgetter.start()
+        self.assertFalse(forgotten.wait(0.2))
+
+        bot.release.set()
+        self.assertTrue(forgotten.wait(5))
+        forgetter.join()
+        # Итоговый текст, отправленный после forget, ничто не перезапишет
+        self.assertEqual(bot.edits, [(1, 10, "50%")])
+        self.assertNotIn((1, 10), scheduler.last_sent)
+
+    def test_edit_taken_before_forget_is_not_sent(self):
+        bot = FakeBot()
+        scheduler = self.make_scheduler(bot)
+        scheduler.submit(1, 10, "50%")
+        generation = scheduler.generations[(1, 10)]
+        scheduler.pending.pop((1, 10))  # Правку взял поток отправки
+        scheduler.forget(1, 10)
+
+        scheduler._send((1, 10), "50%", None, generation)
+        self.assertEqual(bot.edits, [])
+
+    def test_new_message_after_forget_gets_new_generation(self):
+        bot = FakeBot()
+        scheduler = self.make_scheduler(bot)
+        scheduler.submit(1, 10, "50%")
+        old_generation = scheduler.generations[(1, 10)]
+        scheduler.forget(1, 10)
+        scheduler.submit(1, 10, "0%")
+
+        self.assertNotEqual(scheduler.generations[(1, 10)], old_generation)
+        scheduler._send((1, 10), "50%", None, old_generation)
+        self.assertEqual(bot.edits, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+Проверка разбора заголовка Range и пути подписанной ссылки на файл
+Запуск: python -m unittest discover tests
+"""
+
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from http_server import parse_file_link, parse_range  # noqa: E402
+
+
+class ParseRangeTest(unittest.TestCase):
+    def test_no_range(self):
+        self.assertIsNone(parse_range(None, 100))
+        self.assertIsNone(parse_range("", 100))
+        self.assertIsNone(parse_range("items=0-10", 100))
+        self.assertIsNone(parse_range("bytes=10", 100))
+        self.assertIsNone(parse_range("bytes=a-b", 100))
+
+    def test_multiple_ranges_serve_whole_file(self):
+        self.assertIsNone(parse_range("bytes=0-10,20-30", 100))
+
+    def test_closed_and_open_ranges(self):
+        self.assertEqual(parse_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(parse_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=90-500", 100), (90, 99))
+
+    def test_suffix_range(self):
+        self.assertEqual(parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-500", 100), (0, 99))
+        self.assertIs(parse_range("bytes=-0", 100), False)
+
+    def test_unsatisfiable(self):
+        self.assertIs(parse_range("bytes=100-", 100), False)
+        self.assertIs(parse_range("bytes=20-10", 100), False)
+        self.assertIs(parse_range("bytes=0-", 0), False)
+
+
+class ParseFileLinkTest(unittest.TestCase):
+    def test_valid_link(self):
+        self.assertEqual(parse_file_link("/d/42/1700000000/abc123/video%20file.mp4"),
+                         (42, 1700000000, "abc123", "video%20file.mp4"))
+
+    def test_invalid_links(self):
+        for path in ("/d/42/1700000000/abc123", "/d/42/1700000000/abc123/", "/x/42/1700000000/abc/f.mp4",
+                     "d/42/1700000000/abc/f.mp4/x", "/d/id/1700000000/abc/f.mp4", "/d/42/soon/abc/f.mp4",
+                     "/d/42/1700000000/abc/f.mp4/extra"):
+            with self.subTest(path=path):
+                self.assertIsNone(parse_file_link(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
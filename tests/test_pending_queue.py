@@ -0,0 +1,71 @@
+"""
+Проверка PendingQueue: порядок очереди, ленивое удаление и повышение приоритета
+Запуск: python -m unittest discover tests
+"""
+
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import config  # noqa: E402
+
+# Глобальная БД модуля db создается при импорте - не трогать рабочую
+config.DB_PATH = Path(tempfile.mkdtemp()) / "test.db"
+
+from db import PendingQueue  # noqa: E402
+
+
+def download(download_id: int, created_at: str) -> dict:
+    return {"download_id": download_id, "created_at": created_at}
+
+
+class PendingQueueTest(unittest.TestCase):
+    def test_priority_class_then_creation_order(self):
+        queue = PendingQueue()
+        queue.push(download(1, "2024-01-01T10:00:00"), PendingQueue.REGULAR)
+        queue.push(download(2, "2024-01-01T09:00:00"), PendingQueue.REGULAR)
+        queue.push(download(3, "2024-01-01T11:00:00"), PendingQueue.PRIORITY)
+
+        self.assertEqual([queue.pop()["download_id"] for _ in range(3)], [3, 2, 1])
+        self.assertIsNone(queue.pop())
+
+    def test_discard_skips_entry_on_pop(self):
+        queue = PendingQueue()
+        queue.push(download(1, "2024-01-01T10:00:00"), PendingQueue.REGULAR)
+        queue.push(download(2, "2024-01-01T11:00:00"), PendingQueue.REGULAR)
+
+        self.assertTrue(queue.discard(1))
+        self.assertFalse(queue.discard(1))
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.pop()["download_id"], 2)
+        self.assertIsNone(queue.pop())
+
+    def test_discard_compacts_heap(self):
+        queue = PendingQueue()
+        for download_id in range(200):
+            queue.push(download(download_id, f"2024-01-01T10:00:{download_id % 60:02d}"), PendingQueue.REGULAR)
+        for download_id in range(190):
+            queue.discard(download_id)
+
+        self.assertLessEqual(len(queue.heap), 2 * len(queue) + 64)
+        self.assertEqual(sorted(d["download_id"] for d in queue.snapshot()), list(range(190, 200)))
+
+    def test_promote_moves_ahead_without_duplicates(self):
+        queue = PendingQueue()
+        queue.push(download(1, "2024-01-01T10:00:00"), PendingQueue.REGULAR)
+        queue.push(download(2, "2024-01-01T11:00:00"), PendingQueue.REGULAR)
+        queue.promote(2, PendingQueue.PRIORITY)
+        queue.promote(3, PendingQueue.PRIORITY)  # Нет в очереди - ничего не меняется
+
+        self.assertEqual([d["download_id"] for d in queue.snapshot()], [2, 1])
+        self.assertEqual(queue.pop()["download_id"], 2)
+        self.assertEqual(queue.pop()["download_id"], 1)
+        # Устаревшая запись heap повышенной задачи не возвращает ее второй раз
+        self.assertIsNone(queue.pop())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""
+Проверка StorageManager.enforce_quota: LRU-вытеснение до low_watermark,
+файлы в отправке и со ссылками не удаляются
+Запуск: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from storage import StorageManager  # noqa: E402
+
+
+class EnforceQuotaTest(unittest.TestCase):
+    def setUp(self):
+        self.storage_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.storage_dir, ignore_errors=True)
+        self.manager = StorageManager(self.storage_dir, quota_bytes=300, low_watermark=0.7)
+
+    def make_file(self, name: str, size: int, age: float) -> Path:
+        """Файл размера size, последнее обращение к которому было age секунд назад."""
+        path = self.storage_dir / name
+        path.write_bytes(b"x" * size)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_under_quota_keeps_files(self):
+        self.make_file("a", 100, 30)
+        self.manager.scan()
+        self.assertEqual(self.manager.enforce_quota(), 0)
+        self.assertEqual(self.manager.total_bytes, 100)
+
+    def test_evicts_least_recently_used_down_to_watermark(self):
+        oldest = self.make_file("oldest", 100, 30)
+        older = self.make_file("older", 100, 20)
+        newer = self.make_file("newer", 100, 10)
+        newest = self.make_file("newest", 100, 0)
+        self.manager.scan()
+
+        self.assertEqual(self.manager.enforce_quota(), 2)
+        self.assertFalse(oldest.exists())
+        self.assertFalse(older.exists())
+        self.assertTrue(newer.exists())
+        self.assertTrue(newest.exists())
+        self.assertEqual(self.manager.total_bytes, 200)
+        self.assertEqual(self.manager.evicted_files, 2)
+
+    def test_pinned_and_in_use_files_are_kept(self):
+        linked = self.make_file("linked", 100, 40)
+        sending = self.make_file("sending", 100, 30)
+        expired = self.make_file("expired", 100, 20)
+        idle = self.make_file("idle", 100, 10)
+        self.manager.scan()
+        self.manager.pin(linked, time.time() + 3600)
+        self.manager.pin(expired, time.time() - 1)
+        # pin и in_use отмечают обращение - вернуть порядок LRU
+        for path, age in ((linked, 40), (sending, 30), (expired, 20)):
+            self.manager.files[path.resolve()].last_access = time.time() - age
+
+        with self.manager.in_use(sending):
+            self.assertEqual(self.manager.enforce_quota(), 2)
+
+        self.assertTrue(linked.exists())
+        self.assertTrue(sending.exists())
+        self.assertFalse(expired.exists())
+        self.assertFalse(idle.exists())
+
+    def test_all_files_pinned_stays_over_quota(self):
+        paths = [self.make_file(name, 100, 10) for name in ("a", "b", "c", "d")]
+        self.manager.scan()
+        for path in paths:
+            self.manager.pin(path, time.time() + 3600)
+
+        self.assertEqual(self.manager.enforce_quota(), 0)
+        self.assertTrue(all(path.exists() for path in paths))
+        self.assertEqual(self.manager.total_bytes, 400)
+
+    def test_scan_keeps_pins(self):
+        linked = self.make_file("linked", 100, 40)
+        self.manager.scan()
+        self.manager.pin(linked, time.time() + 3600)
+        for name, age in (("b", 30), ("c", 20), ("d", 10)):
+            self.make_file(name, 100, age)
+        self.manager.scan()
+
+        self.manager.enforce_quota()
+        self.assertTrue(linked.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()